@@ -32,15 +32,20 @@ import astropy.io.fits
 
 import ztfperiodic
 from ztfperiodic.period import CE
-from ztfperiodic.lcstats import calc_basic_stats, calc_fourier_stats
+from ztfperiodic.batch import LightcurveBatch
+from ztfperiodic.features import BASIC_FEATURES, FOURIER_FEATURES
+from ztfperiodic.features import calc_feature_columns
 from ztfperiodic.utils import get_kowalski_bulk
+from ztfperiodic.utils import get_featuresetnames
 from ztfperiodic.utils import get_kowalski_list
 from ztfperiodic.utils import get_kowalski_objids
 from ztfperiodic.utils import get_simulated_list
 from ztfperiodic.utils import get_matchfile
 from ztfperiodic.utils import find_matchfile
 from ztfperiodic.utils import convert_to_hex
-from ztfperiodic.periodsearch import find_periods
+from ztfperiodic.periodsearch import get_engine, make_engine, iter_find_periods
+from ztfperiodic.periodsearch import FusedEngine, find_periods_fused
+from ztfperiodic.periodsearch import FrequencyGrid, get_peaks
 from ztfperiodic.specfunc import correlate_spec, adjust_subplots_band, tick_function
 
 try:
@@ -126,6 +131,17 @@ def parse_commandline():
     parser.add_option("--doCheckLightcurves",  action="store_true", default=False)
 
     parser.add_option("--samples_per_peak",default=10,type=int)
+    parser.add_option("--freq_chunk_size",default=1000,type=int)
+    parser.add_option("--freq_block_size",default=0,type=int)
+    parser.add_option("--lightcurve_batch_size",default=0,type=int)
+    parser.add_option("--doCoarseToFine",  action="store_true", default=False)
+    parser.add_option("--coarse_decimation",default=10,type=int)
+    parser.add_option("--nfreqs_to_keep",default=5,type=int)
+    parser.add_option("--npeaks",default=1,type=int)
+    parser.add_option("--summary_bins",default=0,type=int)
+    parser.add_option("--featuresetname",default=None)
+    parser.add_option("--cacheDir",default=None)
+    parser.add_option("--cache_max_size",default=10.0,type=float)
 
     opts, args = parser.parse_args()
 
@@ -181,6 +197,17 @@ def touch(fname):
     else:
         open(fname, 'a').close()
 
+def append_rows(hf, name, rows):
+    """Appends *rows* to the dataset *name* of the h5py file *hf*, created
+    resizable along its first axis on the first call"""
+    rows = np.asarray(rows)
+    if not name in hf:
+        hf.create_dataset(name, data=rows, maxshape=(None,)+rows.shape[1:])
+        return
+    dset = hf[name]
+    dset.resize(dset.shape[0] + len(rows), axis=0)
+    dset[-len(rows):] = rows
+
 # Parse command line
 opts = parse_commandline()
 
@@ -193,6 +220,16 @@ if not (opts.doCPU or opts.doGPU):
     exit(0)
 
 algorithms = opts.algorithm.split(',')
+engines = {}
+for algorithm in algorithms:
+    try:
+        engines[algorithm] = get_engine(algorithm, doGPU=opts.doGPU,
+                                        doCPU=opts.doCPU)
+    except ValueError as e:
+        print(e)
+        exit(0)
+# engines that share work between sources observed at the same epochs
+doSharedEpochs = any([engine.shared_epochs for engine in engines.values()])
 matchFile = opts.matchFile
 outputDir = opts.outputDir
 batch_size = opts.batch_size
@@ -247,10 +284,6 @@ with h5py.File(WDcat, 'r') as f:
     parallax = f['parallax'][:]
 absmagWD=gmag+5*(np.log10(np.abs(parallax))-2)
 
-if opts.doCPU and "BLS" in algorithms:
-    print("BLS only available for --doGPU")
-    exit(0)
-
 if (opts.source_type == "catalog") and (("blue" in catalog_file) or ("wdb" in catalog_file)):
     period_ranges = [0,0.0020833333333333333,0.002777778,0.0034722,0.0041666,0.004861111,0.006944444,0.020833333,0.041666667,0.083333333,0.166666667,0.5,3.0,10.0,50.0,np.inf]
     folders = [None,"3min","4min","5min","6min","7_10min","10_30min","30_60min","1_2hours","2_4hours","4_12hours","12_72hours","3_10days","10_50days","50_baseline"]
@@ -571,7 +604,8 @@ elif opts.lightcurve_source == "matchfiles":
                                                      doRemoveHC=doRemoveHC,
                                                      doHCOnly=doHCOnly,
                                                      Ncatalog=Ncatalog,
-                                                     Ncatindex=Ncatindex)
+                                                     Ncatindex=Ncatindex,
+                                                     doZeroPoint=not doSharedEpochs)
 
     if opts.doRemoveBrightStars:
         lightcurves, coordinates, filters, ids, absmags, bp_rps, names =\
@@ -625,22 +659,18 @@ if opts.doCheckLightcurves:
     print('Just checking that there are lightcurves to analyze... exiting.')
     exit(0)
 
+# with a feature set, only its features are computed (the others are NaN),
+# plus the stats read by the driver itself: n and iqr
+if opts.featuresetname is not None:
+    featurenames = get_featuresetnames(opts.featuresetname) + ['n', 'iqr']
+else:
+    featurenames = None
+
 print('Running lightcurve basic stats...')
 start_time = time.time()
 
-if opts.doParallel:
-    from joblib import Parallel, delayed
-    stats = Parallel(n_jobs=opts.Ncore)(delayed(calc_basic_stats)(LC[0],LC[1],LC[2]) for LC in lightcurves)
-else:
-    stats = []
-    for ii,data in enumerate(lightcurves):
-        if np.mod(ii,100) == 0:
-            print("%d/%d"%(ii,len(lightcurves)))
-        copy = np.ma.copy(data).T
-        t, mag, magerr = copy[:,0], copy[:,1], copy[:,2]
-
-        stat = calc_basic_stats(t, mag, magerr)
-        stats.append(stat)
+stats = calc_feature_columns(LightcurveBatch.from_lightcurves(lightcurves),
+                             BASIC_FEATURES, featurenames)
 end_time = time.time()
 print('Lightcurve basic statistics took %.2f seconds' % (end_time - start_time))
 
@@ -670,65 +700,97 @@ if opts.doRemoveTerrestrial:
     freqs_to_remove = [[3e-2,4e-2], [3.95,4.05], [2.95,3.05], [1.95,2.05], [0.95,1.05], [0.48, 0.52]]
 else:
     freqs_to_remove = None
+# the excluded bands are computed once and shared by all of the engines
+grid = FrequencyGrid(freqs, freqs_to_remove=freqs_to_remove)
+
+# the CPU statistics of the fused engine (ECE, EAOV, ELS) are all
+# computed in a single pass over the frequency grid
+fused_results = {}
+fused_algorithms = [algorithm for algorithm in algorithms
+                    if issubclass(engines[algorithm], FusedEngine)]
+if (len(fused_algorithms) > 1) and not opts.doNotPeriodFind:
+    print('Analyzing %d lightcurves with %s...' % (len(lightcurves),
+                                                   ",".join(fused_algorithms)))
+    start_time = time.time()
+    fused_results = find_periods_fused(fused_algorithms, lightcurves, grid,
+                                       doRemoveTerrestrial=opts.doRemoveTerrestrial,
+                                       freqs_to_remove=freqs_to_remove,
+                                       phase_bins=phase_bins,
+                                       mag_bins=mag_bins,
+                                       freq_chunk_size=opts.freq_chunk_size,
+                                       freq_block_size=opts.freq_block_size)
+    end_time = time.time()
+    print('Lightcurve analysis took %.2f seconds' % (end_time - start_time))
+
+# period-search results are reused from the cache of earlier runs
+# with --cacheDir (maximum size in GB)
+if opts.cacheDir is not None:
+    from ztfperiodic.cache import ResultCache
+    cache = ResultCache(opts.cacheDir, max_size=opts.cache_max_size*1e9)
+else:
+    cache = None
+
+# the top peaks and max-pooled periodogram of each source are saved in the
+# catalog file when requested
+doSavePeaks = (opts.npeaks > 1) or (opts.summary_bins > 0)
+
+# the catalog rows of each batch are appended to the catalog file as soon
+# as its periods are found, so that they are never all held in memory; the
+# names, filters and basic stats are the same for all of the algorithms
+hf = h5py.File(catalogFile, 'w')
+hf.create_dataset("names",
+                  data=np.array([np.bytes_(name) for name in names]))
+hf.create_dataset("filters",
+                  data=np.array([np.bytes_("_".join([str(x) for x in filt]))
+                                 for filt in filters]))
+hf.create_dataset("stats", data=np.column_stack((ids, coordinates, stats)))
 
-periodic_stats_algorithms = {}
 for algorithm in algorithms:    
-    if opts.doGPU and (algorithm == "PDM"):
-        from cuvarbase.utils import weights
-        lightcurves_pdm = []
-        for lightcurve in lightcurves:
-            t, y, dy = lightcurve
-            lightcurves_pdm.append((t, y, weights(np.ones(dy.shape)), freqs))
-        lightcurves = lightcurves_pdm 
-    
     if opts.doNotPeriodFind:
-        periods_best = np.ones((len(lightcurves),1))
-        significances = np.ones((len(lightcurves),1))
-        pdots = np.ones((len(lightcurves),1))
+        results = [(np.arange(len(lightcurves)),
+                    np.ones((len(lightcurves),)),
+                    np.ones((len(lightcurves),)),
+                    np.ones((len(lightcurves),)),
+                    get_peaks(np.ones((len(lightcurves),)), opts.npeaks,
+                              opts.summary_bins))]
+    elif algorithm in fused_results:
+        results = [(np.arange(len(lightcurves)),) + fused_results[algorithm] +
+                   (get_peaks(fused_results[algorithm][0], opts.npeaks,
+                              opts.summary_bins),)]
     else:
         print('Analyzing %d lightcurves...' % len(lightcurves))
-        start_time = time.time()
-        periods_best, significances, pdots = find_periods(algorithm, lightcurves, 
-                                                          freqs, 
-                                                          doGPU=opts.doGPU,
-                                                          doCPU=opts.doCPU,
-                                                          doSaveMemory=opts.doSaveMemory,
-                                                          doRemoveTerrestrial=opts.doRemoveTerrestrial,
-                                                          freqs_to_remove=freqs_to_remove,
-                                                          doUsePDot=opts.doUsePDot,
-                                                          doSingleTimeSegment=opts.doSingleTimeSegment,
-                                                          doParallel=opts.doParallel,
-                                                          Ncore=opts.Ncore)
-        end_time = time.time()
-        print('Lightcurve analysis took %.2f seconds' % (end_time - start_time))
-    
-    print('Running lightcurve stats...')
-    start_time = time.time()
+        engine = make_engine(algorithm,
+                             doGPU=opts.doGPU,
+                             doCPU=opts.doCPU,
+                             doSaveMemory=opts.doSaveMemory,
+                             doRemoveTerrestrial=opts.doRemoveTerrestrial,
+                             freqs_to_remove=freqs_to_remove,
+                             doUsePDot=opts.doUsePDot,
+                             doSingleTimeSegment=opts.doSingleTimeSegment,
+                             doParallel=opts.doParallel,
+                             Ncore=opts.Ncore,
+                             freq_chunk_size=opts.freq_chunk_size,
+                             freq_block_size=opts.freq_block_size,
+                             doCoarseToFine=opts.doCoarseToFine,
+                             coarse_decimation=opts.coarse_decimation,
+                             nfreqs_to_keep=opts.nfreqs_to_keep,
+                             npeaks=opts.npeaks,
+                             summary_bins=opts.summary_bins,
+                             cache=cache)
+        lightcurve_batch_size = opts.lightcurve_batch_size
+        if lightcurve_batch_size <= 0:
+            lightcurve_batch_size = len(lightcurves)
+        results = iter_find_periods(engine, enumerate(lightcurves), grid,
+                                    batch_size=lightcurve_batch_size,
+                                    return_peaks=True)
 
-    if opts.doParallel:
-        from joblib import Parallel, delayed
-        periodic_stats = Parallel(n_jobs=opts.Ncore)(delayed(calc_fourier_stats)(LC[0],LC[1],LC[2],p) for LC,p in zip(lightcurves,periods_best))
-    else:
-        periodic_stats = []
-        for ii,data in enumerate(lightcurves):
-            period = periods_best[ii]
-            if np.mod(ii,100) == 0:
-                print("%d/%d"%(ii,len(lightcurves)))
-            copy = np.ma.copy(data).T
-            t, mag, magerr = copy[:,0], copy[:,1], copy[:,2]
-
-            periodic_stat = calc_fourier_stats(t, mag, magerr, period)
-            periodic_stats.append(periodic_stat)
-    end_time = time.time()
-    print('Lightcurve statistics took %.2f seconds' % (end_time - start_time))
-    
     if not opts.sigthresh is None:
         sigthresh = opts.sigthresh
     else:
         if opts.doVariability:
             sigthresh = 0.15
         else:
-            if algorithm == "LS":
+            if algorithm in ["LS", "LS_GEMM"]:
                 sigthresh = 1e6
             elif algorithm == "FFT":
                 sigthresh = 0
@@ -759,14 +821,9 @@ for algorithm in algorithms:
     
         lamost = SkyCoord(ra=lamost_ra*u.degree, dec=lamost_dec*u.degree, frame='icrs')    
     
-    print('Cataloging / Plotting lightcurves...')
     if opts.doSpectra:
         data_out = {}
     
-    str_stats = np.empty((0,2))
-    data_stats = np.empty((0,25))
-    data_periodic_stats = np.empty((0,18))
-    
     if baseline<10:
         basefolder = os.path.join(outputDir,'%sHC'%algorithm)
     else:
@@ -774,304 +831,292 @@ for algorithm in algorithms:
     if (opts.source_type == "catalog") and ("fermi" in catalog_file):
         basefolder = os.path.join(basefolder,'%d' % Ncatindex)
     
-    cnt = 0
-    fid = open(catalogFile,'w')
-    for lightcurve, filt, objid, name, coordinate, absmag, bp_rp, period, significance, pdot in zip(lightcurves,filters,ids,names,coordinates,absmags,bp_rps,periods_best,significances,pdots):
-        filt_str = "_".join([str(x) for x in filt])
-    
-        str_stats = np.append(str_stats,
-                              np.array([[np.string_(name),
-                                         np.string_(filt_str)]]), axis=0)
-                                        
-        data_stats = np.append(data_stats,
-                               np.array([[objid, coordinate[0],
-                                          coordinate[1],
-                                          stats[cnt][0], stats[cnt][1],
-                                          stats[cnt][2], stats[cnt][3],
-                                          stats[cnt][4], stats[cnt][5],
-                                          stats[cnt][6], stats[cnt][7],
-                                          stats[cnt][8], stats[cnt][9],
-                                          stats[cnt][10], stats[cnt][11],
-                                          stats[cnt][12], stats[cnt][13],
-                                          stats[cnt][14], stats[cnt][15],
-                                          stats[cnt][16], stats[cnt][17],
-                                          stats[cnt][18], stats[cnt][19],
-                                          stats[cnt][20], stats[cnt][21]]]),
-                               axis=0)
-
-        data_periodic_stats = np.append(data_periodic_stats,
-                               np.array([[objid,
-                                          period, significance,
-                                          pdot,
-                                          periodic_stats[cnt][0], periodic_stats[cnt][1],
-                                          periodic_stats[cnt][2], periodic_stats[cnt][3],
-                                          periodic_stats[cnt][4], periodic_stats[cnt][5],
-                                          periodic_stats[cnt][6], periodic_stats[cnt][7],
-                                          periodic_stats[cnt][8], periodic_stats[cnt][9],
-                                          periodic_stats[cnt][10], periodic_stats[cnt][11],
-                                          periodic_stats[cnt][12], periodic_stats[cnt][13]]]),
-                               axis=0)
+    # the lightcurve stats of each batch are computed, and its lightcurves
+    # cataloged and plotted, as soon as its periods are available
+    start_time = time.time()
+    for indices, periods_batch, significances_batch, pdots_batch, peaks_batch in results:
+        # the Fourier decompositions are solved for 1000 lightcurves at a
+        # time, padded to the same length
+        print('Running lightcurve stats...')
+        periodic_stats = np.full((len(indices), len(FOURIER_FEATURES)), np.nan)
+        nchunks = int(np.ceil(len(indices)/1000.0))
+        for chunk in np.array_split(np.arange(len(indices)), max(nchunks, 1)):
+            if len(chunk) == 0:
+                continue
+            batch = LightcurveBatch.from_lightcurves([lightcurves[ii] for ii in indices[chunk]])
+            periodic_stats[chunk] = calc_feature_columns(batch,
+                                                         FOURIER_FEATURES,
+                                                         featurenames,
+                                                         period=periods_batch[chunk])
+
+        append_rows(hf, "stats_%s" % algorithm,
+                    np.column_stack((np.asarray(ids)[indices], periods_batch,
+                                     significances_batch, pdots_batch,
+                                     periodic_stats)))
+        if doSavePeaks:
+            for key in ["peak_freqs", "peak_stats", "summary"]:
+                append_rows(hf, "%s_%s" % (key, algorithm), peaks_batch[key])
+            if not "summary_freqs_%s" % algorithm in hf:
+                hf.create_dataset("summary_freqs_%s" % algorithm,
+                                  data=peaks_batch["summary_freqs"])
+
+        print('Cataloging / Plotting lightcurves...')
+        for cnt, period, significance, pdot in zip(indices, periods_batch, significances_batch, pdots_batch):
+            lightcurve, filt, objid, name = lightcurves[cnt], filters[cnt], ids[cnt], names[cnt]
+            coordinate, absmag, bp_rp = coordinates[cnt], absmags[cnt], bp_rps[cnt]
+            filt_str = "_".join([str(x) for x in filt])
     
-        if opts.doPlots and ((period/(1.0/fmax)) <= 1.05):
-            print("%d %.5f %.5f %d: Period is within 5 per." % (objid, coordinate[0], coordinate[1], stats[cnt][0]))
+            if opts.doPlots and ((period/(1.0/fmax)) <= 1.05):
+                print("%d %.5f %.5f %.0f: Period is within 5 per." % (objid, coordinate[0], coordinate[1], stats[cnt][0]))
     
-        if opts.doVariability:
-            significance = stats[cnt][9]        
+            if opts.doVariability:
+                significance = stats[cnt][9]        
     
-        if opts.doSpectra:
-            data_out[name] = {}
-            data_out[name]["name"] = name
-            data_out[name]["objid"] = objid
-            data_out[name]["RA"] = coordinate[0]
-            data_out[name]["Dec"] = coordinate[1]
-            data_out[name]["period"] = period
-            data_out[name]["significance"] = significance
-            data_out[name]["pdot"] = pdot
-            data_out[name]["filt"] = filt
-            data_out[name]["stats"] = stats[cnt]
+            if opts.doSpectra:
+                data_out[name] = {}
+                data_out[name]["name"] = name
+                data_out[name]["objid"] = objid
+                data_out[name]["RA"] = coordinate[0]
+                data_out[name]["Dec"] = coordinate[1]
+                data_out[name]["period"] = period
+                data_out[name]["significance"] = significance
+                data_out[name]["pdot"] = pdot
+                data_out[name]["filt"] = filt
+                data_out[name]["stats"] = stats[cnt]
   
-        if opts.doPlots and (significance>sigthresh):
-            if opts.doHCOnly and np.isclose(period, 1.0/fmin, rtol=1e-2):
-                print("Vetoing... period is 1/fmax")
-                continue
-    
-            RA, Dec = coordinate
-            if opts.doObjIDFilenames:
-                figfile = "%d.png" % objid
-            else:
-                figfile = "%.10f_%.10f_%.10f_%.10f_%s.png"%(significance, RA, Dec,
-                                                          period, "".join(filt_str))
+            if opts.doPlots and (significance>sigthresh):
+                if opts.doHCOnly and np.isclose(period, 1.0/fmin, rtol=1e-2):
+                    print("Vetoing... period is 1/fmax")
+                    continue
     
-                if opts.doNotPeriodFind:
-                    thisfolder = 'noperiod'
+                RA, Dec = coordinate
+                if opts.doObjIDFilenames:
+                    figfile = "%d.png" % objid
                 else:
-                    idx = np.where((period>=period_ranges[:-1]) & (period<=period_ranges[1:]))[0][0]
-                    thisfolder = folders[idx.astype(int)]
-                    if thisfolder == None:
-                        continue
+                    figfile = "%.10f_%.10f_%.10f_%.10f_%s.png"%(significance, RA, Dec,
+                                                              period, "".join(filt_str))
+    
+                    if opts.doNotPeriodFind:
+                        thisfolder = 'noperiod'
+                    else:
+                        idx = np.where((period>=period_ranges[:-1]) & (period<=period_ranges[1:]))[0][0]
+                        thisfolder = folders[idx.astype(int)]
+                        if thisfolder == None:
+                            continue
     
-            if opts.doGPU and (algorithm == "PDM"):
-                copy = np.ma.copy((lightcurve[0],lightcurve[1],lightcurve[2])).T
-            else:
                 copy = np.ma.copy(lightcurve).T
     
-            if opts.doObjIDFilenames:
-                objid_str = str(objid)
-                folder = os.path.join(basefolder, objid_str[2], objid_str[3])
-            else:
-                nepoch = np.array(len(copy[:,0]))
-                idx2 = np.where((nepoch>=epoch_ranges[:-1]) & (nepoch<=epoch_ranges[1:]))[0][0]
-                if epoch_folders[idx2.astype(int)] == None:
-                    continue
+                if opts.doObjIDFilenames:
+                    objid_str = str(objid)
+                    folder = os.path.join(basefolder, objid_str[2], objid_str[3])
+                else:
+                    nepoch = np.array(len(copy[:,0]))
+                    idx2 = np.where((nepoch>=epoch_ranges[:-1]) & (nepoch<=epoch_ranges[1:]))[0][0]
+                    if epoch_folders[idx2.astype(int)] == None:
+                        continue
     
-                folder = os.path.join(basefolder,thisfolder,epoch_folders[idx2.astype(int)])
-            if not os.path.isdir(folder):
-                os.makedirs(folder)
-            pngfile = os.path.join(folder,figfile)
+                    folder = os.path.join(basefolder,thisfolder,epoch_folders[idx2.astype(int)])
+                if not os.path.isdir(folder):
+                    os.makedirs(folder)
+                pngfile = os.path.join(folder,figfile)
     
-            if opts.doVariability:
-                phases = copy[:,0]
-            else:
-                if pdot == 0:
-                    phases = np.mod(copy[:,0],2*period)/(2*period)
+                if opts.doVariability:
+                    phases = copy[:,0]
                 else:
-                    time_vals = copy[:,0] - np.min(copy[:,0])
-                    phases=np.mod((time_vals-(1.0/2.0)*(pdot/period)*(time_vals)**2),2*period)/(2*period)
-            magnitude, err = copy[:,1], copy[:,2]
+                    if pdot == 0:
+                        phases = np.mod(copy[:,0],2*period)/(2*period)
+                    else:
+                        time_vals = copy[:,0] - np.min(copy[:,0])
+                        phases=np.mod((time_vals-(1.0/2.0)*(pdot/period)*(time_vals)**2),2*period)/(2*period)
+                magnitude, err = copy[:,1], copy[:,2]
     
-            spectral_data = {}
-            if opts.doSpectra:
-                coord = SkyCoord(ra=RA*u.degree, dec=Dec*u.degree, frame='icrs')
-                try:
-                    xid = SDSS.query_region(coord, spectro=True)
-                except:
-                    xid = None
-                if not xid is None:
+                spectral_data = {}
+                if opts.doSpectra:
+                    coord = SkyCoord(ra=RA*u.degree, dec=Dec*u.degree, frame='icrs')
                     try:
-                        spec = SDSS.get_spectra(matches=xid)[0]
+                        xid = SDSS.query_region(coord, spectro=True)
                     except:
-                        spec = []
-                        pass
-                    for ii, sp in enumerate(spec):
+                        xid = None
+                    if not xid is None:
                         try:
-                            sp.data["loglam"]
+                            spec = SDSS.get_spectra(matches=xid)[0]
                         except:
-                            continue
-                        lam = 10**sp.data["loglam"]
-                        flux = sp.data["flux"]
-                        key = len(list(spectral_data.keys()))
-                        spectral_data[key] = {}
-                        spectral_data[key]["lambda"] = lam
-                        spectral_data[key]["flux"] = flux            
-    
-                sep = coord.separation(lamost).deg
-                idx = np.argmin(sep)
-                if sep[idx] < 3.0/3600.0:
-                    idy = np.where(idx == lamost_inverse)[0]
-                    obsids = lamost_obsid[idy]
-                    for obsid in obsids:
-                        requestpage = "%s/%d" % (lamostfits, obsid)
-     
-                        with tempfile.NamedTemporaryFile(mode='w') as f:
-                            wget_command = "wget %s -O %s" % (requestpage, f.name)
-                            os.system(wget_command)
-                            hdul = astropy.io.fits.open(f.name)
-            
-                        for ii, sp in enumerate(hdul):
-                            lam = sp.data[2,:]
-                            flux = sp.data[0,:]
+                            spec = []
+                            pass
+                        for ii, sp in enumerate(spec):
+                            try:
+                                sp.data["loglam"]
+                            except:
+                                continue
+                            lam = 10**sp.data["loglam"]
+                            flux = sp.data["flux"]
                             key = len(list(spectral_data.keys()))
                             spectral_data[key] = {}
                             spectral_data[key]["lambda"] = lam
-                            spectral_data[key]["flux"] = flux
+                            spectral_data[key]["flux"] = flux            
     
-            if len(spectral_data.keys()) > 0:
-                #fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(25,10))
-                fig = plt.figure(figsize=(25,10))
-                gs = fig.add_gridspec(nrows=3, ncols=6)
-                ax1 = fig.add_subplot(gs[:, 0:2])
-                ax2 = fig.add_subplot(gs[:, 2:4])
-                #ax3 = fig.add_subplot(gs[0, 2])
-            else:
-                fig, (ax1, ax2) = plt.subplots(1, 2,figsize=(20,10))
-            ax1.errorbar(phases, magnitude,err,ls='none',c='k')
-            period2=period
-            ymed = np.nanmedian(magnitude)
-            y10, y90 = np.nanpercentile(magnitude,10), np.nanpercentile(magnitude,90)
-            ystd = np.nanmedian(err)
-            ymin = y10 - 7*ystd
-            ymax = y90 + 7*ystd
-            ax1.set_ylim([ymin,ymax])
-            ax1.invert_yaxis()
-            asymmetric_error = np.atleast_2d([absmag[1], absmag[2]]).T
-            hist2 = ax2.hist2d(bprpWD,absmagWD, bins=100,zorder=0,norm=LogNorm())
-            if not np.isnan(bp_rp) or not np.isnan(absmag[0]):
-                ax2.errorbar(bp_rp,absmag[0],yerr=asymmetric_error,
-                             c='r',zorder=1,fmt='o')
-            ax2.set_xlim([-1,4.0])
-            ax2.set_ylim([-5,18])
-            ax2.invert_yaxis()
-            fig.colorbar(hist2[3],ax=ax2)
-            nspec = len(spectral_data.keys())
-            npairs = 0
-            if nspec > 1:
-                bands = [[4750.0, 4950.0], [6475.0, 6650.0], [8450, 8700]]
-                npairs = int(nspec * (nspec-1)/2)
-                v_values = np.zeros((len(bands), npairs))
-                v_values_unc = np.zeros((len(bands), npairs))
-                data_out[name]["spectra"] = {}
-                for jj, band in enumerate(bands):
-                    data_out[name]["spectra"][jj] = np.empty((0,3))
+                    sep = coord.separation(lamost).deg
+                    idx = np.argmin(sep)
+                    if sep[idx] < 3.0/3600.0:
+                        idy = np.where(idx == lamost_inverse)[0]
+                        obsids = lamost_obsid[idy]
+                        for obsid in obsids:
+                            requestpage = "%s/%d" % (lamostfits, obsid)
+     
+                            with tempfile.NamedTemporaryFile(mode='w') as f:
+                                wget_command = "wget %s -O %s" % (requestpage, f.name)
+                                os.system(wget_command)
+                                hdul = astropy.io.fits.open(f.name)
+            
+                            for ii, sp in enumerate(hdul):
+                                lam = sp.data[2,:]
+                                flux = sp.data[0,:]
+                                key = len(list(spectral_data.keys()))
+                                spectral_data[key] = {}
+                                spectral_data[key]["lambda"] = lam
+                                spectral_data[key]["flux"] = flux
     
-                    ax = fig.add_subplot(gs[jj, 4])
-                    ax_ = fig.add_subplot(gs[jj, 5])
-                    xmin, xmax = band[0], band[1]
-                    ymin, ymax = np.inf, -np.inf
-                    for key in spectral_data:
-                        idx = np.where( (spectral_data[key]["lambda"] >= xmin) &
-                                        (spectral_data[key]["lambda"] <= xmax))[0]
-                        wave = spectral_data[key]["lambda"][idx]
-                        myflux = spectral_data[key]["flux"][idx]
-                        # quick-and-dirty normalization
-                        myflux -= np.median(myflux)
-                        if len(myflux) == 0: continue
-                        myflux /= np.max(np.abs(myflux))
-                        y1 = np.nanpercentile(myflux,1)
-                        y99 = np.nanpercentile(myflux,99)
-                        ydiff = y99 - y1
-                        ymintmp = y1 - ydiff
-                        ymaxtmp = y99 + ydiff
-                        if ymin > ymintmp:
-                            ymin = ymintmp
-                        if ymaxtmp > ymax:
-                            ymax = ymaxtmp
-                        ax.plot(wave, myflux, '--')
-                    correlation_funcs = correlate_spec(spectral_data, band = band)
-                    # cross correlation
-                    if correlation_funcs == {}:
-                        pass
-                    else:
-                        if len(correlation_funcs) == 1:
-                            yheights = [0.5]
+                if len(spectral_data.keys()) > 0:
+                    #fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(25,10))
+                    fig = plt.figure(figsize=(25,10))
+                    gs = fig.add_gridspec(nrows=3, ncols=6)
+                    ax1 = fig.add_subplot(gs[:, 0:2])
+                    ax2 = fig.add_subplot(gs[:, 2:4])
+                    #ax3 = fig.add_subplot(gs[0, 2])
+                else:
+                    fig, (ax1, ax2) = plt.subplots(1, 2,figsize=(20,10))
+                ax1.errorbar(phases, magnitude,err,ls='none',c='k')
+                period2=period
+                ymed = np.nanmedian(magnitude)
+                y10, y90 = np.nanpercentile(magnitude,10), np.nanpercentile(magnitude,90)
+                ystd = np.nanmedian(err)
+                ymin = y10 - 7*ystd
+                ymax = y90 + 7*ystd
+                ax1.set_ylim([ymin,ymax])
+                ax1.invert_yaxis()
+                asymmetric_error = np.atleast_2d([absmag[1], absmag[2]]).T
+                hist2 = ax2.hist2d(bprpWD,absmagWD, bins=100,zorder=0,norm=LogNorm())
+                if not np.isnan(bp_rp) or not np.isnan(absmag[0]):
+                    ax2.errorbar(bp_rp,absmag[0],yerr=asymmetric_error,
+                                 c='r',zorder=1,fmt='o')
+                ax2.set_xlim([-1,4.0])
+                ax2.set_ylim([-5,18])
+                ax2.invert_yaxis()
+                fig.colorbar(hist2[3],ax=ax2)
+                nspec = len(spectral_data.keys())
+                npairs = 0
+                if nspec > 1:
+                    bands = [[4750.0, 4950.0], [6475.0, 6650.0], [8450, 8700]]
+                    npairs = int(nspec * (nspec-1)/2)
+                    v_values = np.zeros((len(bands), npairs))
+                    v_values_unc = np.zeros((len(bands), npairs))
+                    data_out[name]["spectra"] = {}
+                    for jj, band in enumerate(bands):
+                        data_out[name]["spectra"][jj] = np.empty((0,3))
+    
+                        ax = fig.add_subplot(gs[jj, 4])
+                        ax_ = fig.add_subplot(gs[jj, 5])
+                        xmin, xmax = band[0], band[1]
+                        ymin, ymax = np.inf, -np.inf
+                        for key in spectral_data:
+                            idx = np.where( (spectral_data[key]["lambda"] >= xmin) &
+                                            (spectral_data[key]["lambda"] <= xmax))[0]
+                            wave = spectral_data[key]["lambda"][idx]
+                            myflux = spectral_data[key]["flux"][idx]
+                            # quick-and-dirty normalization
+                            myflux -= np.median(myflux)
+                            if len(myflux) == 0: continue
+                            myflux /= np.max(np.abs(myflux))
+                            y1 = np.nanpercentile(myflux,1)
+                            y99 = np.nanpercentile(myflux,99)
+                            ydiff = y99 - y1
+                            ymintmp = y1 - ydiff
+                            ymaxtmp = y99 + ydiff
+                            if ymin > ymintmp:
+                                ymin = ymintmp
+                            if ymaxtmp > ymax:
+                                ymax = ymaxtmp
+                            ax.plot(wave, myflux, '--')
+                        correlation_funcs = correlate_spec(spectral_data, band = band)
+                        # cross correlation
+                        if correlation_funcs == {}:
+                            pass
                         else:
-                            yheights = np.linspace(0.25,0.75,len(correlation_funcs))
-                        for kk, key in enumerate(correlation_funcs):
-                            if not 'v_peak' in correlation_funcs[key]:
-                                continue
-                            vpeak = correlation_funcs[key]['v_peak']
-                            vpeak_unc = correlation_funcs[key]['v_peak_unc']
-                            Cpeak = correlation_funcs[key]['C_peak']
-                            ax_.plot(correlation_funcs[key]["velocity"], correlation_funcs[key]["correlation"])
-                            ax_.plot([vpeak, vpeak], [0, Cpeak], 'k--')
-                            ax_.text(250, yheights[kk], "v=%.0f +- %.0f"%(vpeak, vpeak_unc))
-                            v_values[jj][kk] = vpeak
-                            v_values_unc[jj][kk] = vpeak_unc
-                            data_out[name]["spectra"][jj] = np.vstack((data_out[name]["spectra"][jj], [vpeak, vpeak_unc, Cpeak]))
+                            if len(correlation_funcs) == 1:
+                                yheights = [0.5]
+                            else:
+                                yheights = np.linspace(0.25,0.75,len(correlation_funcs))
+                            for kk, key in enumerate(correlation_funcs):
+                                if not 'v_peak' in correlation_funcs[key]:
+                                    continue
+                                vpeak = correlation_funcs[key]['v_peak']
+                                vpeak_unc = correlation_funcs[key]['v_peak_unc']
+                                Cpeak = correlation_funcs[key]['C_peak']
+                                ax_.plot(correlation_funcs[key]["velocity"], correlation_funcs[key]["correlation"])
+                                ax_.plot([vpeak, vpeak], [0, Cpeak], 'k--')
+                                ax_.text(250, yheights[kk], "v=%.0f +- %.0f"%(vpeak, vpeak_unc))
+                                v_values[jj][kk] = vpeak
+                                v_values_unc[jj][kk] = vpeak_unc
+                                data_out[name]["spectra"][jj] = np.vstack((data_out[name]["spectra"][jj], [vpeak, vpeak_unc, Cpeak]))
     
-                    if np.isfinite(ymin) and np.isfinite(ymax):
-                        ax.set_ylim([ymin,ymax])
-                    ax.set_xlim([xmin,xmax])
-                    ax_.set_ylim([0,1])
-                    ax_.set_xlim([-1000,1000])
-                    if jj == len(bands)-1:
-                        ax.set_xlabel('Wavelength [A]')
-                        ax_.set_xlabel('Velocity [km/s]')
-                        adjust_subplots_band(ax, ax_)
+                        if np.isfinite(ymin) and np.isfinite(ymax):
+                            ax.set_ylim([ymin,ymax])
+                        ax.set_xlim([xmin,xmax])
+                        ax_.set_ylim([0,1])
+                        ax_.set_xlim([-1000,1000])
+                        if jj == len(bands)-1:
+                            ax.set_xlabel('Wavelength [A]')
+                            ax_.set_xlabel('Velocity [km/s]')
+                            adjust_subplots_band(ax, ax_)
+                        else:
+                            ax_.set_xticklabels([])
+                        if jj==1:
+                            new_tick_locations = np.array([-1000, -500, 0, 500, 1000])
+                            axmass = ax_.twiny()
+                            axmass.set_xlim(ax_.get_xlim())
+                            axmass.set_xticks(new_tick_locations)
+                            tick_labels = tick_function(new_tick_locations, period)
+                            tick_labels = ["{0:.0f}".format(float(x)) for x in tick_labels]
+                            axmass.set_xticklabels(tick_labels)
+                            axmass.set_xlabel("f($M$) ("+r'$M_\odot$'+')')
+                if npairs > 0:
+                    # calculate mass functon
+                    if npairs==1:
+                        id_pair = 0
                     else:
-                        ax_.set_xticklabels([])
-                    if jj==1:
-                        new_tick_locations = np.array([-1000, -500, 0, 500, 1000])
-                        axmass = ax_.twiny()
-                        axmass.set_xlim(ax_.get_xlim())
-                        axmass.set_xticks(new_tick_locations)
-                        tick_labels = tick_function(new_tick_locations, period)
-                        tick_labels = ["{0:.0f}".format(float(x)) for x in tick_labels]
-                        axmass.set_xticklabels(tick_labels)
-                        axmass.set_xlabel("f($M$) ("+r'$M_\odot$'+')')
-            if npairs > 0:
-                # calculate mass functon
-                if npairs==1:
-                    id_pair = 0
+                        # select a pair with:
+                        # (1) reasonable variance among all band measurements
+                        stds = np.std(v_values, axis=0)
+                        if np.sum(stds<50)>=1:
+                            v_values = v_values[:, stds<50]
+                            v_values_unc = v_values_unc[:, stds<50]
+                        # (2) largest (absolute) velosity variation
+                        vsums = np.sum(abs(v_values), axis=0)
+                        id_pair = np.where(vsums == max(vsums))[0][0]
+                    v_adopt = np.median(v_values[:,id_pair])
+                    id_band = np.where(v_values[:,id_pair]==v_adopt)[0][0]
+                    v_adopt_unc = v_values_unc[id_band,id_pair]
+                    K = abs(v_adopt/2.) # [km/s] assuming that the velocity variation is max and min in rv curve
+                    K_unc = abs(v_adopt_unc/2.) # [km/s]
+                    P = 2*period # [day] if ellipsodial modulation, amplitude are roughly the same, 
+                                # then the photometric period is probably half of the orbital period
+                    fmass = (K * 100000)**3 * (P*86400) / (2*np.pi*const.G.cgs.value) / const.M_sun.cgs.value
+                    fmass_unc = 3 * fmass / K * K_unc
+                    data_out[name]["fmass"] = fmass
+                    data_out[name]["fmass_unc"] = fmass_unc
+                if pdot == 0:
+                    plt.suptitle(str(period2)+"_"+str(RA)+"_"+str(Dec))
                 else:
-                    # select a pair with:
-                    # (1) reasonable variance among all band measurements
-                    stds = np.std(v_values, axis=0)
-                    if np.sum(stds<50)>=1:
-                        v_values = v_values[:, stds<50]
-                        v_values_unc = v_values_unc[:, stds<50]
-                    # (2) largest (absolute) velosity variation
-                    vsums = np.sum(abs(v_values), axis=0)
-                    id_pair = np.where(vsums == max(vsums))[0][0]
-                v_adopt = np.median(v_values[:,id_pair])
-                id_band = np.where(v_values[:,id_pair]==v_adopt)[0][0]
-                v_adopt_unc = v_values_unc[id_band,id_pair]
-                K = abs(v_adopt/2.) # [km/s] assuming that the velocity variation is max and min in rv curve
-                K_unc = abs(v_adopt_unc/2.) # [km/s]
-                P = 2*period # [day] if ellipsodial modulation, amplitude are roughly the same, 
-                            # then the photometric period is probably half of the orbital period
-                fmass = (K * 100000)**3 * (P*86400) / (2*np.pi*const.G.cgs.value) / const.M_sun.cgs.value
-                fmass_unc = 3 * fmass / K * K_unc
-                data_out[name]["fmass"] = fmass
-                data_out[name]["fmass_unc"] = fmass_unc
-            if pdot == 0:
-                plt.suptitle(str(period2)+"_"+str(RA)+"_"+str(Dec))
-            else:
-                plt.suptitle(str(period2)+"_"+str(RA)+"_"+str(Dec)+"_"+str(pdot))
-            fig.savefig(pngfile, bbox_inches='tight')
-            plt.close()
-    
-        cnt = cnt + 1
-
-    periodic_stats_algorithms[algorithm] = data_periodic_stats
+                    plt.suptitle(str(period2)+"_"+str(RA)+"_"+str(Dec)+"_"+str(pdot))
+                fig.savefig(pngfile, bbox_inches='tight')
+                plt.close()
 
-with h5py.File(catalogFile, 'w') as hf:
-    hf.create_dataset("names",  data=str_stats[:,0])
-    hf.create_dataset("filters",  data=str_stats[:,1])
-    hf.create_dataset("stats",  data=data_stats)
+    end_time = time.time()
+    print('Lightcurve analysis, statistics and cataloging took %.2f seconds' % (end_time - start_time))
+    if cache is not None:
+        print('Cache hits: %d, misses: %d' % (cache.hits, cache.misses))
 
-    for algorithm in algorithms:
-        hf.create_dataset("stats_%s" % algorithm,
-                          data=periodic_stats_algorithms[algorithm])
+hf.close()
 
 if opts.doSpectra:
     with open(spectraFile, 'wb') as handle:
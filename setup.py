@@ -29,7 +29,7 @@ if sys.version < '2.6':
 import glob
 import os.path
 
-from setuptools import (setup, find_packages)
+from setuptools import (setup, find_packages, Extension)
 
 # set basic metadata
 PACKAGENAME = 'ztfperiodic'
@@ -91,6 +91,23 @@ extras_require = {
     ],
 }
 
+# -- extensions ---------------------------------------------------------------
+
+# the multi-threaded AOV periodogram is optional, it requires Cython and an
+# OpenMP-capable compiler
+try:
+    from Cython.Build import cythonize
+    import numpy
+except ImportError:
+    ext_modules = []
+else:
+    ext_modules = cythonize([
+        Extension('ztfperiodic.AOV_cython', ['ztfperiodic/AOV_cython.pyx'],
+                  include_dirs=[numpy.get_include()],
+                  extra_compile_args=['-O3', '-fopenmp'],
+                  extra_link_args=['-fopenmp']),
+    ])
+
 # -- run setup ----------------------------------------------------------------
 
 packagenames = find_packages()
@@ -105,6 +122,7 @@ setup(name=DISTNAME,
       author_email=AUTHOR_EMAIL,
       license=LICENSE,
       packages=packagenames,
+      ext_modules=ext_modules,
       include_package_data=True,
       cmdclass=cmdclass,
       scripts=scripts,
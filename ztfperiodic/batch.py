@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ragged batches of lightcurves.
+
+A LightcurveBatch holds the times, magnitudes and magnitude errors of many
+lightcurves concatenated into three arrays, with offsets[ii]:offsets[ii+1]
+the epochs of lightcurve ii. Per-lightcurve operations (sorting,
+referencing to the first epoch, normalization) are done on the whole batch
+at once with np.lexsort and ufunc.reduceat, and single lightcurves are
+handed out as views of the concatenated arrays.
+"""
+
+import numpy as np
+
+
+class LightcurveBatch(object):
+    """
+    Ragged batch of lightcurves.
+
+    **Parameters**
+
+    t, y, dy : array-like, shape = [n_samples]
+        Concatenated times, magnitudes and magnitude errors.
+    offsets : array-like, shape = [n_lightcurves + 1]
+        Start index of each lightcurve, followed by n_samples.
+    """
+
+    def __init__(self, t, y, dy, offsets):
+        self.t = np.asarray(t)
+        self.y = np.asarray(y)
+        self.dy = np.asarray(dy)
+        self.offsets = np.asarray(offsets, dtype=np.intp)
+
+        self.lengths = np.diff(self.offsets)
+        self.segments = np.repeat(np.arange(len(self.lengths)), self.lengths)
+
+    @classmethod
+    def from_lightcurves(cls, lightcurves, dtype=float):
+        """Returns the batch of the (t, y, dy) tuples *lightcurves*"""
+        offsets = np.append(0, np.cumsum([len(lightcurve[0])
+                                          for lightcurve in lightcurves]))
+        if len(lightcurves) == 0:
+            empty = np.empty((0,), dtype=dtype)
+            return cls(empty, empty, empty, offsets)
+
+        t, y, dy = [np.concatenate([np.asarray(lightcurve[ii], dtype=dtype)
+                                    for lightcurve in lightcurves])
+                    for ii in range(3)]
+        return cls(t, y, dy, offsets)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, ii):
+        start, stop = self.offsets[ii], self.offsets[ii+1]
+        return (self.t[start:stop], self.y[start:stop], self.dy[start:stop])
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self[ii]
+
+    @property
+    def maxn(self):
+        """Maximum number of epochs of a lightcurve"""
+        if len(self) == 0:
+            return 0
+        return int(np.max(self.lengths))
+
+    def reduce(self, ufunc, values, empty=np.nan):
+        """Returns ufunc.reduceat of *values* over each lightcurve, and
+        *empty* for the lightcurves without epochs"""
+        out = np.full(len(self), empty, dtype=np.result_type(values, empty))
+        nonempty = self.lengths > 0
+        if np.any(nonempty):
+            out[nonempty] = ufunc.reduceat(values,
+                                           self.offsets[:-1][nonempty])
+        return out
+
+    def split(self, values):
+        """Returns *values*, concatenated like the batch, as a list of
+        per-lightcurve views"""
+        return np.split(values, self.offsets[1:-1])
+
+    def sorted(self):
+        """Returns the batch with each lightcurve sorted in time"""
+        if len(self.t) < 2:
+            return self
+        unsorted = (np.diff(self.t) < 0) & (np.diff(self.segments) == 0)
+        if not np.any(unsorted):
+            return self
+
+        # a single argsort of the lightcurve index plus the time scaled to
+        # [0, 0.5] is much faster than np.lexsort((t, segments))
+        tmin = self.tmin()
+        span = self.reduce(np.maximum, self.t) - tmin
+        span[~(span > 0)] = 1.0
+        key = self.segments + 0.5*((self.t - tmin[self.segments]) /
+                                   span[self.segments])
+        order = np.argsort(key)
+        return LightcurveBatch(self.t[order], self.y[order], self.dy[order],
+                               self.offsets)
+
+    def sort_values(self, values, chunk_size=1000):
+        """Returns *values*, concatenated like the batch, sorted within each
+        lightcurve; chunk_size lightcurves at a time are sorted as the rows
+        of a NaN-padded array, which is much faster than sorting the
+        concatenation by (lightcurve, value)"""
+        values = np.asarray(values, dtype=float)
+        out = np.empty_like(values)
+        column = np.arange(len(values)) - self.offsets[:-1][self.segments]
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            lo, hi = self.offsets[start], self.offsets[stop]
+            if hi == lo:
+                continue
+            rows = self.segments[lo:hi] - start
+            padded = np.full((stop - start, np.max(self.lengths[start:stop])),
+                             np.nan)
+            padded[rows, column[lo:hi]] = values[lo:hi]
+            padded.sort(axis=1)
+            out[lo:hi] = padded[rows, column[lo:hi]]
+        return out
+
+    def percentile(self, values, q, presorted=False):
+        """Returns the percentiles *q* of *values* within each lightcurve,
+        shape [n_lightcurves, len(q)], with the linear interpolation of
+        np.percentile; a single sort is shared by all the percentiles"""
+        if not presorted:
+            values = self.sort_values(values)
+        q = np.atleast_1d(np.asarray(q, dtype=float))
+
+        lengths = self.lengths[:, np.newaxis]
+        pos = q/100.0 * np.maximum(lengths - 1, 0)
+        lo = np.floor(pos).astype(np.intp)
+        hi = np.minimum(lo + 1, np.maximum(lengths - 1, 0))
+        frac = pos - lo
+
+        out = np.full((len(self), len(q)), np.nan)
+        nonempty = self.lengths > 0
+        start = self.offsets[:-1][nonempty, np.newaxis]
+        below = values[start + lo[nonempty]]
+        above = values[start + hi[nonempty]]
+        out[nonempty] = below + (above - below)*frac[nonempty]
+        return out
+
+    def tmin(self):
+        return self.reduce(np.minimum, self.t)
+
+    def zero_pointed(self):
+        """Returns the batch with each lightcurve referenced to its first
+        epoch"""
+        t = self.t - self.tmin()[self.segments]
+        return LightcurveBatch(t, self.y, self.dy, self.offsets)
+
+    def normalized_mag(self):
+        """Returns the magnitudes min-max normalized to [0, 1] within each
+        lightcurve, as normalize_mag"""
+        ymin = self.reduce(np.minimum, self.y)[self.segments]
+        ymax = self.reduce(np.maximum, self.y)[self.segments]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (self.y - ymin)/(ymax - ymin)
+
+    def rows(self, ncols=3):
+        """Returns the lightcurves as a list of [n_epochs, ncols] views of
+        one array with the columns t, y (and dy)"""
+        data = np.column_stack((self.t, self.y, self.dy)[:ncols])
+        return self.split(data)
+
+    def padded(self, fill_err=np.inf):
+        """Returns the times, magnitudes and errors as [n_lightcurves, maxn]
+        arrays; the padding has zero time and magnitude and *fill_err*
+        errors (infinite errors carry no weight in weighted fits)"""
+        t = np.zeros((len(self), self.maxn), dtype=self.t.dtype)
+        y = np.zeros((len(self), self.maxn), dtype=self.y.dtype)
+        dy = np.full((len(self), self.maxn), fill_err, dtype=float)
+
+        column = np.arange(len(self.t)) - self.offsets[:-1][self.segments]
+        t[self.segments, column] = self.t
+        y[self.segments, column] = self.y
+        dy[self.segments, column] = self.dy
+        return t, y, dy
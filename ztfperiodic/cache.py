@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of period-search results.
+
+Each entry is a small .npz file named by the SHA-1 hash of its key, so that
+entries can be written and read by concurrent jobs sharing the directory:
+entries are written to a temporary file and renamed into place, and
+eviction of the least recently used entries (by modification time, which
+is refreshed on every hit) is serialized with an exclusive lock on
+<cachedir>/.lock. Each writer evicts as soon as the size of the cache, as
+last scanned plus what it has written since, exceeds max_size.
+"""
+
+import os
+import fcntl
+import hashlib
+import tempfile
+import zipfile
+
+import numpy as np
+
+
+class ResultCache(object):
+    """
+    Size-bounded LRU cache of dictionaries of arrays in *cachedir*.
+
+    **Parameters**
+
+    cachedir : str
+        Cache directory, created if needed.
+    max_size : float, optional
+        Maximum total size of the entries in bytes (default 10 GB).
+    evict_every : int, optional
+        Maximum number of entries written between two evictions, which
+        bounds what concurrent writers add unseen (default 1000).
+    """
+
+    def __init__(self, cachedir, max_size=10e9, evict_every=1000):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        self.evict_every = evict_every
+        self.nwritten = 0
+        # size of the cache at the last eviction plus the entries written
+        # since; None until the directory has been scanned
+        self.size = None
+        self.hits, self.misses = 0, 0
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        """Returns the hash of *parts*, arrays (by dtype, shape and
+        content) or anything with a deterministic str"""
+        h = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                part = np.ascontiguousarray(part)
+                h.update(str((part.dtype.str, part.shape)).encode())
+                h.update(part.tobytes())
+            else:
+                h.update(str(part).encode())
+            h.update(b"|")
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key[:2], "%s.npz" % key)
+
+    def get(self, key):
+        """Returns the entry of *key*, or None if it is not cached"""
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                values = {name: data[name] for name in data.files}
+            os.utime(path)
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return values
+
+    def put(self, key, values):
+        """Stores the dictionary of arrays *values* under *key*"""
+        path = self.path(key)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+
+        fd, tmpname = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fid:
+                np.savez(fid, **values)
+            size = os.path.getsize(tmpname)
+            os.replace(tmpname, path)
+        except OSError:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+        self.nwritten += 1
+        if self.size is not None:
+            self.size += size
+        if (self.size is None or self.size > self.max_size or
+                self.nwritten % self.evict_every == 0):
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in
+        max_size"""
+        with open(os.path.join(self.cachedir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = []
+                for folder in os.scandir(self.cachedir):
+                    if not folder.is_dir():
+                        continue
+                    for entry in os.scandir(folder.path):
+                        if not entry.name.endswith(".npz"):
+                            continue
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size,
+                                        entry.path))
+
+                total = np.sum([entry[1] for entry in entries])
+                for mtime, size, path in sorted(entries):
+                    if total <= self.max_size:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+                self.size = total
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
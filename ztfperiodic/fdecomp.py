@@ -1,10 +1,10 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
-import scipy.optimize
-from scipy.optimize import curve_fit
 import copy
 
+from ztfperiodic.lcstats import fourier_lstsq
+
 
 def AB2AmpPhi(arr):
     """ convert an array of fourier components (A,B) to amp,phase and normalise
@@ -84,26 +84,10 @@ def fit_best(LC,p,maxNterms=5,output='compact',plotname=False):
     
     # 
     f = make_f(p=p)
-    chi2 = np.zeros(maxNterms+1,dtype=float) # fill in later
-    Fstats = np.zeros(maxNterms+1,dtype=float) # fill in later
-    pars = np.zeros((maxNterms+1,(maxNterms+1)*2)) # fill in later
 
-    
-    init = [16.0,0.001] # the initial values for the minimiser
-    for i,Nterms in enumerate(np.arange(maxNterms+1.,dtype=int)):
-        # fit using scipy curvefit
-        popt, pcov = curve_fit(make_f(p), # function
-            t, y, # t,dy
-            init, # initial values [1.0]*2
-            sigma=dy # dy
-            )
-
-        init = init + [0.05]*2
-
-        pars[i,:2*(i+1)] = popt
-        # make the model
-        model = f(t, *popt)
-        chi2[i] = np.sum(((y-model)/dy)**2)
+    # linear least squares fits of all orders from one QR factorization
+    chi2, pars, _ = fourier_lstsq(t,y,dy,p,maxNterms=maxNterms)
+    chi2, pars = chi2[0], pars[0]
 
     # calc BICs
     BIC = chi2 + np.log(N)* (2+2*np.arange(maxNterms+1,dtype=float))
@@ -145,13 +129,10 @@ def fit(LC,p,Nterms=3,output='compact',plotname=False):
     dy = LC[:,2]
     N = np.size(t)
 
-    # fit using scipy curvefit
+    # fit by linear least squares
     f = make_f(p=p)
-    popt, pcov = curve_fit(f, # function
-        t, y, # t,dy
-        [1.0] * (2+2*Nterms), # initial values
-        sigma=dy # dy
-        )
+    _, pars, _ = fourier_lstsq(t,y,dy,p,maxNterms=Nterms)
+    popt = pars[0,-1]
 
     model = f(t, *popt)
 
@@ -165,7 +146,7 @@ def fit(LC,p,Nterms=3,output='compact',plotname=False):
 
     if output == 'compact':
         # convert to amplitude and phase
-        bestpars[2:2+2*Nterms] = AB2AmpPhi(bestpars[2:2+2*Nterms])
+        popt[2:2+2*Nterms] = AB2AmpPhi(popt[2:2+2*Nterms])
 
     return np.r_[power,BIC,popt]
 
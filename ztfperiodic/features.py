@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Registry of lightcurve features.
+
+Each feature (or intermediate result, such as the sorted magnitudes or the
+weighted mean) is registered with the names of the features it is computed
+from. calc_features computes the requested features of a LightcurveBatch,
+and only the features they depend on, each of them once: the median,
+the interquantile ranges and the median absolute deviation share one sort
+of the magnitudes, and all the Fourier features share one decomposition.
+
+The feature names are those of utils.get_featuresetnames; the features of
+a set that are not computed from the lightcurve (cross-matches, alerts)
+are not registered.
+"""
+
+import numpy as np
+
+from ztfperiodic.lcstats import calc_anderson_batch, calc_shapiro_batch
+from ztfperiodic.lcstats import fourier_decomposition_batch
+from ztfperiodic.lcstats import calc_dmdt_batch
+
+FEATURES = {}
+
+# columns of calc_basic_stats and calc_fourier_stats
+BASIC_FEATURES = ['n', 'median', 'wmean', 'chi2red', 'roms', 'wstd',
+                  'norm_peak_to_peak_amp', 'norm_excess_var',
+                  'median_abs_dev', 'iqr', 'f60', 'f70', 'f80', 'f90',
+                  'skew', 'smallkurt', 'inv_vonneumannratio', 'welch_i',
+                  'stetson_j', 'stetson_k', 'ad', 'sw']
+FOURIER_FEATURES = ['f1_power', 'f1_bic', 'f1_a', 'f1_b', 'f1_amp',
+                    'f1_phi0', 'f1_relamp1', 'f1_relphi1', 'f1_relamp2',
+                    'f1_relphi2', 'f1_relamp3', 'f1_relphi3', 'f1_relamp4',
+                    'f1_relphi5']
+
+PERCENTILES = [50, 5, 10, 15, 20, 25, 75, 80, 85, 90, 95]
+
+
+def register_feature(name, *requires):
+    """Decorator adding a feature, computed from the features *requires*,
+    to FEATURES"""
+    def register(func):
+        FEATURES[name] = (func, requires)
+        return func
+    return register
+
+
+def calc_features(batch, names, **inputs):
+    """ Computes the features *names* of the lightcurves of *batch*
+
+    Parameters
+    ----------
+    batch : LightcurveBatch
+        lightcurves
+    names : list of str
+        features to compute
+    **inputs : arrays, shape = [nlc]
+        features that are not computed from the lightcurves, such as the
+        period (required by the Fourier features)
+
+    Returns
+    -------
+    features : dict
+        the [nlc] array of each feature of *names*
+    """
+
+    values = dict(inputs)
+    values["batch"] = batch
+
+    def get(name):
+        if not name in values:
+            if not name in FEATURES:
+                raise ValueError("feature %s not available" % name)
+            func, requires = FEATURES[name]
+            values[name] = func(*[get(require) for require in requires])
+        return values[name]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {name: get(name) for name in names}
+
+
+def calc_feature_columns(batch, columns, names=None, **inputs):
+    """ Returns the features *columns* of the lightcurves of *batch* as an
+    array of shape [nlc, len(columns)]; if *names* is given, only the
+    columns in *names* are computed and the others are NaN
+    """
+
+    if names is None:
+        names = columns
+    wanted = [name for name in columns if name in names]
+    features = calc_features(batch, wanted, **inputs)
+
+    out = np.full((len(batch), len(columns)), np.nan)
+    for ii, name in enumerate(columns):
+        if name in features:
+            out[:, ii] = features[name]
+    return out
+
+
+# intermediate results
+
+@register_feature("mag", "batch")
+def calc_mag(batch):
+    return np.asarray(batch.y, dtype=float)
+
+
+@register_feature("err", "batch")
+def calc_err(batch):
+    return np.asarray(batch.dy, dtype=float)
+
+
+@register_feature("mag_sorted", "batch", "mag")
+def calc_mag_sorted(batch, mag):
+    return batch.sort_values(mag)
+
+
+@register_feature("percentiles", "batch", "mag_sorted")
+def calc_percentiles(batch, mag_sorted):
+    return batch.percentile(mag_sorted, PERCENTILES, presorted=True)
+
+
+@register_feature("weights", "err")
+def calc_weights(err):
+    return err**-2
+
+
+@register_feature("residuals", "batch", "mag", "wmean")
+def calc_residuals(batch, mag, wmean):
+    return mag - wmean[batch.segments]
+
+
+@register_feature("normalized_residuals", "residuals", "err")
+def calc_normalized_residuals(residuals, err):
+    return residuals/err
+
+
+@register_feature("pairs", "batch")
+def calc_pairs(batch):
+    """Consecutive pairs of samples within a lightcurve: the mask of the
+    pairs (of sample ii and ii+1) and their lightcurve"""
+    pair = batch.segments[:-1] == batch.segments[1:]
+    return pair, batch.segments[:-1][pair]
+
+
+def sum_pairs(batch, pairs, values):
+    """Sums *values*, defined for each pair of consecutive samples of the
+    batch, over the pairs within each lightcurve"""
+    pair, pairseg = pairs
+    return np.bincount(pairseg, weights=values[pair], minlength=len(batch))
+
+
+@register_feature("stetson_d", "batch", "n", "normalized_residuals")
+def calc_stetson_d(batch, n, normalized_residuals):
+    return np.sqrt(1.*n/(n-1))[batch.segments]*normalized_residuals
+
+
+@register_feature("stetson_p", "stetson_d")
+def calc_stetson_p(stetson_d):
+    return stetson_d[:-1]*stetson_d[1:]
+
+
+@register_feature("fourier", "batch", "period")
+def calc_fourier(batch, period):
+    t, mag, err = batch.padded()
+    return fourier_decomposition_batch(t, mag, err, period)
+
+
+# basic stats
+
+@register_feature("n", "batch")
+def calc_n(batch):
+    return batch.lengths.astype(float)
+
+
+@register_feature("median", "percentiles")
+def calc_median(percentiles):
+    return percentiles[:, 0]
+
+
+@register_feature("wmean", "batch", "mag", "weights")
+def calc_wmean(batch, mag, weights):
+    return batch.reduce(np.add, weights*mag)/batch.reduce(np.add, weights)
+
+
+@register_feature("wstd", "batch", "residuals", "weights")
+def calc_wstd(batch, residuals, weights):
+    return np.sqrt(batch.reduce(np.add, weights*residuals**2) /
+                   batch.reduce(np.add, weights))
+
+
+@register_feature("chi2red", "batch", "n", "residuals", "weights")
+def calc_chi2red(batch, n, residuals, weights):
+    return batch.reduce(np.add, residuals**2*weights)/(n-1)
+
+
+@register_feature("roms", "batch", "n", "mag", "err", "median")
+def calc_roms(batch, n, mag, err, median):
+    return batch.reduce(np.add,
+                        np.abs(mag-median[batch.segments])/err)/(n-1)
+
+
+@register_feature("norm_peak_to_peak_amp", "batch", "mag", "err")
+def calc_norm_peak_to_peak_amp(batch, mag, err):
+    peak = batch.reduce(np.maximum, mag-err)
+    trough = batch.reduce(np.minimum, mag+err)
+    return (peak-trough)/(peak+trough)
+
+
+@register_feature("norm_excess_var", "batch", "n", "residuals", "err",
+                  "wmean")
+def calc_norm_excess_var(batch, n, residuals, err, wmean):
+    return batch.reduce(np.add, residuals**2-err**2)/(n*wmean**2)
+
+
+@register_feature("median_abs_dev", "batch", "mag", "median")
+def calc_median_abs_dev(batch, mag, median):
+    return batch.percentile(np.abs(mag-median[batch.segments]), 50)[:, 0]
+
+
+def register_interquantile_range(name, lower, upper):
+    register_feature(name, "percentiles")(
+        lambda percentiles: (percentiles[:, PERCENTILES.index(upper)] -
+                             percentiles[:, PERCENTILES.index(lower)]))
+
+
+register_interquantile_range("iqr", 25, 75)
+register_interquantile_range("f60", 20, 80)
+register_interquantile_range("f70", 15, 85)
+register_interquantile_range("f80", 10, 90)
+register_interquantile_range("f90", 5, 95)
+
+
+@register_feature("skew", "batch", "n", "normalized_residuals")
+def calc_skew(batch, n, normalized_residuals):
+    return 1.*n/(n-1)/(n-2) * batch.reduce(np.add, normalized_residuals**3)
+
+
+@register_feature("smallkurt", "batch", "n", "normalized_residuals")
+def calc_smallkurt(batch, n, normalized_residuals):
+    smallkurt = 1.*n*(n+1)/(n-1)/(n-2)/(n-3)
+    smallkurt *= batch.reduce(np.add, normalized_residuals**4)
+    smallkurt -= 3*(n-1)**2/(n-2)/(n-3)
+    return smallkurt
+
+
+@register_feature("inv_vonneumannratio", "batch", "pairs", "mag", "wstd")
+def calc_inv_vonneumannratio(batch, pairs, mag, wstd):
+    w = np.diff(batch.t)**-2
+    eta = sum_pairs(batch, pairs, w*np.diff(mag)**2)
+    eta /= sum_pairs(batch, pairs, w)*wstd**2
+    return eta**-1
+
+
+@register_feature("welch_i", "batch", "pairs", "stetson_p")
+def calc_welch_i(batch, pairs, stetson_p):
+    return sum_pairs(batch, pairs, stetson_p)
+
+
+@register_feature("stetson_j", "batch", "pairs", "stetson_p")
+def calc_stetson_j(batch, pairs, stetson_p):
+    return sum_pairs(batch, pairs,
+                     np.sign(stetson_p)*np.sqrt(np.abs(stetson_p)))
+
+
+@register_feature("stetson_k", "batch", "n", "stetson_d")
+def calc_stetson_k(batch, n, stetson_d):
+    K = batch.reduce(np.add, np.abs(stetson_d))/n
+    K /= np.sqrt(1./n*batch.reduce(np.add, stetson_d**2))
+    return K
+
+
+@register_feature("ad", "batch", "mag", "err")
+def calc_ad(batch, mag, err):
+    return calc_anderson_batch(batch, mag/err)
+
+
+@register_feature("sw", "batch", "mag", "err")
+def calc_sw(batch, mag, err):
+    return calc_shapiro_batch(batch, mag/err)
+
+
+# fourier stats
+
+def register_fourier_feature(name, column):
+    register_feature(name, "fourier")(lambda fourier: fourier[:, column])
+
+
+for column, name in enumerate(FOURIER_FEATURES):
+    register_fourier_feature(name, column)
+
+
+# dmdt image
+
+@register_feature("dmdt", "batch")
+def calc_dmdt(batch):
+    return calc_dmdt_batch(batch.sorted())
@@ -9,8 +9,18 @@
 import numpy as np
 import copy
 from scipy.stats import anderson, shapiro
+from scipy.special import ndtri, log_ndtr, binom
 import scipy.optimize
-from scipy.optimize import curve_fit
+
+from ztfperiodic.batch import LightcurveBatch
+
+# magnitude and time difference bin edges of the dmdt images of the ZTF
+# source features (v20200318), 26x26 bins
+DMINTS = [-8, -5, -3, -2.5, -2, -1.5, -1.25, -0.75, -0.5, -0.3, -0.2, -0.1,
+          -0.05, 0, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.25, 1.5, 2, 2.5, 3, 5, 8]
+DTINTS = [0.0, 1.0/145, 2.0/145, 3.0/145, 4.0/145, 1.0/25, 2.0/25, 3.0/25,
+          1.5, 2.5, 3.5, 4.5, 5.5, 7, 10, 20, 30, 60, 90, 120, 240, 600, 960,
+          2000, 4000, 6000, 8000]
 
 
 def calc_weighted_mean_std(mag,w):
@@ -97,43 +107,180 @@ def calc_NormPeaktoPeakamp(mag,err):
 
 
 
-def fourier_decomposition(t,y,dy,p,maxNterms=5,relative_output=True):
+def fourier_design_matrix(t,p,Nterms,tmin=None):
+    """ Design matrix of the fourier model of make_f: offset, slope and
+    Nterms harmonics of the period p
+
+    Parameters
+    ----------
+    t : array, shape = [..., N]
+        times
+    p : float or array, shape = [...]
+        periods
+    Nterms : int
+        number of harmonics
+    tmin : float or array, shape = [...], optional
+        reference time of the slope, default the minimum of t
+
+    Returns
+    -------
+    X : array, shape = [..., N, 2+2*Nterms]
+        columns [1, t-tmin, cos(phi), sin(phi), cos(2phi), ...]
+    """
 
-    N = np.size(y)
+    t = np.asarray(t,dtype=float)
+    p = np.asarray(p,dtype=float)[...,np.newaxis]
+    if tmin is None:
+        tmin = np.min(t,axis=-1)
+    tmin = np.asarray(tmin,dtype=float)[...,np.newaxis]
 
-    f = make_f(p=p)
-    chi2 = np.zeros(maxNterms+1,dtype=float) # fill in later
-    pars = np.zeros((maxNterms+2,(maxNterms+1)*2)) # fill in later
+    phi = 2*np.pi*t/p
+    n = np.arange(1,Nterms+1)
+    nphi = phi[...,np.newaxis]*n
 
-    
-    init = np.array([np.median(y),0.000001]) # the initial values for the minimiser
-    #print(t,y,dy,init)
-    for i,Nterms in enumerate(np.arange(maxNterms+1.,dtype=int)):
-        popt, pcov = curve_fit(make_f(p), # function
-            t, y, # t,dy
-            init, # initial values [1.0]*2
-            sigma=dy # dy
-            )
-
-        init = np.r_[init,0.1*np.ones(2)]
-
-        pars[i,:2*(i+1)] = popt
-        # make the model
-        model = f(t, *popt)
-        chi2[i] = np.sum(((y-model)/dy)**2)
+    X = np.empty(t.shape + (2+2*Nterms,))
+    X[...,0] = 1.0
+    X[...,1] = t-tmin
+    X[...,2::2] = np.cos(nphi)
+    X[...,3::2] = np.sin(nphi)
+    return X
+
+
+
+def fourier_lstsq(t,y,dy,p,maxNterms=5):
+    """ Weighted linear least squares fits of the fourier models with 0 to
+    maxNterms harmonics
+
+    The model of make_f is linear in its parameters at fixed period, so the
+    weighted design matrix of the highest order is QR factorized once; the
+    fit with the first m columns is the solution of R[:m,:m] c = (Q^T y)[:m]
+    and its chi2 is the residual of the full fit plus the sum of the
+    squares of (Q^T y)[m:]. Works on a batch of lightcurves stacked along
+    the first axis; samples with an infinite (or zero weight) error are
+    ignored, so lightcurves of different lengths can be padded.
+
+    Parameters
+    ----------
+    t, y, dy : array, shape = [N] or [nlc, N]
+        times, magnitudes and errors
+    p : float or array, shape = [nlc]
+        periods
+    maxNterms : int
+        highest number of harmonics
+
+    Returns
+    -------
+    chi2 : array, shape = [nlc, maxNterms+1]
+        chi2 of each order; NaN if the fit is not determined
+    pars : array, shape = [nlc, maxNterms+1, 2+2*maxNterms]
+        parameters [offset, slope, a_1, b_1, ...] of each order, zero padded
+    N : array, shape = [nlc]
+        number of samples used
+    """
+
+    t = np.atleast_2d(np.asarray(t,dtype=float))
+    y = np.atleast_2d(np.asarray(y,dtype=float))
+    dy = np.atleast_2d(np.asarray(dy,dtype=float))
+    p = np.atleast_1d(np.asarray(p,dtype=float))
+    nlc = t.shape[0]
+    npars = 2+2*maxNterms
+
+    w = 1.0/dy
+    used = np.isfinite(y) & np.isfinite(t) & (w > 0)
+    w = np.where(used,w,0.0)
+    N = np.sum(used,axis=1)
+    t = np.where(used,t,np.inf)
+    tmin = np.min(t,axis=1,initial=np.inf)
+    tmin[N == 0] = 0.0
+    t = np.where(used,t,tmin[:,np.newaxis])
+    y = np.where(used,y,0.0)
+
+    X = fourier_design_matrix(t,p,maxNterms,tmin=tmin) * w[...,np.newaxis]
+    yw = y*w
+
+    Q, R = np.linalg.qr(X)
+    qty = np.einsum('lnm,ln->lm',Q,yw)
+    chi2_full = np.sum((yw - np.einsum('lnm,lm->ln',Q,qty))**2,axis=1)
+    chi2 = chi2_full[:,np.newaxis] + \
+        np.cumsum((qty**2)[:,::-1],axis=1)[:,::-1][:,2::2]
+    chi2 = np.hstack((chi2,chi2_full[:,np.newaxis]))
+
+    # the fit is not determined with fewer samples than parameters, or
+    # with (numerically) dependent columns
+    diag = np.abs(np.diagonal(R,axis1=1,axis2=2))
+    bad = (N < npars) | ~np.all(diag > 1e-10*np.max(diag,axis=1,initial=0.0)[:,np.newaxis],axis=1)
+    R[bad] = np.eye(npars)
+
+    pars = np.zeros((nlc,maxNterms+1,npars))
+    for k in range(maxNterms+1):
+        m = 2+2*k
+        pars[:,k,:m] = np.linalg.solve(R[:,:m,:m],qty[:,:m,np.newaxis])[...,0]
+
+    chi2[bad] = np.nan
+    pars[bad] = np.nan
+
+    return chi2, pars, N
+
+
+
+def fourier_decomposition_batch(t,y,dy,p,maxNterms=5,relative_output=True):
+    """ Fourier decomposition of a batch of lightcurves, the order chosen
+    by BIC; see fourier_lstsq for the inputs and fourier_decomposition for
+    the outputs
+
+    Returns
+    -------
+    out : array, shape = [nlc, 4+2*maxNterms]
+        [power, BIC, offset, slope, ...] per lightcurve; NaN where the fit
+        failed
+    """
+
+    chi2, pars, N = fourier_lstsq(t,y,dy,p,maxNterms=maxNterms)
+    nlc = chi2.shape[0]
 
     # calc BICs
-    BIC = chi2 + np.log(N)* (2+2*np.arange(maxNterms+1,dtype=float))
-    best = np.argmin(BIC)
-    
-    power = (chi2[0]-chi2[best])/chi2[0]
-    bestBIC = BIC[best]
-    bestpars = pars[best,:]
+    with np.errstate(divide='ignore'):
+        BIC = chi2 + np.log(N)[:,np.newaxis] * (2+2*np.arange(maxNterms+1,dtype=float))
+    failed = np.any(np.isnan(BIC),axis=1)
+    best = np.argmin(np.where(np.isnan(BIC),np.inf,BIC),axis=1)
+    rows = np.arange(nlc)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        power = (chi2[:,0]-chi2[rows,best])/chi2[:,0]
+    bestBIC = BIC[rows,best]
+    bestpars = pars[rows,best,:]
 
     if relative_output:
-        bestpars[2:] = AB2AmpPhi(bestpars[2:])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bestpars[:,2:] = AB2AmpPhi(bestpars[:,2:])
 
-    return np.r_[power,bestBIC,bestpars]
+    out = np.c_[power,bestBIC,bestpars]
+    out[failed] = np.nan
+    return out
+
+
+
+def fourier_decomposition(t,y,dy,p,maxNterms=5,relative_output=True):
+    """ Fourier decomposition of a lightcurve at period p: the fourier models
+    with 0 to maxNterms harmonics (plus offset and slope) are fitted by
+    linear least squares and the order with the lowest BIC is kept
+
+    Returns
+    -------
+    out : array
+        [power, BIC, offset, slope, a_1, b_1, ...], with the harmonics as
+        relative amplitudes and phases if relative_output
+
+    Raises
+    ------
+    ValueError if the fit is not determined
+    """
+
+    out = fourier_decomposition_batch(t,y,dy,p,maxNterms=maxNterms,
+                                      relative_output=relative_output)[0]
+    if np.all(np.isnan(out)):
+        raise ValueError("Fourier decomposition failed")
+    return out
 
 
 
@@ -141,30 +288,29 @@ def AB2AmpPhi(input_arr):
     """ convert an array of fourier components (A,B) to amp,phase and normalise
 
     input:
-        arr : array of fourier components, A&B
+        arr : array of fourier components, A&B, along the last axis
     
     output:
         arr : array of fourier amplitudes and phases. The phase differences are 
                 normalised between 0 and 1.
     """
 
-    arr = copy.deepcopy(input_arr)
+    arr = np.array(input_arr,dtype=float)
 
     # convert A,B to amp and phi
-    for n in np.arange(0,np.size(arr),2):
-        amp = np.sqrt(arr[n]**2 + arr[n+1]**2)
-        phi = np.arctan2(arr[n],arr[n+1])
-        arr[n] = amp
-        arr[n+1] = phi
+    amp = np.sqrt(arr[...,0::2]**2 + arr[...,1::2]**2)
+    phi = np.arctan2(arr[...,0::2],arr[...,1::2])
+    arr[...,0::2] = amp
+    arr[...,1::2] = phi
 
     # normalise
-    arr[2::2] /= arr[0] # normalise amplitudes
+    arr[...,2::2] /= arr[...,0:1] # normalise amplitudes
 
     # report phase shift
 
-    maxk = int(np.size(input_arr)/2)
+    maxk = int(np.shape(input_arr)[-1]/2)
     for k in range(2,maxk+1,1):
-        arr[k*2-1] = (arr[k*2-1]/k-arr[1])/(2.*np.pi/k)%1
+        arr[...,k*2-1] = (arr[...,k*2-1]/k-arr[...,1])/(2.*np.pi/k)%1
 
     return arr
 
@@ -239,6 +385,119 @@ def calc_basic_stats(t,mag,err):
 
 
 
+def calc_anderson_batch(batch,x):
+    """ Anderson-Darling statistic for normality of *x* within each
+    lightcurve of *batch*, as scipy.stats.anderson(x)[0]
+    """
+
+    N = batch.lengths
+    seg = batch.segments
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xbar = batch.reduce(np.add,x)/N
+        s = np.sqrt(batch.reduce(np.add,(x-xbar[seg])**2)/(N-1))
+        w = (batch.sort_values(x)-xbar[seg])/s[seg]
+
+    # rank of each sorted sample, and the sample of the reversed order
+    start = batch.offsets[:-1][seg]
+    rank = np.arange(len(x)) - start
+    reverse = start + N[seg]-1 - rank
+
+    terms = (2*(rank+1)-1.0)/N[seg] * (log_ndtr(w) + log_ndtr(-w[reverse]))
+    return -N - np.bincount(seg,weights=terms,minlength=len(batch))
+
+
+
+def calc_shapiro_batch(batch,x):
+    """ Shapiro-Wilk W statistic of *x* within each lightcurve of *batch*,
+    as scipy.stats.shapiro(x)[0] (algorithm AS R94, Royston 1995); NaN for
+    lightcurves with fewer than 3 samples
+    """
+
+    c1 = [0.0, 0.221157, -0.147981, -2.071190, 4.434685, -2.706056]
+    c2 = [0.0, 0.042981, -0.293762, -1.752461, 5.682633, -3.582633]
+
+    N = batch.lengths
+    nlc = len(batch)
+    seg = batch.segments
+    n = N[seg].astype(float)
+    start = batch.offsets[:-1][seg]
+    rank = np.arange(len(x)) - start
+    half = np.minimum(rank, N[seg]-1-rank)
+
+    # expected normal order statistics of the lower half
+    m = ndtri((half+1-0.375)/(n+0.25))
+    lower = rank < N[seg]-1-rank
+    summ2 = 2*np.bincount(seg,weights=np.where(lower,m**2,0.0),minlength=nlc)
+    m1 = np.full(nlc,np.nan)
+    m2 = np.full(nlc,np.nan)
+    m1[seg[lower & (half == 0)]] = m[lower & (half == 0)]
+    m2[seg[lower & (half == 1)]] = m[lower & (half == 1)]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rsn = 1.0/np.sqrt(N)
+        ssumm2 = np.sqrt(summ2)
+        a1 = np.polyval(c1[::-1],rsn) - m1/ssumm2
+        a2 = np.polyval(c2[::-1],rsn) - m2/ssumm2
+        fac = np.where(N > 5,
+                       np.sqrt((summ2-2*m1**2-2*m2**2)/(1-2*a1**2-2*a2**2)),
+                       np.sqrt((summ2-2*m1**2)/(1-2*a1**2)))
+
+        a = -m/fac[seg]
+        a = np.where(half == 0,a1[seg],a)
+        a = np.where((half == 1) & (n > 5),a2[seg],a)
+        a = np.where(n == 3,np.sqrt(0.5),a)
+        coef = np.where(lower,-a,np.where(rank > N[seg]-1-rank,a,0.0))
+
+        y = batch.sort_values(x)
+        ymid = batch.percentile(y,50,presorted=True)[:,0]
+        y = y - ymid[seg]
+        ymin = batch.reduce(np.minimum,y)
+        yrange = batch.reduce(np.maximum,y) - ymin
+        xs = y/yrange[seg]
+
+        sa = batch.reduce(np.add,coef)/N
+        sx = batch.reduce(np.add,xs)/N
+        asa = coef - sa[seg]
+        xsx = xs - sx[seg]
+        ssa = batch.reduce(np.add,asa**2)
+        ssx = batch.reduce(np.add,xsx**2)
+        sax = batch.reduce(np.add,asa*xsx)
+        ssassx = np.sqrt(ssa*ssx)
+        W = 1 - (ssassx-sax)*(ssassx+sax)/(ssa*ssx)
+
+    W[N < 3] = np.nan
+    return W
+
+
+
+def calc_basic_stats_batch(t,mag,err,offsets):
+    """ Basic statistics of a batch of lightcurves, as calc_basic_stats
+
+    The lightcurves are concatenated, and all statistics are segment-wise
+    reductions over the whole batch (see ztfperiodic.features).
+
+    Parameters
+    ----------
+    t, mag, err : array, shape = [n_samples]
+        concatenated times, magnitudes and errors
+    offsets : array, shape = [nlc+1]
+        start index of each lightcurve, followed by n_samples
+
+    Returns
+    -------
+    stats : array, shape = [nlc, 22]
+        the calc_basic_stats of each lightcurve
+    """
+
+    from ztfperiodic.features import BASIC_FEATURES, calc_feature_columns
+
+    batch = LightcurveBatch(t,mag,err,offsets)
+    return calc_feature_columns(batch,BASIC_FEATURES)
+
+
+
+
+
 def calc_stats(t,mag,err,p):
 
     # calculate basic stats
@@ -291,3 +550,397 @@ def calc_fourier_stats(t,mag,err,p):
     return np.r_[f1_power,f1_BIC,f1_a,f1_b,f1_amp,f1_phi0,
                  f1_relamp1,f1_relphi1,f1_relamp2,f1_relphi2,
                  f1_relamp3,f1_relphi3,f1_relamp4,f1_relphi5] 
+
+
+def calc_fourier_stats_batch(t,mag,err,p):
+    """ calc_fourier_stats of a batch of lightcurves stacked along the first
+    axis (padded with infinite errors if their lengths differ)
+
+    Returns
+    -------
+    stats : array, shape = [nlc, 14]
+        NaN rows where the fit failed
+    """
+
+    return fourier_decomposition_batch(t,mag,err,p)
+
+
+
+def digitize_edges(x,edges):
+    """ bin index of x in the bins of *edges*, as np.histogram (the last
+    bin includes its right edge); -1 or len(edges)-1 outside the bins
+    """
+
+    idx = np.searchsorted(edges,x,side='right')-1
+    idx[x == edges[-1]] = len(edges)-2
+    return idx
+
+
+
+def calc_dmdt_batch(batch,dmints=DMINTS,dtints=DTINTS,chunk_size=1000,
+                    max_pairs=10**7):
+    """ dmdt images of a batch of lightcurves: the 2D histograms of the
+    magnitude and time differences of all the pairs of epochs (later minus
+    earlier), normalized to unit L2 norm
+
+    The pairs are enumerated by lag (epoch ii with epoch ii+lag), for a
+    chunk of lightcurves and a block of lags at a time, so that at most
+    max_pairs pairs are held in memory whatever the lengths of the
+    lightcurves.
+
+    Parameters
+    ----------
+    batch : LightcurveBatch
+        lightcurves, sorted in time
+    dmints, dtints : list
+        bin edges of the magnitude and time differences
+    chunk_size : int
+        number of lightcurves histogrammed at a time
+    max_pairs : int
+        maximum number of pairs enumerated at a time
+
+    Returns
+    -------
+    dmdt : array, shape = [nlc, len(dmints)-1, len(dtints)-1]
+        dmdt images; zero for lightcurves with fewer than two epochs
+    """
+
+    dmints = np.asarray(dmints,dtype=float)
+    dtints = np.asarray(dtints,dtype=float)
+    ndm, ndt = len(dmints)-1, len(dtints)-1
+    nlc = len(batch)
+    t = np.asarray(batch.t,dtype=float)
+    mag = np.asarray(batch.y,dtype=float)
+
+    # number of later epochs of each epoch in its lightcurve
+    later = batch.offsets[1:][batch.segments]-1-np.arange(len(t))
+
+    dmdt = np.zeros((nlc,ndm*ndt))
+    for start in range(0,nlc,chunk_size):
+        stop = min(start+chunk_size,nlc)
+        lo, hi = batch.offsets[start], batch.offsets[stop]
+        counts = np.zeros((stop-start)*ndm*ndt)
+
+        active = np.arange(lo,hi)
+        lag = 1
+        while True:
+            active = active[later[active] >= lag]
+            if len(active) == 0:
+                break
+            nlags = max(1,min(int(max_pairs//len(active)),
+                              int(np.max(later[active]))-lag+1))
+            lags = lag+np.arange(nlags)
+            valid = lags[np.newaxis,:] <= later[active][:,np.newaxis]
+            ii = np.broadcast_to(active[:,np.newaxis],valid.shape)[valid]
+            jj = (active[:,np.newaxis]+lags[np.newaxis,:])[valid]
+
+            idm = digitize_edges(mag[jj]-mag[ii],dmints)
+            idt = digitize_edges(t[jj]-t[ii],dtints)
+            inside = (idm >= 0) & (idm < ndm) & (idt >= 0) & (idt < ndt)
+            flat = ((batch.segments[ii]-start)*ndm+idm)*ndt+idt
+            counts += np.bincount(flat[inside],minlength=len(counts))
+            lag += nlags
+
+        dmdt[start:stop] = counts.reshape(stop-start,-1)
+
+    norm = np.linalg.norm(dmdt,axis=1)
+    dmdt[norm > 0] /= norm[norm > 0][:,np.newaxis]
+    return dmdt.reshape(nlc,ndm,ndt)
+
+
+
+
+class OnlineStats(object):
+    """ Incremental basic statistics of a lightcurve to which epochs are
+    appended (in time order)
+
+    The state keeps sufficient statistics, so that update costs O(new
+    epochs): weighted Welford moments, power sums of the residuals
+    (relative to the first magnitude, to limit cancellations) for the skew
+    and kurtosis, sums over consecutive pairs for the von Neumann ratio and
+    the Welch/Stetson I, the extrema of mag-err and mag+err, and a merging
+    centroid sketch of the magnitudes (a t-digest, exact while there are
+    at most compression epochs) for the percentiles, the median absolute
+    deviation, RoMS and Stetson K. Stetson J, whose terms are not
+    polynomial in the weighted mean, is exact while there are at most
+    compression consecutive pairs, which are kept; beyond that, its terms
+    are summed for jknots trial means spanning 4 standard deviations on
+    each side of the weighted mean (of the epochs at that time), and
+    interpolated at the current weighted mean (extrapolated linearly
+    outside the trial means). For 600 epochs with a slow trend, appended
+    20 at a time after the first 200, it is within 0.6% of the sum of the
+    absolute values of its terms. The Anderson-Darling and
+    Shapiro-Wilk statistics, which require the whole lightcurve, are not
+    available.
+
+    Parameters
+    ----------
+    compression : int
+        compression of the magnitude sketch, which keeps O(compression)
+        centroids
+    """
+
+    scalar_names = ['n', 'ref', 'W', 'wmean', 'M2', 'sd1', 'sd2', 'se2',
+                    's3_0', 's3_1', 's3_2', 's3_3',
+                    's4_0', 's4_1', 's4_2', 's4_3', 's4_4',
+                    'p0', 'p1', 'p11', 'jstart', 'jstep', 'vw', 'vwdm',
+                    'peak', 'trough', 'last_t', 'last_d', 'last_e']
+    jknots = 65
+
+    def __init__(self, compression=200):
+        self.compression = compression
+        for name in self.scalar_names:
+            setattr(self, name, 0.0)
+        self.jsums = np.zeros(self.jknots)
+        self.ref, self.last_t = np.nan, np.nan
+        self.peak, self.trough = -np.inf, np.inf
+        self.centroids = np.empty((0,3))
+        self.pairs = np.empty((0,3))
+
+    @classmethod
+    def from_lightcurve(cls, t, mag, err, compression=200):
+        state = cls(compression=compression)
+        state.update(t, mag, err)
+        return state
+
+    def update(self, t, mag, err):
+        """ Appends the epochs t, mag, err, which must be later than the
+        epochs already in the state
+        """
+
+        t = np.asarray(t,dtype=float)
+        order = np.argsort(t,kind='stable')
+        t = t[order]
+        mag = np.asarray(mag,dtype=float)[order]
+        err = np.asarray(err,dtype=float)[order]
+        if len(t) == 0:
+            return
+        if t[0] < self.last_t:
+            raise ValueError("epochs must be appended in time order")
+
+        if self.n == 0:
+            self.ref = mag[0]
+        d = mag - self.ref
+
+        # weighted Welford moments, merged with those of the new epochs
+        w = err**-2
+        Wb = np.sum(w)
+        meanb = np.sum(w*d)/Wb + self.ref
+        M2b = np.sum(w*(mag-meanb)**2)
+        delta = meanb - self.wmean
+        W = self.W + Wb
+        self.wmean = meanb if self.W == 0 else self.wmean + delta*Wb/W
+        self.M2 += M2b + delta**2*self.W*Wb/W
+        self.W = W
+        self.n += len(t)
+
+        # power sums
+        self.sd1 += np.sum(d)
+        self.sd2 += np.sum(d**2)
+        self.se2 += np.sum(err**2)
+        for j in range(4):
+            setattr(self, 's3_%d' % j,
+                    getattr(self, 's3_%d' % j) + np.sum(d**j/err**3))
+        for j in range(5):
+            setattr(self, 's4_%d' % j,
+                    getattr(self, 's4_%d' % j) + np.sum(d**j/err**4))
+        self.peak = max(self.peak, np.max(mag-err))
+        self.trough = min(self.trough, np.min(mag+err))
+        self.update_sketch(mag, err)
+
+        # consecutive pairs, including the last epoch of the state
+        if np.isfinite(self.last_t):
+            t = np.r_[self.last_t, t]
+            d = np.r_[self.last_d, d]
+            err = np.r_[self.last_e, err]
+        ee = err[:-1]*err[1:]
+        self.p0 += np.sum(1.0/ee)
+        self.p1 += np.sum((d[:-1]+d[1:])/ee)
+        self.p11 += np.sum(d[:-1]*d[1:]/ee)
+        vw = np.diff(t)**-2
+        self.vw += np.sum(vw)
+        self.vwdm += np.sum(vw*np.diff(d)**2)
+        pairs = np.c_[d[:-1], d[1:], ee]
+        if self.jstep == 0:
+            self.pairs = np.r_[self.pairs, pairs]
+            pairs = np.empty((0,3))
+            if len(self.pairs) > self.compression:
+                pairs, self.pairs = self.pairs, np.empty((0,3))
+                std = np.sqrt(self.M2/self.W + self.se2/self.n)
+                self.jstep = 8*std/(self.jknots-1)
+                self.jstart = self.wmean - 4*std
+        if len(pairs) > 0:
+            knots = self.jstart + self.jstep*np.arange(self.jknots)
+            self.jsums += np.sum(self.stetson_terms(pairs, knots), axis=0)
+        self.last_t, self.last_d, self.last_e = t[-1], d[-1], err[-1]
+
+    def stetson_terms(self, pairs, means):
+        """ terms sign(P)*sqrt(|P|) of Stetson J, without the factor
+        N/(N-1) of P, of the *pairs* (residuals from ref, product of the
+        errors) for each of the *means* """
+
+        means = np.asarray(means) - self.ref
+        P = ((pairs[:,0,np.newaxis]-means)*(pairs[:,1,np.newaxis]-means) /
+             pairs[:,2,np.newaxis])
+        return np.sign(P)*np.sqrt(np.abs(P))
+
+    def update_sketch(self, mag, err):
+        """ Merges the magnitudes into the sketch of centroids (mean
+        magnitude, number of epochs, sum of 1/err), merging neighbouring
+        centroids away from the tails as in the t-digest
+        """
+
+        centroids = np.r_[self.centroids, np.c_[mag, np.ones(len(mag)), 1.0/err]]
+        centroids = centroids[np.argsort(centroids[:,0],kind='stable')]
+        if len(centroids) <= self.compression:
+            self.centroids = centroids
+            return
+
+        N = np.sum(centroids[:,1])
+        merged = [centroids[0].copy()]
+        cum = 0.0
+        for centroid in centroids[1:]:
+            current = merged[-1]
+            q = (cum + current[1] + centroid[1]/2.0)/N
+            if current[1] + centroid[1] <= 4*N*q*(1-q)/self.compression:
+                count = current[1] + centroid[1]
+                current[0] = (current[0]*current[1] +
+                              centroid[0]*centroid[1])/count
+                current[1] = count
+                current[2] += centroid[2]
+            else:
+                cum += current[1]
+                merged.append(centroid.copy())
+        self.centroids = np.array(merged)
+
+    def quantile(self, q, values=None):
+        """ percentiles q of the magnitudes (or of *values*, one per
+        centroid), with the linear interpolation of np.percentile between
+        the centroids """
+
+        if values is None:
+            values = self.centroids[:,0]
+        order = np.argsort(values,kind='stable')
+        values = values[order]
+        counts = self.centroids[order,1]
+        centers = np.cumsum(counts) - counts + (counts-1)/2.0
+        return np.interp(np.asarray(q)/100.0*(self.n-1), centers, values)
+
+    def calc_basic_stats(self):
+        """ the statistics of calc_basic_stats, with AD and SW NaN """
+
+        N = self.n
+        wmean = self.wmean
+        delta = wmean - self.ref
+        median = self.quantile(50)
+        (q5,q10,q15,q20,q25,q75,q80,q85,q90,q95) = \
+            self.quantile([5,10,15,20,25,75,80,85,90,95])
+
+        means, inverr = self.centroids[:,0], self.centroids[:,2]
+        wstd = np.sqrt(self.M2/self.W)
+        chi2red = self.M2/(N-1)
+        RoMS = np.sum(np.abs(means-median)*inverr)/(N-1)
+        NormPeaktoPeakamp = (self.peak-self.trough)/(self.peak+self.trough)
+        NormExcessVar = (self.sd2 - 2*delta*self.sd1 + N*delta**2 -
+                         self.se2)/(N*wmean**2)
+        medianAbsDev = self.quantile(50, np.abs(means-median))
+
+        s3 = sum(binom(3,j)*(-delta)**(3-j)*getattr(self,'s3_%d' % j)
+                 for j in range(4))
+        s4 = sum(binom(4,j)*(-delta)**(4-j)*getattr(self,'s4_%d' % j)
+                 for j in range(5))
+        skew = 1.*N/(N-1)/(N-2)*s3
+        smallkurt = 1.*N*(N+1)/(N-1)/(N-2)/(N-3)*s4
+        smallkurt -= 3*(N-1)**2/(N-2)/(N-3)
+        invNeumann = (self.vwdm/(self.vw*wstd**2))**-1
+
+        WelchI = 1.*N/(N-1)*(self.p11 - delta*self.p1 + delta**2*self.p0)
+        if self.jstep > 0:
+            x = (wmean - self.jstart)/self.jstep
+            k = int(np.clip(np.floor(x), 0, self.jknots-2))
+            StetsonJ = self.jsums[k] + (x-k)*(self.jsums[k+1]-self.jsums[k])
+        else:
+            StetsonJ = np.sum(self.stetson_terms(self.pairs, [wmean]))
+        StetsonJ *= np.sqrt(1.*N/(N-1))
+        StetsonK = np.sqrt(1.*N/(N-1))*np.sum(np.abs(means-wmean)*inverr)/N
+        StetsonK /= np.sqrt(1.*N/(N-1)*self.M2/N)
+
+        return np.r_[N,median,wmean,chi2red,RoMS,wstd,
+                     NormPeaktoPeakamp,NormExcessVar,medianAbsDev,q75-q25,
+                     q80-q20,q85-q15,q90-q10,q95-q5,skew,smallkurt,
+                     invNeumann,WelchI,StetsonJ,StetsonK,np.nan,np.nan]
+
+    def to_arrays(self):
+        """ the scalars followed by the jknots sums of Stetson J, the
+        centroids and the pairs kept for Stetson J """
+        scalars = np.array([getattr(self, name) for name in self.scalar_names],
+                           dtype=float)
+        return np.r_[scalars, self.jsums], self.centroids, self.pairs
+
+    @classmethod
+    def from_arrays(cls, scalars, centroids, pairs, compression=200):
+        state = cls(compression=compression)
+        for name, value in zip(cls.scalar_names, scalars):
+            setattr(state, name, value)
+        state.jsums = np.array(scalars[len(cls.scalar_names):], dtype=float)
+        state.n = int(state.n)
+        state.centroids = np.array(centroids, dtype=float).reshape(-1,3)
+        state.pairs = np.array(pairs, dtype=float).reshape(-1,3)
+        return state
+
+
+
+def save_online_stats(filename, ids, states):
+    """ Writes the OnlineStats *states* of the objects *ids* to the hdf5
+    file *filename*: one row of scalars per object, and the centroids of
+    all the sketches and the pairs kept for Stetson J concatenated, with
+    offsets """
+
+    import h5py
+
+    scalars = np.array([state.to_arrays()[0] for state in states]).reshape(
+        len(states), len(OnlineStats.scalar_names) + OnlineStats.jknots)
+    centroids = [state.centroids for state in states]
+    offsets = np.append(0, np.cumsum([len(c) for c in centroids]))
+    pairs = [state.pairs for state in states]
+    pair_offsets = np.append(0, np.cumsum([len(p) for p in pairs]))
+    if len(centroids) > 0:
+        centroids = np.concatenate(centroids)
+        pairs = np.concatenate(pairs)
+    else:
+        centroids = np.empty((0,3))
+        pairs = np.empty((0,3))
+
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('ids', data=np.asarray(ids))
+        f.create_dataset('scalars', data=scalars, compression='gzip')
+        f.create_dataset('centroids', data=centroids, compression='gzip')
+        f.create_dataset('offsets', data=offsets)
+        f.create_dataset('pairs', data=pairs, compression='gzip')
+        f.create_dataset('pair_offsets', data=pair_offsets)
+        f.attrs['scalar_names'] = OnlineStats.scalar_names
+        f.attrs['compression'] = (states[0].compression
+                                    if len(states) > 0 else 200)
+
+
+
+def load_online_stats(filename):
+    """ Reads the ids and OnlineStats states written by save_online_stats """
+
+    import h5py
+
+    with h5py.File(filename, 'r') as f:
+        ids = f['ids'][:]
+        scalars = f['scalars'][:]
+        centroids = f['centroids'][:]
+        offsets = f['offsets'][:]
+        pairs = f['pairs'][:]
+        pair_offsets = f['pair_offsets'][:]
+        compression = int(f.attrs['compression'])
+
+    states = [OnlineStats.from_arrays(scalars[ii],
+                                      centroids[offsets[ii]:offsets[ii+1]],
+                                      pairs[pair_offsets[ii]:pair_offsets[ii+1]],
+                                      compression=compression)
+              for ii in range(len(ids))]
+    return ids, states
@@ -60,10 +60,16 @@ def gamma(N):
 
 def tau_davies(Z, N, fmax, t, y, dy, normalization='standard'):
     """tau factor for estimating Davies bound (see Baluev 2008, Table 1)"""
+    Dt = weighted_var(t, dy)
+    return tau_davies_var(Z, N, fmax, Dt, normalization=normalization)
+
+
+def tau_davies_var(Z, N, fmax, Dt, normalization='standard'):
+    """Same as tau_davies, from the weighted variance *Dt* of the epochs;
+    all arguments may be arrays"""
     # Variable names follow the discussion in Baluev 2008
     NH = N - 1  # DOF for null hypothesis
     NK = N - 3  # DOF for periodic hypothesis
-    Dt = weighted_var(t, dy)
     Teff = np.sqrt(4 * np.pi * Dt)
     W = fmax * Teff
     if normalization == 'psd':
@@ -148,4 +154,265 @@ def period_search_ls(t, mag, magerr, data_out, remove_harmonics = True):
     data_out["Nztfobs"] = N
     data_out["fap_Neff"] = fap_Neff
     # data_out["fap_Baluev"] = fap_Baluev
-    return data_out
\ No newline at end of file
+    return data_out
+
+def bitceil(N):
+    """Smallest power of 2 greater than or equal to N"""
+    return 1 << int(np.ceil(np.log2(max(N, 1))))
+
+
+def extirpolate_batch(x, y, segments, nseg, N, M=4):
+    """Extirpolate the ragged samples (x, y) onto one regular grid per segment
+
+    Batched version of the Press & Rybicki (1989) extirpolation used by the
+    fast Lomb-Scargle, where *segments* gives the index of the lightcurve
+    each sample belongs to. Returns an array of shape (nseg, N).
+    """
+    result = np.zeros(nseg * N, dtype=y.dtype)
+    base = segments * N
+
+    # samples falling exactly on the grid go straight in
+    integers = x % 1 == 0
+    np.add.at(result, base[integers] + x[integers].astype(int), y[integers])
+    x, y, base = x[~integers], y[~integers], base[~integers]
+
+    # Lagrange weights over the M grid points bracketing each sample
+    ilo = np.clip((x - M // 2).astype(int), 0, N - M)
+    numerator = y * np.prod(x - ilo - np.arange(M)[:, np.newaxis], 0)
+    denominator = float(np.prod(np.arange(1, M)))
+    for j in range(M):
+        if j > 0:
+            denominator *= j / (j - M)
+        ind = ilo + (M - 1 - j)
+        np.add.at(result, base + ind, numerator / (denominator * (x - ind)))
+
+    return result.reshape((nseg, N))
+
+
+def trig_sum_batch(t, h, segments, nseg, f0, df, N, freq_factor=1,
+                   oversampling=5, Mfft=4):
+    """Trigonometric sums of a batch of lightcurves on a regular grid
+
+    Computes S_j = sum_i h_i sin(2 pi f_j t_i), C_j = sum_i h_i cos(2 pi f_j t_i)
+    with f_j = freq_factor * (f0 + j * df) for every lightcurve at once: the
+    samples of all lightcurves are extirpolated onto a (nseg, Nfft) grid and
+    transformed with a single FFT along the last axis. *h* can have shape
+    (nsums, n_samples) to share the extirpolation across several sums.
+    """
+    df *= freq_factor
+    f0 *= freq_factor
+
+    h = np.atleast_2d(h)
+    nsums = h.shape[0]
+    Nfft = bitceil(N * oversampling)
+
+    # reference each lightcurve to its own first epoch
+    t0 = np.full(nseg, np.inf)
+    np.minimum.at(t0, segments, t)
+    tshift = t - t0[segments]
+
+    hshift = h * np.exp(2j * np.pi * f0 * tshift)
+    tnorm = (tshift * Nfft * df) % Nfft
+
+    allsegments = (np.arange(nsums)[:, np.newaxis] * nseg
+                   + segments).ravel()
+    grid = extirpolate_batch(np.tile(tnorm, nsums), hshift.ravel(),
+                             allsegments, nsums * nseg, Nfft, Mfft)
+    fftgrid = np.fft.ifft(grid, axis=1)[:, :N]
+    fftgrid = fftgrid.reshape((nsums, nseg, N))
+
+    f = f0 + df * np.arange(N)
+    fftgrid *= np.exp(2j * np.pi * t0[:, np.newaxis] * f)
+
+    C = Nfft * fftgrid.real
+    S = Nfft * fftgrid.imag
+    return S, C
+
+
+def lombscargle_fast_batch(lightcurves, f0, df, N, oversampling=5, Mfft=4):
+    """Floating-mean Lomb-Scargle periodograms of a batch of lightcurves
+
+    O[N log N] evaluation (Press & Rybicki 1989, Zechmeister & Kurster 2009)
+    on the regular grid f0 + df * arange(N), with the same conventions as
+    astropy's LombScargle (fit_mean, center_data, standard normalization).
+    The trigonometric sums of all lightcurves are computed together.
+
+    Returns an array of shape (len(lightcurves), N).
+    """
+    nseg = len(lightcurves)
+    lengths = np.array([len(lc[0]) for lc in lightcurves])
+    segments = np.repeat(np.arange(nseg), lengths)
+    offsets = np.append(0, np.cumsum(lengths))[:-1]
+
+    t = np.concatenate([np.asarray(lc[0], dtype=float) for lc in lightcurves])
+    y = np.concatenate([np.asarray(lc[1], dtype=float) for lc in lightcurves])
+    dy = np.concatenate([np.asarray(lc[2], dtype=float) for lc in lightcurves])
+
+    w = dy ** -2.0
+    w /= np.add.reduceat(w, offsets)[segments]
+    y = y - np.add.reduceat(w * y, offsets)[segments]
+    YY = np.add.reduceat(w * y ** 2, offsets)[:, np.newaxis]
+
+    kwargs = dict(f0=f0, df=df, N=N, oversampling=oversampling, Mfft=Mfft)
+    (Sh, S), (Ch, C) = trig_sum_batch(t, np.vstack((w * y, w)), segments,
+                                      nseg, **kwargs)
+    S2, C2 = trig_sum_batch(t, w, segments, nseg, freq_factor=2, **kwargs)
+    S2, C2 = S2[0], C2[0]
+
+    tan_2omega_tau = (S2 - 2 * S * C) / (C2 - (C * C - S * S))
+    S2w = tan_2omega_tau / np.sqrt(1 + tan_2omega_tau * tan_2omega_tau)
+    C2w = 1 / np.sqrt(1 + tan_2omega_tau * tan_2omega_tau)
+    Cw = np.sqrt(0.5) * np.sqrt(1 + C2w)
+    Sw = np.sqrt(0.5) * np.sign(S2w) * np.sqrt(1 - C2w)
+
+    YC = Ch * Cw + Sh * Sw
+    YS = Sh * Cw - Ch * Sw
+    CC = 0.5 * (1 + C2 * C2w + S2 * S2w) - (C * Cw + S * Sw) ** 2
+    SS = 0.5 * (1 - C2 * C2w - S2 * S2w) - (S * Cw - C * Sw) ** 2
+
+    power = (YC * YC / CC + YS * YS / SS) / YY
+
+    return power
+
+
+def lombscargle_batch_at(lightcurves, freqs):
+    """Exact floating-mean Lomb-Scargle powers of a batch of lightcurves at
+    a few frequencies each
+
+    Direct O[n_samples * M] evaluation of the generalized Lomb-Scargle
+    (Zechmeister & Kurster 2009) with the same conventions as astropy's
+    LombScargle (fit_mean, center_data, standard normalization), used to
+    re-evaluate exactly the peaks found on the fast periodograms.
+    *freqs* has shape (len(lightcurves), M); returns the powers with the
+    same shape.
+    """
+    freqs = np.atleast_2d(np.asarray(freqs, dtype=float))
+    nseg = len(lightcurves)
+    lengths = np.array([len(lc[0]) for lc in lightcurves])
+    segments = np.repeat(np.arange(nseg), lengths)
+    offsets = np.append(0, np.cumsum(lengths))[:-1]
+
+    t = np.concatenate([np.asarray(lc[0], dtype=float) for lc in lightcurves])
+    y = np.concatenate([np.asarray(lc[1], dtype=float) for lc in lightcurves])
+    dy = np.concatenate([np.asarray(lc[2], dtype=float) for lc in lightcurves])
+    t = t - t[offsets][segments]
+
+    w = dy ** -2.0
+    w /= np.add.reduceat(w, offsets)[segments]
+    y = y - np.add.reduceat(w * y, offsets)[segments]
+    YY = np.add.reduceat(w * y ** 2, offsets)[:, np.newaxis]
+
+    omegat = 2 * np.pi * freqs[segments] * t[:, np.newaxis]
+    cos, sin = np.cos(omegat), np.sin(omegat)
+    w, y = w[:, np.newaxis], y[:, np.newaxis]
+
+    def wsum(x):
+        return np.add.reduceat(w * x, offsets, axis=0)
+
+    C, S = wsum(cos), wsum(sin)
+    YC, YS = wsum(y * cos), wsum(y * sin)
+    CC = wsum(cos * cos) - C * C
+    SS = wsum(sin * sin) - S * S
+    CS = wsum(cos * sin) - C * S
+    D = CC * SS - CS * CS
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (SS * YC ** 2 + CC * YS ** 2 - 2 * CS * YC * YS) / (YY * D)
+
+
+def FAP_baluev(Z, fmax, t, y, dy, normalization='standard'):
+    """Baluev (2008) false alarm probability of a single peak *Z*
+
+    Same as FAP_aliasfree, but written as -expm1(-tau + log1p(-FAP_single))
+    so that it does not round to zero for strong peaks, as in astropy's
+    LombScargle.false_alarm_probability(method='baluev').
+    """
+    N = len(t)
+    FAP_s = FAP_single(Z, N, normalization=normalization)
+    tau = tau_davies(Z, N, fmax, t, y, dy, normalization=normalization)
+    with np.errstate(divide='ignore'):
+        return -np.expm1(-tau + np.log1p(-FAP_s))
+
+
+def FAP_baluev_batch(Z, fmax, lightcurves, normalization='standard'):
+    """Baluev (2008) false alarm probabilities of the peaks *Z* of a batch
+    of lightcurves, one peak per (non-empty) lightcurve
+
+    Same as FAP_baluev, with the number of epochs and the weighted variance
+    of the epochs of all lightcurves computed together with np.add.reduceat
+    (each lightcurve referenced to its first epoch).
+    """
+    lengths = np.array([len(lc[0]) for lc in lightcurves])
+    offsets = np.append(0, np.cumsum(lengths))[:-1]
+    segments = np.repeat(np.arange(len(lightcurves)), lengths)
+
+    t = np.concatenate([np.asarray(lc[0], dtype=float) for lc in lightcurves])
+    dy = np.concatenate([np.asarray(lc[2], dtype=float) for lc in lightcurves])
+    t = t - t[offsets][segments]
+
+    w = dy ** -2.0
+    W = np.add.reduceat(w, offsets)
+    tmean = np.add.reduceat(w * t, offsets) / W
+    Dt = np.add.reduceat(w * t ** 2, offsets) / W - tmean ** 2
+
+    Z = np.asarray(Z, dtype=float)
+    FAP_s = FAP_single(Z, lengths, normalization=normalization)
+    tau = tau_davies_var(Z, lengths, fmax, Dt, normalization=normalization)
+    with np.errstate(divide='ignore'):
+        return -np.expm1(-tau + np.log1p(-FAP_s))
+
+
+def lombscargle_shared_epochs(t, y, w, freqs, chunk_size=1000):
+    """Floating-mean Lomb-Scargle periodograms of sources with common epochs
+
+    All sources are sampled on the same epochs *t*; missing epochs have zero
+    weight. The sin/cos basis is computed once per block of *chunk_size*
+    frequencies and the weighted sums of every source are obtained with
+    dense matrix products, so the work is BLAS bound. Same conventions as
+    astropy's LombScargle (fit_mean, center_data, standard normalization).
+
+    Parameters
+    ----------
+    t : 1D-array, shape = [n_epochs]
+        common epochs
+    y : 2D-array, shape = [n_sources, n_epochs]
+        magnitudes (any value where the weight is zero)
+    w : 2D-array, shape = [n_sources, n_epochs]
+        weights, i.e. 1/dy**2, and 0 for missing epochs
+    freqs : 1D-array
+        frequency grid, need not be regular
+
+    Returns
+    -------
+    power : 2D-array, shape = [n_sources, n_freqs]
+    """
+    t = np.asarray(t, dtype=float)
+    t = t - np.min(t)
+
+    w = w / np.sum(w, axis=1)[:, np.newaxis]
+    y = y - np.sum(w * y, axis=1)[:, np.newaxis]
+    y[w == 0] = 0.0
+    wy = w * y
+    YY = np.sum(wy * y, axis=1)[:, np.newaxis]
+
+    ns, nf = y.shape[0], len(freqs)
+    power = np.zeros((ns, nf))
+    for start in range(0, nf, chunk_size):
+        f = freqs[start:start+chunk_size]
+        nc = len(f)
+        arg = 2 * np.pi * f[:, np.newaxis] * t
+        basis = np.vstack((np.cos(arg), np.sin(arg),
+                           np.cos(2 * arg), np.sin(2 * arg)))
+
+        C, S, C2, S2 = np.split(np.dot(w, basis.T), 4, axis=1)
+        YC, YS = np.split(np.dot(wy, basis[:2*nc].T), 2, axis=1)
+
+        CC = 0.5 * (1 + C2) - C * C
+        SS = 0.5 * (1 - C2) - S * S
+        CS = 0.5 * S2 - C * S
+        D = CC * SS - CS * CS
+
+        power[:, start:start+nc] = (SS * YC * YC + CC * YS * YS
+                                    - 2 * CS * YC * YS) / (YY * D)
+
+    return power
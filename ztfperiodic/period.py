@@ -123,6 +123,352 @@ def CE(period, data, xbins=10, ybins=5):
     else:
         return np.PINF
 
+def CE_vectorized(periods, data, xbins=10, ybins=5, chunk_size=1000):
+    """
+    Returns the conditional entropy of *data* rephased with each of *periods*.
+
+    The phase-bin index of every (period, epoch) pair is computed for a block
+    of *chunk_size* periods at a time, and all of the 2D histograms of the
+    block are filled with a single call to np.bincount. The binning follows
+    the convention of CE (fast_histogram), so that values equal to the upper
+    edge of the range are dropped and the results match CE period by period
+    (to rounding).
+
+    **Parameters**
+
+    periods : array-like, shape = [n_periods]
+        The periods to rephase *data* by.
+    data : array-like, shape = [n_samples, 2] or [n_samples, 3]
+        Array containing columns *time*, *mag*, and (optional) *error*.
+    xbins : int, optional
+        Number of phase bins (default 10).
+    ybins : int, optional
+        Number of magnitude bins (default 5).
+    chunk_size : int, optional
+        Number of periods evaluated at once; bounds the memory use to
+        roughly chunk_size * n_samples phase values (default 1000).
+
+    **Returns**
+
+    entropies : array-like, shape = [n_periods]
+        The conditional entropy at each period.
+    """
+
+    periods = np.atleast_1d(np.asarray(periods, dtype=float))
+    data = np.ma.getdata(data)
+    t, y = np.asarray(data[:, 0], dtype=float), np.asarray(data[:, 1],
+                                                          dtype=float)
+    size = len(t)
+
+    entropies = np.full(len(periods), np.inf)
+    if size == 0:
+        return entropies
+
+    for start in range(0, len(periods), chunk_size):
+        period = periods[start:start+chunk_size]
+        good = period > 0
+        if not np.any(good):
+            continue
+        period = period[good]
+
+        phases = np.mod(t, period[:, np.newaxis]) / period[:, np.newaxis]
+
+        idx = np.arange(start, start+len(good))[good]
+        entropies[idx] = CE_phases(phases, y, xbins=xbins, ybins=ybins)
+
+    return entropies
+
+def CE_phases(phases, y, xbins=10, ybins=5):
+    """
+    Returns the conditional entropy of *y* for each row of *phases*.
+
+    All of the 2D histograms are filled with a single call to np.bincount;
+    as in CE, phases and magnitudes outside of [0, 1) are dropped.
+
+    **Parameters**
+
+    phases : array-like, shape = [n_trials, n_samples]
+        The phases of the samples for each trial (period, pdot, ...).
+    y : array-like, shape = [n_samples]
+        The (normalized) magnitudes.
+    xbins : int, optional
+        Number of phase bins (default 10).
+    ybins : int, optional
+        Number of magnitude bins (default 5).
+
+    **Returns**
+
+    entropies : array-like, shape = [n_trials]
+        The conditional entropy of each trial.
+    """
+
+    phases = np.atleast_2d(phases)
+    ntrials, size = phases.shape
+    if size == 0:
+        return np.full(ntrials, np.inf)
+
+    ymask = (y >= 0) & (y < 1)
+    ybin = np.zeros(y.shape, dtype=np.int64)
+    ybin[ymask] = (y[ymask] * ybins).astype(np.int64)
+
+    nbins = xbins * ybins
+    mask = ymask & (phases >= 0) & (phases < 1)
+    xbin = (phases * xbins).astype(np.int64)
+
+    index = np.arange(ntrials)[:, np.newaxis]*nbins + xbin*ybins + ybin
+    bins = np.bincount(index[mask], minlength=ntrials*nbins)
+
+    return CE_from_bins(bins.reshape((ntrials, xbins, ybins)), size)
+
+def CE_from_bins(bins, size):
+    """
+    Returns the conditional entropy of the 2D (phase, magnitude) histograms
+    *bins* (counts, shape = [n_trials, xbins, ybins]) of *size* samples.
+
+    With the column sums c_i = sum_j b_ij, the entropy
+    sum_ij b_ij/size * log(c_i / b_ij) is evaluated as
+    (sum_i c_i log c_i - sum_ij b_ij log b_ij) / size, with a table of
+    k log k for the integer counts, so that no logarithm is taken per bin.
+    """
+    bins = np.asarray(bins, dtype=np.int64)
+    column_sums = np.sum(bins, axis=2)
+
+    k = np.arange(1, size+1)
+    klogk = np.zeros(size+1)
+    klogk[1:] = k*np.log(k)
+
+    return (np.sum(klogk[column_sums], axis=1)
+            - np.sum(klogk[bins], axis=(1, 2))) / size
+
+def AOV_phases(phases, y, r=10):
+    """
+    Returns the analysis of variance statistic of *y* for each row of
+    *phases*, with *r* phase bins, as in AOV_cython.aov_batch.
+
+    **Parameters**
+
+    phases : array-like, shape = [n_trials, n_samples]
+        The phases of the samples for each trial (period, pdot, ...).
+    y : array-like, shape = [n_samples]
+        The (normalized) magnitudes.
+    r : int, optional
+        Number of phase bins (default 10).
+
+    **Returns**
+
+    aov : array-like, shape = [n_trials]
+        The AOV statistic of each trial; NaN where it is undefined.
+    """
+
+    phases = np.atleast_2d(phases)
+    ntrials, size = phases.shape
+    if size <= r:
+        return np.full(ntrials, np.nan)
+
+    xbin = np.minimum((phases * r).astype(np.int64), r - 1)
+    index = (np.arange(ntrials)[:, np.newaxis]*r + xbin).ravel()
+    weights = np.broadcast_to(y, phases.shape).ravel()
+
+    n = np.bincount(index, minlength=ntrials*r).reshape((ntrials, r))
+    sum1 = np.bincount(index, weights=weights,
+                       minlength=ntrials*r).reshape((ntrials, r))
+    sum2 = np.bincount(index, weights=weights**2,
+                       minlength=ntrials*r).reshape((ntrials, r))
+
+    return AOV_from_sums(n, sum1, sum2, np.mean(y), size)
+
+def AOV_from_sums(n, sum1, sum2, avg, size):
+    """
+    Returns the AOV statistic from the number of samples *n*, and the sums
+    of the magnitudes *sum1* and of their squares *sum2*, in each phase
+    bin (shape = [n_trials, r]); *avg* is the mean magnitude and *size*
+    the number of samples.
+    """
+    r = n.shape[-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(n > 0, sum1 / n, 0.0)
+        s1 = np.sum(n*(mean - avg)**2, axis=1)
+        s2 = np.sum(sum2 - n*mean**2, axis=1)
+        aov = s1 / s2 * (size - r) / (r - 1)
+    aov[s2 == 0] = np.nan
+
+    return aov
+
+def pdot_periodogram(t, y, freqs, pdots, statistic="CE", xbins=10, ybins=5,
+                     chunk_size=1000):
+    """
+    Returns the conditional entropy or AOV statistic of (*t*, *y*) folded
+    with every pair of *freqs* and *pdots*.
+
+    The phases follow simulate.pdot_phasefold, referenced to the first
+    epoch: phase = f*t - Pdot*f**2*t**2/2 (mod 1). They are computed for
+    *chunk_size* (frequency, pdot) pairs at a time.
+
+    **Parameters**
+
+    t, y : array-like, shape = [n_samples]
+        The times and (normalized) magnitudes.
+    freqs : array-like, shape = [n_freqs]
+        The trial frequencies.
+    pdots : array-like, shape = [n_pdots]
+        The trial period derivatives (time/time).
+    statistic : str, optional
+        "CE" or "AOV" (default "CE").
+    xbins : int, optional
+        Number of phase bins (default 10).
+    ybins : int, optional
+        Number of magnitude bins for CE (default 5).
+    chunk_size : int, optional
+        Number of (frequency, pdot) pairs evaluated at once (default 1000).
+
+    **Returns**
+
+    stats : array-like, shape = [n_pdots, n_freqs]
+        The statistic at each (pdot, frequency).
+    """
+
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    t = t - np.min(t)
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+    pdots = np.atleast_1d(np.asarray(pdots, dtype=float))
+
+    if statistic == "CE":
+        calc_stat = partial(CE_phases, y=y, xbins=xbins, ybins=ybins)
+    elif statistic == "AOV":
+        calc_stat = partial(AOV_phases, y=y, r=xbins)
+    else:
+        raise ValueError("statistic must be CE or AOV")
+
+    ff = np.tile(freqs, len(pdots))
+    pp = np.repeat(pdots, len(freqs))
+    stats = np.empty(ff.shape)
+    for start in range(0, len(ff), chunk_size):
+        f = ff[start:start+chunk_size, np.newaxis]
+        pdot = pp[start:start+chunk_size, np.newaxis]
+        phases = f*t - 0.5*pdot*f**2*t**2
+        phases = phases - np.floor(phases)
+        stats[start:start+chunk_size] = calc_stat(phases)
+
+    return stats.reshape((len(pdots), len(freqs)))
+
+def fused_periodogram(t, y, dy, freqs, statistics=["CE", "AOV", "LS"],
+                      xbins=20, ybins=10, chunk_size=1000):
+    """
+    Returns the conditional entropy, AOV and Lomb-Scargle periodograms of
+    (*t*, *y*, *dy*) from a single pass over *freqs*.
+
+    The phases of a block of *chunk_size* frequencies are computed once;
+    CE and AOV share the same phase-bin index and 2D phase and magnitude
+    histogram (AOV also needs the per-bin sums of the magnitudes and of
+    their squares), and LS comes from the cosines and sines of the same
+    phases, with the conventions of mylombscargle.lombscargle_shared_epochs
+    (floating mean, weights 1/dy**2, standard normalization).
+
+    **Parameters**
+
+    t, y, dy : array-like, shape = [n_samples]
+        The times, (normalized) magnitudes and magnitude errors.
+    freqs : array-like, shape = [n_freqs]
+        The trial frequencies.
+    statistics : list, optional
+        Any of "CE", "AOV" and "LS" (default all).
+    xbins : int, optional
+        Number of phase bins of CE and AOV (default 20).
+    ybins : int, optional
+        Number of magnitude bins of CE (default 10).
+    chunk_size : int, optional
+        Number of frequencies evaluated at once (default 1000).
+
+    **Returns**
+
+    stats : dict
+        The periodogram of each statistic, shape = [n_freqs].
+    """
+
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    dy = np.asarray(dy, dtype=float)
+    t = t - np.min(t)
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+    size = len(t)
+
+    stats = {}
+    for statistic in statistics:
+        if not statistic in ["CE", "AOV", "LS"]:
+            raise ValueError("statistic must be CE, AOV or LS")
+        stats[statistic] = np.full(len(freqs), np.nan)
+    if size == 0:
+        return stats
+
+    # magnitudes outside of [0, 1) go to an extra bin that CE ignores
+    ymask = (y >= 0) & (y < 1)
+    ybin = ybins*np.ones(y.shape, dtype=np.int64)
+    ybin[ymask] = (y[ymask] * ybins).astype(np.int64)
+    avg = np.mean(y)
+
+    w = 1.0/dy**2
+    w = w / np.sum(w)
+    wy = w * (y - np.sum(w * y))
+    YY = np.sum(wy * (y - np.sum(w * y)))
+
+    for start in range(0, len(freqs), chunk_size):
+        f = freqs[start:start+chunk_size]
+        nc = len(f)
+
+        phases = f[:, np.newaxis] * t
+        phases = phases - np.floor(phases)
+        xbin = np.minimum((phases * xbins).astype(np.int64), xbins - 1)
+        trial = np.arange(nc)[:, np.newaxis]
+
+        if "CE" in stats or "AOV" in stats:
+            index = (trial*xbins + xbin)*(ybins+1) + ybin
+            counts = np.bincount(index.ravel(), minlength=nc*xbins*(ybins+1))
+            counts = counts.reshape((nc, xbins, ybins+1))
+
+        if "CE" in stats:
+            stats["CE"][start:start+nc] = CE_from_bins(counts[:, :, :ybins],
+                                                       size)
+
+        if "AOV" in stats and size > xbins:
+            index = (trial*xbins + xbin).ravel()
+            weights = np.broadcast_to(y, phases.shape).ravel()
+            n = np.sum(counts, axis=2)
+            sum1 = np.bincount(index, weights=weights, minlength=nc*xbins)
+            sum2 = np.bincount(index, weights=weights**2,
+                               minlength=nc*xbins)
+            stats["AOV"][start:start+nc] = AOV_from_sums(n,
+                                                         sum1.reshape((nc, xbins)),
+                                                         sum2.reshape((nc, xbins)),
+                                                         avg, size)
+
+        if "LS" in stats and size > 3:
+            df = f[1] - f[0] if nc > 1 else 0.0
+            if nc > 1 and np.allclose(np.diff(f), df, rtol=1e-10, atol=0):
+                # on a regular grid exp(2 pi i f t) follows from the phases
+                # of the first frequency by a recurrence in frequency,
+                # which is much cheaper than evaluating the exponentials
+                z = np.empty(phases.shape, dtype=complex)
+                z[0] = np.exp(2j * np.pi * phases[0])
+                z[1:] = np.exp(2j * np.pi * df * t)
+                z = np.cumprod(z, axis=0)
+            else:
+                z = np.exp(2j * np.pi * phases)
+            CS1, YCS = np.dot(z, np.vstack((w, wy)).T).T
+            CS2 = np.dot(z * z, w)
+            C, S, C2, S2 = CS1.real, CS1.imag, CS2.real, CS2.imag
+            YC, YS = YCS.real, YCS.imag
+
+            CC = 0.5 * (1 + C2) - C * C
+            SS = 0.5 * (1 - C2) - S * S
+            CS = 0.5 * S2 - C * S
+            D = CC * SS - CS * CS
+
+            stats["LS"][start:start+nc] = (SS * YC * YC + CC * YS * YS
+                                           - 2 * CS * YC * YS) / (YY * D)
+
+    return stats
+
 def CE_cupy(period, data, xbins=10, ybins=5):
     """
     Returns the conditional entropy of *data* rephased with *period*.
@@ -185,3 +531,162 @@ def CE_cupy(period, data, xbins=10, ybins=5):
         return np.sum(A)
     else:
         return np.PINF
+
+def BLS_periodogram(t, y, dy, freqs, nbins=100, qmin=0.01, qmax=0.2,
+                    chunk_size=1000):
+    """
+    Returns the box least squares (BLS) periodogram of (*t*, *y*, *dy*).
+
+    For a block of *chunk_size* frequencies at a time, the weights and
+    weighted (mean subtracted) magnitudes are binned in phase with
+    np.bincount, and their cumulative sums over the phase-sorted bins
+    (extended by the longest box to wrap around phase 1) give the sums in
+    every box of every duration by differences. The power of a box with
+    weight fraction r and weighted magnitude sum s is s**2/(r*(1-r)),
+    normalized by the weighted variance, as in Kovacs et al. (2002) and
+    cuvarbase's eebls_gpu_fast.
+
+    **Parameters**
+
+    t, y, dy : array-like, shape = [n_samples]
+        The times, magnitudes and magnitude errors.
+    freqs : array-like, shape = [n_freqs]
+        The trial frequencies.
+    nbins : int, optional
+        Number of phase bins (default 100).
+    qmin, qmax : float, optional
+        Shortest and longest box durations, as fractions of the period
+        (default 0.01 and 0.2); all durations in between, in whole phase
+        bins, are tested.
+    chunk_size : int, optional
+        Number of frequencies evaluated at once (default 1000).
+
+    **Returns**
+
+    power : array-like, shape = [n_freqs]
+        The highest BLS power over all boxes at each frequency.
+    """
+
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    dy = np.asarray(dy, dtype=float)
+    t = t - np.min(t)
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+
+    power = np.full(len(freqs), np.nan)
+    if len(t) < 2:
+        return power
+
+    w = 1.0/dy**2
+    w = w / np.sum(w)
+    yc = y - np.sum(w * y)
+    YY = np.sum(w * yc**2)
+    if YY == 0:
+        return power
+
+    kmin = max(int(np.round(qmin*nbins)), 1)
+    kmax = min(max(int(np.round(qmax*nbins)), kmin), nbins - 1)
+
+    for start in range(0, len(freqs), chunk_size):
+        f = freqs[start:start+chunk_size]
+        nc = len(f)
+
+        phases = f[:, np.newaxis] * t
+        phases = phases - np.floor(phases)
+        ibin = np.minimum((phases * nbins).astype(np.int64), nbins - 1)
+        index = (np.arange(nc)[:, np.newaxis]*nbins + ibin).ravel()
+
+        W = np.bincount(index, weights=np.broadcast_to(w, phases.shape).ravel(),
+                        minlength=nc*nbins).reshape((nc, nbins))
+        S = np.bincount(index, weights=np.broadcast_to(w*yc, phases.shape).ravel(),
+                        minlength=nc*nbins).reshape((nc, nbins))
+
+        zeros = np.zeros((nc, 1))
+        CW = np.cumsum(np.hstack((zeros, W, W[:, :kmax])), axis=1)
+        CS = np.cumsum(np.hstack((zeros, S, S[:, :kmax])), axis=1)
+
+        best = np.zeros(nc)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for k in range(kmin, kmax+1):
+                r = CW[:, k:k+nbins] - CW[:, :nbins]
+                s = CS[:, k:k+nbins] - CS[:, :nbins]
+                bls = s**2/(r*(1-r))
+                bls[(r <= 0) | (r >= 1)] = 0.0
+                best = np.maximum(best, np.max(bls, axis=1))
+
+        power[start:start+nc] = best / YY
+
+    return power
+
+def PDM_periodogram(t, y, freqs, w=None, nbins=10, chunk_size=1000):
+    """
+    Returns the phase dispersion minimization (PDM) periodogram of (*t*, *y*)
+    with the binned_linterp model of cuvarbase.pdm.
+
+    For a block of *chunk_size* frequencies at a time, the weighted bin means
+    are computed with np.bincount, the model at each phase is the linear
+    interpolation between the means of the two nearest bin centres
+    (wrapping around phase 1; empty bins take the overall mean), and the
+    power is 1 - sum(w*(y - model)**2)/sum(w*(y - mean)**2), so the best
+    frequency maximizes it.
+
+    **Parameters**
+
+    t, y : array-like, shape = [n_samples]
+        The times and magnitudes.
+    freqs : array-like, shape = [n_freqs]
+        The trial frequencies.
+    w : array-like, shape = [n_samples], optional
+        The weights; uniform if None (default None).
+    nbins : int, optional
+        Number of phase bins (default 10).
+    chunk_size : int, optional
+        Number of frequencies evaluated at once (default 1000).
+
+    **Returns**
+
+    power : array-like, shape = [n_freqs]
+        The PDM power at each frequency.
+    """
+
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+    if w is None:
+        w = np.ones(len(t))
+    w = np.asarray(w, dtype=float)
+    w = w / np.sum(w)
+
+    power = np.full(len(freqs), np.nan)
+    ybar = np.sum(w * y)
+    var = np.sum(w * (y - ybar)**2)
+    if len(t) < 2 or var == 0:
+        return power
+
+    for start in range(0, len(freqs), chunk_size):
+        f = freqs[start:start+chunk_size]
+        nc = len(f)
+
+        phases = f[:, np.newaxis] * t
+        phases = phases - np.floor(phases)
+        ibin = np.minimum((phases * nbins).astype(np.int64), nbins - 1)
+        offset = np.arange(nc)[:, np.newaxis]*nbins
+        index = (offset + ibin).ravel()
+
+        W = np.bincount(index, weights=np.broadcast_to(w, phases.shape).ravel(),
+                        minlength=nc*nbins)
+        S = np.bincount(index, weights=np.broadcast_to(w*y, phases.shape).ravel(),
+                        minlength=nc*nbins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(W > 0, S/W, ybar)
+
+        x = phases * nbins - 0.5
+        i0 = np.floor(x)
+        alpha = x - i0
+        i0 = i0.astype(np.int64) % nbins
+        i1 = (i0 + 1) % nbins
+        model = (1 - alpha)*means[offset + i0] + alpha*means[offset + i1]
+
+        power[start:start+nc] = 1 - np.sum(w * (y - model)**2, axis=1)/var
+
+    return power
@@ -1,11 +1,47 @@
+from functools import partial
 
 import numpy as np
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+# registry of period-search engines, keyed by (algorithm, device)
+ENGINES = {}
 
-import ztfperiodic.utils
+
+def register_engine(cls):
+    """Class decorator adding a period-search engine to ENGINES"""
+    ENGINES[(cls.algorithm, cls.device)] = cls
+    return cls
+
+
+def get_engine(algorithm, doGPU=False, doCPU=False):
+    """Returns the engine class implementing *algorithm* on the device"""
+    if doGPU:
+        device = "GPU"
+    elif doCPU:
+        device = "CPU"
+    else:
+        raise ValueError("doGPU or doCPU required")
+
+    if not (algorithm, device) in ENGINES:
+        raise ValueError("%s not available for --do%s" % (algorithm, device))
+    return ENGINES[(algorithm, device)]
+
+
+def make_engine(algorithm, doGPU=False, doCPU=False, doCoarseToFine=False,
+                coarse_decimation=10, nfreqs_to_keep=5, cache=None,
+                **kwargs):
+    """
+    Returns an instance of the engine implementing *algorithm*, wrapped in
+    a CoarseToFineEngine with doCoarseToFine and in a CachedEngine if
+    *cache* (a ztfperiodic.cache.ResultCache) is given; the remaining
+    keyword arguments are passed to the engine.
+    """
+    engine = get_engine(algorithm, doGPU=doGPU, doCPU=doCPU)(**kwargs)
+    if doCoarseToFine:
+        engine = CoarseToFineEngine(engine, decimation=coarse_decimation,
+                                    nfreqs_to_keep=nfreqs_to_keep)
+    if cache is not None:
+        engine = CachedEngine(engine, cache)
+    return engine
 
 
 def find_periods(algorithm, lightcurves, freqs, batch_size=1,
@@ -16,769 +52,2125 @@ def find_periods(algorithm, lightcurves, freqs, batch_size=1,
                  freqs_to_remove=None,
                  phase_bins=20, mag_bins=10,
                  doParallel=False,
-                 Ncore=4):
+                 Ncore=4,
+                 freq_chunk_size=1000,
+                 freq_block_size=None,
+                 doCoarseToFine=False,
+                 coarse_decimation=10,
+                 nfreqs_to_keep=5,
+                 lightcurve_batch_size=None):
+    """
+    Returns the best periods, significances and pdots of *lightcurves*,
+    run through iter_find_periods in batches of *lightcurve_batch_size*
+    lightcurves (default all of them); *batch_size* is the batch size of
+    the engine itself (e.g. of the GPU engines).
+    """
+
+    if lightcurve_batch_size is None or lightcurve_batch_size <= 0:
+        lightcurve_batch_size = max(len(lightcurves), 1)
+
+    engine = make_engine(algorithm, doGPU=doGPU, doCPU=doCPU,
+                         doCoarseToFine=doCoarseToFine,
+                         coarse_decimation=coarse_decimation,
+                         nfreqs_to_keep=nfreqs_to_keep,
+                         batch_size=batch_size, doSaveMemory=doSaveMemory,
+                         doRemoveTerrestrial=doRemoveTerrestrial,
+                         doUsePDot=doUsePDot,
+                         doSingleTimeSegment=doSingleTimeSegment,
+                         freqs_to_remove=freqs_to_remove,
+                         phase_bins=phase_bins, mag_bins=mag_bins,
+                         doParallel=doParallel, Ncore=Ncore,
+                         freq_chunk_size=freq_chunk_size,
+                         freq_block_size=freq_block_size)
 
-    if doRemoveTerrestrial and (freqs_to_remove is not None) and not (algorithm=="LS" or algorithm=="GCE_LS_AOV" or algorithm=="GCE_LS" or algorithm=="GCE_LS_AOV_x3"):
-        for pair in freqs_to_remove:
-            idx = np.where((freqs < pair[0]) | (freqs > pair[1]))[0]
-            freqs = freqs[idx]
-
-    periods_best, significances = [], []
-    pdots = np.zeros((len(lightcurves),))
     print('Period finding lightcurves...')
-    if doGPU:
-    
-        if algorithm == "CE":
-            from cuvarbase.ce import ConditionalEntropyAsyncProcess
-    
-            proc = ConditionalEntropyAsyncProcess(use_double=True, use_fast=True, phase_bins=phase_bins, mag_bins=mag_bins, phase_overlap=1, mag_overlap=1, only_keep_best_freq=True)
-    
-            if doSaveMemory:
-                periods_best, significances = proc.batched_run_const_nfreq(lightcurves, batch_size=batch_size, freqs = freqs, only_keep_best_freq=True,show_progress=True,returnBestFreq=True)
-            else:
-
-                results = proc.batched_run_const_nfreq(lightcurves, batch_size=batch_size, freqs = freqs, only_keep_best_freq=True,show_progress=True,returnBestFreq=False)
-                cnt = 0
-                for lightcurve, out in zip(lightcurves,results):
-                    periods = 1./out[0]
-                    entropies = out[1]
-
-                    significance = np.abs(np.mean(entropies)-np.min(entropies))/np.std(entropies)
-                    period = periods[np.argmin(entropies)]
-    
-                    periods_best.append(period)
-                    significances.append(significance)
-   
-        elif algorithm == "BLS":
-            from cuvarbase.bls import eebls_gpu_fast
-            for ii,data in enumerate(lightcurves):
-                if np.mod(ii,10) == 0:
-                    print("%d/%d"%(ii,len(lightcurves)))
-                copy = np.ma.copy(data).T
-                powers = eebls_gpu_fast(copy[:,0],copy[:,1], copy[:,2],
-                                        freq_batch_size=batch_size,
-                                        freqs = freqs)
-    
-                significance = np.abs(np.mean(powers)-np.max(powers))/np.std(powers)
-                freq = freqs[np.argmax(powers)]
-                period = 1.0/freq
-    
-                periods_best.append(period)
-                significances.append(significance)
-    
-        elif algorithm == "LS":
-            from cuvarbase.lombscargle import LombScargleAsyncProcess, fap_baluev
-    
-            nfft_sigma, spp = 10, 10
-    
-            ls_proc = LombScargleAsyncProcess(use_double=True,
-                                                  sigma=nfft_sigma)
-    
-            if doSaveMemory:
-                periods_best, significances = ls_proc.batched_run_const_nfreq(lightcurves, batch_size=batch_size, use_fft=True, samples_per_peak=spp, returnBestFreq=True, freqs = freqs, doRemoveTerrestrial=doRemoveTerrestrial, freqs_to_remove=freqs_to_remove)
-            else:
-                results = ls_proc.batched_run_const_nfreq(lightcurves,
-                                                          batch_size=batch_size,
-                                                          use_fft=True,
-                                                          samples_per_peak=spp,
-                                                          returnBestFreq=False,
-                                                          freqs = freqs)
-    
-                for data, out in zip(lightcurves,results):
-                    freqs, powers = out
-                    if doRemoveTerrestrial and (freqs_to_remove is not None):
-                        for pair in freqs_to_remove:
-                            idx = np.where((freqs < pair[0]) | (freqs > pair[1]))[0]
-                            freqs = freqs[idx]
-                            powers = powers[idx]
-
-                    copy = np.ma.copy(data).T
-                    fap = fap_baluev(copy[:,0], copy[:,2], powers, np.max(freqs))
-                    idx = np.argmin(fap)
-    
-                    period = 1./freqs[idx]
-                    significance = 1./fap[idx]
-
-                    periods_best.append(period)
-                    significances.append(significance)
+    periods_best = np.zeros((len(lightcurves),))
+    significances = np.zeros((len(lightcurves),))
+    pdots = np.zeros((len(lightcurves),))
+    for idx, periods, sigs, pds in iter_find_periods(engine,
+                                                     enumerate(lightcurves),
+                                                     freqs,
+                                                     batch_size=lightcurve_batch_size):
+        periods_best[idx], significances[idx], pdots[idx] = periods, sigs, pds
+
+    return periods_best, significances, pdots
+
+
+def iter_find_periods(engine, lightcurve_iter, freqs, batch_size=1000,
+                      return_peaks=False):
+    """
+    Runs *engine* over the lightcurves of *lightcurve_iter*, which yields
+    (id, lightcurve) pairs, *batch_size* lightcurves at a time. *freqs* is
+    an array or a FrequencyGrid.
+
+    Yields (ids, periods, significances, pdots) for each batch as soon as
+    it is done, so that only one batch of lightcurves (and periodograms)
+    needs to be held in memory and the results can be processed or
+    written out while the next batch is read. With return_peaks, the
+    engine's batch_peaks dictionary is appended to each tuple.
+    """
+    def run_batch(ids, lightcurves):
+        periods_best, significances, pdots = engine.run_batch(lightcurves)
+        periods_best = np.array(periods_best).flatten()
+        results = (np.array(ids), periods_best,
+                   np.array(significances).flatten(),
+                   np.array(pdots).flatten())
+        if return_peaks:
+            results = results + (engine.batch_peaks(periods_best),)
+        return results
+
+    engine.set_grid(engine.make_grid(freqs))
+    try:
+        ids, lightcurves = [], []
+        for objid, lightcurve in lightcurve_iter:
+            ids.append(objid)
+            lightcurves.append(lightcurve)
+            if len(lightcurves) < batch_size:
+                continue
+
+            yield run_batch(ids, lightcurves)
+            ids, lightcurves = [], []
+
+        if len(lightcurves) > 0:
+            yield run_batch(ids, lightcurves)
+    finally:
+        engine.finalize()
+
+
+class PeriodSearchEngine(object):
+    """
+    Base class of the period-search engines.
+
+    An engine is set up once with set_grid(grid), which calls
+    prepare(freqs) on the frequencies of the FrequencyGrid *grid* to do the
+    (lazy) imports and anything that only depends on the frequency grid,
+    then
+    run_batch(lightcurves) returns the best periods, significances and
+    pdots of a batch of lightcurves, batch_peaks(periods_best) the
+    *npeaks* best peaks and the *summary_bins* bins max-pooled periodogram
+    of that batch, and finalize() releases resources.
+
+    Capabilities are declared as class attributes:
+        device : "CPU" or "GPU"
+        supports_pdot : searches over period derivatives with doUsePDot
+        float32 : computes in single precision
+        chunked : the frequency grid can be evaluated in independent chunks
+        shared_epochs : benefits from lightcurves with common epochs
+        regular_grid : needs the full regular grid (grid.freqs_all); the
+            excluded frequencies are dropped from its output with
+            grid.keep. Other engines only see the kept frequencies.
+    """
+
+    algorithm = None
+    device = None
+    supports_pdot = False
+    float32 = False
+    chunked = False
+    shared_epochs = False
+    regular_grid = False
+
+    def __init__(self, batch_size=1, doSaveMemory=False,
+                 doRemoveTerrestrial=False, doUsePDot=False,
+                 doSingleTimeSegment=False, freqs_to_remove=None,
+                 phase_bins=20, mag_bins=10, doParallel=False, Ncore=4,
+                 freq_chunk_size=1000, freq_block_size=None, npeaks=1,
+                 summary_bins=0):
+        self.batch_size = batch_size
+        self.doSaveMemory = doSaveMemory
+        self.doRemoveTerrestrial = doRemoveTerrestrial
+        self.doUsePDot = doUsePDot
+        self.doSingleTimeSegment = doSingleTimeSegment
+        self.freqs_to_remove = freqs_to_remove
+        self.phase_bins = phase_bins
+        self.mag_bins = mag_bins
+        self.doParallel = doParallel
+        self.Ncore = Ncore
+        self.freq_chunk_size = freq_chunk_size
+        self.freq_block_size = freq_block_size
+        self.npeaks = npeaks
+        self.summary_bins = summary_bins
+
+    def prepare(self, freqs):
+        self.freqs = freqs
+
+    def run_batch(self, lightcurves):
+        raise NotImplementedError
+
+    def batch_peaks(self, periods_best):
+        """Returns the peaks of the last batch, see get_peaks; engines
+        without full periodograms only report their best period"""
+        return get_peaks(periods_best, self.npeaks, self.summary_bins)
+
+    def config_key(self):
+        """Returns a string identifying the settings that change the
+        results of the engine"""
+        return str((type(self).__name__, self.algorithm, self.device,
+                    self.doRemoveTerrestrial, self.freqs_to_remove,
+                    self.doUsePDot, self.doSingleTimeSegment,
+                    self.phase_bins, self.mag_bins,
+                    self.npeaks, self.summary_bins))
+
+    def finalize(self):
+        pass
+
+    def make_grid(self, freqs):
+        """Returns the FrequencyGrid of *freqs*, excluding freqs_to_remove
+        with doRemoveTerrestrial"""
+        if isinstance(freqs, FrequencyGrid):
+            return freqs
+        if self.doRemoveTerrestrial:
+            return FrequencyGrid(freqs, freqs_to_remove=self.freqs_to_remove)
+        return FrequencyGrid(freqs)
+
+    def set_grid(self, grid):
+        self.grid = grid
+        if self.regular_grid:
+            self.prepare(grid.freqs_all)
+        else:
+            self.prepare(grid.freqs)
+
+
+class PeriodogramEngine(PeriodSearchEngine):
+    """
+    Base class of the engines that compute full periodograms on the CPU.
+
+    Subclasses implement periodogram(lightcurves), returning an array of
+    shape (len(lightcurves), len(self.freqs)); rows of lightcurves that
+    cannot be analyzed are NaN. The best frequency maximizes the
+    statistic (minimizes it if maximize is False).
+
+    With freq_block_size, the grid is evaluated in blocks of that many
+    frequencies and the statistics needed for the significance are carried
+    across blocks by a PeriodogramAccumulator, so that the memory use does
+    not depend on the size of the grid.
+    """
+
+    device = "CPU"
+    chunked = True
+    maximize = True
+
+    def periodogram(self, lightcurves):
+        raise NotImplementedError
+
+    def significance(self, lightcurves, accumulator):
+        """Returns the index of the best frequency and its significance"""
+        return accumulator.peak_index[:,0], accumulator.significance()
+
+    def accumulate(self, lightcurves, accumulator):
+        freqs = self.freqs
+        self.fmax = np.max(freqs)
+        if not self.freq_block_size or self.freq_block_size >= len(freqs):
+            accumulator.update(self.periodogram(lightcurves))
+            accumulator.finalize()
+            return accumulator
+
+        nblocks = int(np.ceil(len(freqs)/self.freq_block_size))
+        for idx in np.array_split(np.arange(len(freqs)), nblocks):
+            self.prepare(freqs[idx])
+            accumulator.update(self.periodogram(lightcurves), offset=idx[0])
+        self.prepare(freqs)
+        accumulator.finalize()
+
+        return accumulator
+
+    def make_accumulator(self, nlightcurves):
+        """Returns the accumulator of a batch; the *npeaks* peaks are
+        distinct local extrema"""
+        return PeriodogramAccumulator(nlightcurves, maximize=self.maximize,
+                                      npeaks=self.npeaks,
+                                      local_peaks=self.npeaks > 1,
+                                      nsummary=self.summary_bins,
+                                      nfreqs=len(self.freqs))
+
+    def batch_peaks(self, periods_best):
+        accumulator = self.accumulator
+        peak_freqs = self.freqs[accumulator.peak_index]
+        peak_freqs[np.isnan(accumulator.peak_value)] = np.nan
+
+        return {"peak_freqs": peak_freqs,
+                "peak_stats": accumulator.peak_value,
+                "summary": accumulator.summary,
+                "summary_freqs": get_summary_freqs(self.freqs,
+                                                   self.summary_bins)}
+
+    def run_batch(self, lightcurves):
+        accumulator = self.make_accumulator(len(lightcurves))
+        self.accumulate(lightcurves, accumulator)
+        self.accumulator = accumulator
+        idx, significances = self.significance(lightcurves, accumulator)
+
+        periods_best = 1.0/self.freqs[idx]
+        periods_best[significances < 0] = -1
+        pdots = np.zeros((len(lightcurves),))
+
+        return periods_best, significances, pdots
+
+
+class PeriodogramAccumulator(object):
+    """
+    Streaming statistics of a batch of periodograms evaluated in blocks of
+    frequencies.
+
+    The mean and variance of each periodogram are merged block by block
+    with the parallel form of Welford's algorithm (Chan et al. 1979), and
+    the *npeaks* best values are kept with their grid indices, so that the
+    significance |mean - extremum| / std is the same as if the whole
+    periodogram had been computed at once. Non-finite values are left out
+    of the mean and variance, and blocks of a periodogram with no finite
+    value (lightcurves that could not be analyzed) are ignored.
+
+    With local_peaks, only local extrema are kept, so that the *npeaks*
+    peaks are distinct: a value is a peak if it is strictly better than its
+    left neighbour and at least as good as its right one, so a plateau
+    counts once, at its first index. The last value of each block is held
+    back until its right neighbour is known, and finalize() must be called
+    after the last block. With *nsummary* > 0, the periodograms of *nfreqs*
+    frequencies are also max-pooled (min-pooled if not maximize) into
+    *nsummary* bins of consecutive frequencies.
+    """
+
+    def __init__(self, nlightcurves, maximize=True, npeaks=1,
+                 local_peaks=False, nsummary=0, nfreqs=None):
+        self.maximize = maximize
+        self.npeaks = npeaks
+        self.local_peaks = local_peaks
+        self.nsummary = nsummary
+        self.nfreqs = nfreqs
+        self.count = np.zeros(nlightcurves)
+        self.mean = np.zeros(nlightcurves)
+        self.m2 = np.zeros(nlightcurves)
+        self.peak_index = np.zeros((nlightcurves, npeaks), dtype=int)
+        self.peak_value = np.full((nlightcurves, npeaks), np.nan)
+        # last two values seen and the grid index of the last one
+        self.tail = np.full((nlightcurves, 2), np.nan)
+        self.tail_index = np.zeros(nlightcurves, dtype=int)
+        self.summary = np.full((nlightcurves, nsummary), np.nan)
+
+    def key(self, stats):
+        """Sort key of *stats*: larger is better, NaN is worst"""
+        key = stats if self.maximize else -stats
+        return np.where(np.isnan(key), -np.inf, key)
+
+    def select(self, stats, rows):
+        """Returns the *rows* (default all) of the block *stats* that have
+        a finite value, and their stats"""
+        stats = np.atleast_2d(stats)
+        if rows is None:
+            rows = np.arange(len(self.count))
+        finite = np.any(np.isfinite(stats), axis=1)
+        return np.asarray(rows)[finite], stats[finite]
+
+    def update(self, stats, offset=0, rows=None):
+        """Adds the block *stats* of the periodograms (of the lightcurves
+        *rows*, default all), which starts at index *offset* of the
+        frequency grid"""
+        self.update_moments(stats, rows=rows)
+        self.update_peaks(stats, offset=offset, rows=rows)
+
+    def update_moments(self, stats, rows=None):
+        """Adds the block *stats* to the mean and variance only"""
+        rows, stats = self.select(stats, rows)
+        if len(rows) == 0:
+            return
+
+        with np.errstate(invalid='ignore'):
+            finite = np.isfinite(stats)
+            nb = np.sum(finite, axis=1)
+            mean = np.sum(np.where(finite, stats, 0), axis=1)/nb
+            m2 = np.sum(np.where(finite, stats - mean[:,np.newaxis], 0)**2,
+                        axis=1)
+
+            na = self.count[rows]
+            n = na + nb
+            delta = mean - self.mean[rows]
+            self.mean[rows] += delta*nb/n
+            self.m2[rows] += m2 + delta**2*na*nb/n
+            self.count[rows] = n
+
+    def update_peaks(self, stats, offset=0, rows=None):
+        """Adds the block *stats* to the peaks and the summary only (e.g.
+        the fine grid of a CoarseToFineEngine, whose mean and variance
+        come from its coarse grid); with local_peaks, the blocks must be
+        consecutive"""
+        rows, stats = self.select(stats, rows)
+        if len(rows) == 0:
+            return
+
+        if self.nsummary > 0:
+            self.pool(stats, offset, rows)
+
+        if self.local_peaks:
+            # candidates are the previous last value and all but the last
+            # value of this block, whose two neighbours are known
+            stats_ext = np.hstack((self.tail[rows], stats))
+            key_ext = self.key(stats_ext)
+            is_peak = ((key_ext[:,1:-1] > key_ext[:,:-2]) &
+                       (key_ext[:,1:-1] >= key_ext[:,2:]) &
+                       np.isfinite(key_ext[:,1:-1]))
+            candidates = np.where(is_peak, stats_ext[:,1:-1], np.nan)
+            self.tail[rows] = stats_ext[:,-2:]
+            self.tail_index[rows] = offset + stats.shape[1] - 1
+            self.merge(rows, candidates, offset - 1)
+        else:
+            self.merge(rows, stats, offset)
+
+    def merge(self, rows, stats, offset):
+        """Merges the best values of *stats*, whose first column is index
+        *offset* of the grid, with the peaks kept for *rows*"""
+        key = self.key(stats)
+        if self.npeaks == 1:
+            idx = np.argmax(key, axis=1)[:,np.newaxis]
+        else:
+            idx = np.argsort(-key, axis=1, kind='stable')[:,:self.npeaks]
+        value = np.take_along_axis(stats, idx, axis=1)
+        idx = idx + offset
+
+        # merge with the peaks of the previous blocks (NaN until the first
+        # peak is found); on ties the lower frequency index wins, as with
+        # np.argmax over the whole grid
+        idx = np.hstack((self.peak_index[rows], idx))
+        value = np.hstack((self.peak_value[rows], value))
+        key = self.key(value)
+        order = np.lexsort((idx, -key), axis=1)[:,:self.npeaks]
+        self.peak_index[rows] = np.take_along_axis(idx, order, axis=1)
+        self.peak_value[rows] = np.take_along_axis(value, order, axis=1)
+
+    def pool(self, stats, offset, rows):
+        """Max-pools the block *stats* into the summary bins"""
+        bins = (np.arange(offset, offset + stats.shape[1]) *
+                self.nsummary) // self.nfreqs
+        starts = np.where(np.diff(bins, prepend=-1) != 0)[0]
+        reduce = np.fmax if self.maximize else np.fmin
+        with np.errstate(invalid='ignore'):
+            pooled = reduce.reduceat(stats, starts, axis=1)
+        bins = bins[starts]
+        self.summary[rows[:,np.newaxis], bins] = reduce(
+            self.summary[rows[:,np.newaxis], bins], pooled)
+
+    def finalize(self):
+        """With local_peaks, adds the last value of each periodogram if it
+        is a peak"""
+        if not self.local_peaks:
+            return
+        rows = np.where(self.count > 0)[0]
+        if len(rows) == 0:
+            return
+        key = self.key(self.tail[rows])
+        is_peak = (key[:,1] > key[:,0]) & np.isfinite(key[:,1])
+        candidates = np.where(is_peak, self.tail[rows,1], np.nan)
+        self.merge(rows, candidates[:,np.newaxis],
+                   self.tail_index[rows][:,np.newaxis])
+        self.tail[rows] = np.nan
+
+    def std(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.m2/self.count)
+
+    def significance(self):
+        """Returns |mean - extremum| / std, or -1 for empty rows"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            significances = np.abs(self.mean-self.peak_value[:,0])/self.std()
+        significances[self.count == 0] = -1
+        return significances
+
+
+def calc_significances(stats, maximize=True):
+    """
+    Returns the index of the best frequency of each periodogram of the 2-D
+    block *stats* (lightcurves x frequencies) and its significance
+    |mean - extremum| / std, from vectorized reductions over the block;
+    rows with no finite value get a significance of -1. Periodograms
+    streamed in chunks of frequencies go through a PeriodogramAccumulator
+    directly.
+    """
+    accumulator = PeriodogramAccumulator(len(stats), maximize=maximize)
+    accumulator.update(stats)
+    return accumulator.peak_index[:,0], accumulator.significance()
+
+
+def calc_top_frequencies(stats, nfreqs):
+    """
+    Returns the indices of the *nfreqs* frequencies of each periodogram of
+    the 2-D block *stats* whose values deviate most from the mean of the
+    periodogram, |mean - stats| / std, in either direction (NaN last).
+    """
+    stats = np.atleast_2d(stats)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        significance = np.abs(np.mean(stats, axis=1)[:,np.newaxis] - stats)/np.std(stats, axis=1)[:,np.newaxis]
+    significance = np.where(np.isnan(significance), -np.inf, significance)
+    return np.argsort(-significance, axis=1, kind='stable')[:,:nfreqs]
+
+
+class FrequencyGrid(object):
+    """
+    Frequency grid with the excluded bands (e.g. terrestrial aliases)
+    precomputed once.
+
+    freqs_all : the full (regular) grid
+    keep : boolean mask of the frequencies of freqs_all outside of the
+        bands of freqs_to_remove
+    freqs : the kept frequencies, freqs_all[keep]
+
+    The engines that need the regular runs of the kept frequencies find
+    them with get_regular_segments, which also works on the coarse and
+    refined grids of a CoarseToFineEngine.
+    """
+
+    def __init__(self, freqs, freqs_to_remove=None):
+        self.freqs_all = np.asarray(freqs, dtype=float)
+        self.keep = np.ones(self.freqs_all.shape, dtype=bool)
+        if freqs_to_remove is not None:
+            for pair in freqs_to_remove:
+                self.keep[(self.freqs_all >= pair[0]) &
+                          (self.freqs_all <= pair[1])] = False
+        self.freqs = self.freqs_all[self.keep]
+
+    def __len__(self):
+        return len(self.freqs)
+
+
+def get_regular_segments(freqs, rtol=1e-6):
+    """
+    Returns the smallest step df of *freqs* and the (start, stop) index
+    ranges of its runs with a constant step df; the runs are separated by
+    the excluded bands of a FrequencyGrid.
+    """
+    freqs = np.atleast_1d(freqs)
+    if len(freqs) < 2:
+        return 1.0, [(0, len(freqs))]
+
+    steps = np.diff(freqs)
+    df = np.min(steps)
+    breaks = np.where(~np.isclose(steps, df, rtol=rtol, atol=0))[0] + 1
+    starts = np.append(0, breaks)
+    stops = np.append(breaks, len(freqs))
+
+    return df, list(zip(starts, stops))
+
+
+def get_pdots_to_test(doUsePDot, num_pdots=10, min_pdot=1e-12, max_pdot=1e-10):
+    """Returns the period derivatives tested with doUsePDot"""
+    if doUsePDot:
+        pdots_to_test = -np.logspace(np.log10(min_pdot), np.log10(max_pdot), num_pdots)
+        pdots_to_test = np.append(0,pdots_to_test)
+    else:
+        pdots_to_test = np.array([0.0])
+    return pdots_to_test
+
+
+def stack_lightcurves(lightcurves, doSingleTimeSegment=False):
+    """
+    Returns the lightcurves as a LightcurveBatch, sorted in time and
+    referenced to their first epoch or, with doSingleTimeSegment, all
+    placed on the union of their epochs with missing epochs set to 999;
+    also returns the maximum number of epochs.
+
+    The union of the epochs is built with one np.unique of all the times,
+    the position of every sample in it is found with np.searchsorted, and
+    the padded (sources x epochs) magnitude and error matrices are filled
+    in one assignment each.
+    """
+    from ztfperiodic.batch import LightcurveBatch
+
+    batch = LightcurveBatch.from_lightcurves(lightcurves)
+    if not doSingleTimeSegment:
+        batch = batch.sorted().zero_pointed()
+        return batch, batch.maxn
+
+    tt = np.unique(batch.t)
+    idx = np.searchsorted(tt, batch.t)
+
+    mag_array = np.full((len(batch), len(tt)), 999.0)
+    magerr_array = np.full((len(batch), len(tt)), 999.0)
+    mag_array[batch.segments, idx] = batch.y
+    magerr_array[batch.segments, idx] = batch.dy
+
+    offsets = len(tt)*np.arange(len(batch)+1)
+    batch = LightcurveBatch(np.tile(tt, len(batch)), mag_array.ravel(),
+                            magerr_array.ravel(), offsets)
+
+    return batch, batch.maxn
+
+
+def normalize_mag(mag):
+    """Min-max normalization of the magnitudes to [0, 1]"""
+    return (mag - np.min(mag))/(np.max(mag)-np.min(mag))
+
+
+def resample_lightcurves(lightcurves, T, duration):
+    """
+    Interpolates every lightcurve onto a regular grid of cadence *T* over
+    the window of length *duration* containing the most epochs, then
+    subtracts the median and applies a Hann window.
+
+    All lightcurves are interpolated with a single np.interp call: each is
+    shifted to start at zero and offset by a multiple of the longest
+    baseline, and the grid points are clipped to each lightcurve's own
+    time range, so the edge values are held as for separate calls.
+
+    Returns the resampled magnitudes, shape [n_lightcurves, N], and a mask
+    of the lightcurves with at least two epochs.
+    """
+
+    x = np.arange(0.0, duration, T)
+    nlc = len(lightcurves)
+
+    valid = np.array([len(lightcurve[0]) >= 2 for lightcurve in lightcurves])
+    y = np.zeros((nlc, len(x)))
+    if not np.any(valid):
+        return y, valid
+
+    ts, ys, starts, ends, offsets = [], [], [], [], []
+    for lightcurve in lightcurves:
+        if len(lightcurve[0]) < 2:
+            continue
+        idx = np.argsort(lightcurve[0])
+        t = lightcurve[0][idx] - lightcurve[0][idx[0]]
+        # densest window: the number of epochs within duration of each epoch
+        counts = np.searchsorted(t, t + duration) - np.arange(len(t))
+        starts.append(t[np.argmax(counts)])
+        ends.append(t[-1])
+        ts.append(t)
+        ys.append(lightcurve[1][idx])
+
+    span = np.max(ends) + duration + 1.0
+    shift = span * np.arange(len(ts))
+    starts, ends = np.array(starts), np.array(ends)
+
+    xs = np.clip(starts[:, np.newaxis] + x, 0.0, ends[:, np.newaxis])
+    tt = np.concatenate([t + s for t, s in zip(ts, shift)])
+    yy = np.concatenate(ys)
+    y_valid = np.interp(xs + shift[:, np.newaxis], tt, yy)
+
+    y_valid = y_valid - np.median(y_valid, axis=1)[:, np.newaxis]
+    y[valid] = y_valid * np.hanning(len(x))
+
+    return y, valid
+
+
+def print_batch_info(nlightcurves, maxn, batch_size, nfreqs, phase_bins,
+                     mag_bins):
+    print("Number of lightcurves: %d" % nlightcurves)
+    print("Max length of lightcurves: %d" % maxn)
+    print("Batch size: %d" % batch_size)
+    print("Number of frequency bins: %d" % nfreqs)
+    print("Number of phase bins: %d" % phase_bins)
+    print("Number of magnitude bins: %d" % mag_bins)
+
+
+def find_peaks(stat, npeaks, maximize=True):
+    """
+    Returns the indices of the *npeaks* highest local maxima of *stat*
+    (lowest local minima if maximize is False), best first and the lowest
+    index first on ties. Non-finite values are never selected, and a
+    plateau counts once, at its first index.
+    """
+    stat = np.asarray(stat, dtype=float)
+    if not maximize:
+        stat = -stat
+    stat = np.where(np.isfinite(stat), stat, -np.inf)
+
+    is_peak = np.ones(stat.shape, dtype=bool)
+    is_peak[1:] &= stat[1:] > stat[:-1]
+    is_peak[:-1] &= stat[:-1] >= stat[1:]
+    is_peak &= np.isfinite(stat)
+
+    idx = np.where(is_peak)[0]
+    idx = idx[np.argsort(-stat[idx], kind='stable')]
+    return idx[:npeaks]
+
+
+def get_peaks(periods_best, npeaks=1, summary_bins=0):
+    """
+    Returns the peaks of a batch of engines that only find the best period:
+    its frequency as the first of the *npeaks* peak frequencies (NaN where
+    no period was found), and NaN for the peak statistics and the
+    *summary_bins* bins periodogram summary.
+    """
+    periods_best = np.asarray(periods_best, dtype=float).flatten()
+    nlc = len(periods_best)
+
+    peak_freqs = np.full((nlc, npeaks), np.nan)
+    found = periods_best > 0
+    peak_freqs[found,0] = 1.0/periods_best[found]
+
+    return {"peak_freqs": peak_freqs,
+            "peak_stats": np.full((nlc, npeaks), np.nan),
+            "summary": np.full((nlc, summary_bins), np.nan),
+            "summary_freqs": np.full((summary_bins,), np.nan)}
+
+
+def get_summary_freqs(freqs, summary_bins):
+    """Returns the lowest frequency of each of the *summary_bins* bins of
+    the periodogram summary of *freqs*"""
+    summary_freqs = np.full((summary_bins,), np.nan)
+    if summary_bins == 0:
+        return summary_freqs
+    bins = np.arange(len(freqs))*summary_bins // len(freqs)
+    starts = np.where(np.diff(bins, prepend=-1) != 0)[0]
+    summary_freqs[bins[starts]] = freqs[starts]
+    return summary_freqs
+
+
+def get_refinement_windows(idx, halfwidth, nfreqs):
+    """
+    Returns the union of the windows idx +- halfwidth of a grid of *nfreqs*
+    frequencies, as a list of contiguous index arrays.
+    """
+    windows = np.unique(np.concatenate([np.arange(ii-halfwidth, ii+halfwidth+1)
+                                        for ii in np.atleast_1d(idx)]))
+    windows = windows[(windows >= 0) & (windows < nfreqs)]
+    return np.split(windows, np.where(np.diff(windows) > 1)[0]+1)
+
+
+class CoarseToFineEngine(PeriodSearchEngine):
+    """
+    Hierarchical search wrapping a PeriodogramEngine.
+
+    The wrapped engine is first run on the grid decimated by *decimation*;
+    the *nfreqs_to_keep* best peaks of each lightcurve are then refined at
+    full resolution over +- decimation bins of the full grid. The mean and
+    standard deviation of the significance come from the coarse periodogram
+    only (the refined windows sample the peaks, not the periodogram), and
+    the extremum from the coarse periodogram and the refined windows. The
+    windows of all of the lightcurves of a batch are evaluated together,
+    for the whole batch, so the number of frequencies evaluated per
+    lightcurve is about len(freqs)/decimation plus
+    2*nfreqs_to_keep*decimation per lightcurve of the batch (at most
+    len(freqs)), instead of len(freqs).
+
+    A peak is about 1/baseline wide, so the coarse grid must keep at least
+    *coarse_samples_per_peak* samples per 1/baseline for the peaks not to
+    fall between its samples: the decimation of a batch is reduced (down
+    to 1, the full grid) when the grid is not oversampled enough for the
+    longest baseline of the batch.
+    """
+
+    def __init__(self, engine, decimation=10, nfreqs_to_keep=5,
+                 coarse_samples_per_peak=2):
+        if not isinstance(engine, PeriodogramEngine):
+            raise ValueError("coarse-to-fine search not available for %s on the %s" % (engine.algorithm, engine.device))
+
+        self.engine = engine
+        self.decimation = decimation
+        self.nfreqs_to_keep = nfreqs_to_keep
+        self.coarse_samples_per_peak = coarse_samples_per_peak
+        self.warned = False
+
+        self.algorithm = engine.algorithm
+        self.device = engine.device
+        self.npeaks = engine.npeaks
+        self.summary_bins = engine.summary_bins
+
+    def make_grid(self, freqs):
+        return self.engine.make_grid(freqs)
+
+    def set_grid(self, grid):
+        self.grid = grid
+        self.engine.grid = grid
+        self.prepare(grid.freqs)
+
+    def prepare(self, freqs):
+        self.freqs = freqs
+        self.df = np.median(np.diff(freqs)) if len(freqs) > 1 else np.inf
+
+    def get_decimation(self, lightcurves):
+        """Returns the decimation of the batch: at most self.decimation,
+        with coarse_samples_per_peak coarse samples per 1/baseline"""
+        baseline = np.max([np.ptp(lightcurve[0]) if len(lightcurve[0]) > 0
+                           else 0.0 for lightcurve in lightcurves])
+        if not baseline > 0:
+            return self.decimation
+        oversampling = 1.0/(baseline*self.df)
+        decimation = int(np.clip(oversampling/self.coarse_samples_per_peak,
+                                 1, self.decimation))
+        if decimation < self.decimation and not self.warned:
+            print("Coarse-to-fine: the grid has %.1f samples per peak, "
+                  "using a decimation of %d instead of %d" %
+                  (oversampling, decimation, self.decimation))
+            self.warned = True
+        return decimation
+
+    def run_batch(self, lightcurves):
+        engine = self.engine
+        pdots = np.zeros((len(lightcurves),))
+
+        decimation = self.get_decimation(lightcurves)
+        coarse = np.arange(0, len(self.freqs), decimation)
+        engine.prepare(self.freqs[coarse])
+        engine.fmax = np.max(self.freqs)
+        coarse_stats = engine.periodogram(lightcurves)
+
+        # the refinement windows of all of the lightcurves are evaluated
+        # at once, for the whole batch, and merged with the coarse grid
+        # into one increasing sub-grid of self.freqs
+        fine = coarse
+        if decimation > 1:
+            idx = [coarse[find_peaks(stat, self.nfreqs_to_keep,
+                                     maximize=engine.maximize)]
+                   for stat in coarse_stats]
+            idx = np.concatenate(idx)
+            if len(idx) > 0:
+                windows = np.concatenate(get_refinement_windows(
+                    idx, decimation, len(self.freqs)))
+                fine = np.union1d(coarse, windows)
+
+        stats = np.full((len(lightcurves), len(fine)), np.nan)
+        stats[:, np.searchsorted(fine, coarse)] = coarse_stats
+        if len(fine) > len(coarse):
+            engine.prepare(self.freqs[windows])
+            stats[:, np.searchsorted(fine, windows)] = engine.periodogram(
+                lightcurves)
+
+        # the mean and standard deviation come from the coarse grid, the
+        # peaks from the merged grid
+        engine.freqs = self.freqs[fine]
+        accumulator = engine.make_accumulator(len(lightcurves))
+        accumulator.update_peaks(stats)
+        accumulator.finalize()
+        accumulator.update_moments(coarse_stats)
+
+        idx, significances = engine.significance(lightcurves, accumulator)
+        periods_best = 1.0/engine.freqs[idx]
+        periods_best[significances < 0] = -1
+
+        return periods_best, significances, pdots
+
+    def config_key(self):
+        return str(("CoarseToFine", self.decimation, self.nfreqs_to_keep,
+                    self.coarse_samples_per_peak, self.engine.config_key()))
+
+    def finalize(self):
+        self.engine.finalize()
+
+
+class CachedEngine(PeriodSearchEngine):
+    """
+    Wraps an engine with a ztfperiodic.cache.ResultCache: the results of
+    each lightcurve (best period, significance, pdot and peaks) are stored
+    under the hash of its arrays, the frequency grid and the engine
+    settings, and only the lightcurves not found in the cache are run.
+    """
+
+    def __init__(self, engine, cache):
+        self.engine = engine
+        self.cache = cache
+
+        self.algorithm = engine.algorithm
+        self.device = engine.device
+        self.npeaks = engine.npeaks
+        self.summary_bins = engine.summary_bins
+
+    def make_grid(self, freqs):
+        return self.engine.make_grid(freqs)
+
+    def set_grid(self, grid):
+        self.grid = grid
+        self.engine.set_grid(grid)
+        self.freqs = self.engine.freqs
+        self.grid_key = self.cache.make_key(grid.freqs_all, grid.keep,
+                                            self.engine.config_key())
+
+    def run_batch(self, lightcurves):
+        keys = [self.cache.make_key(self.grid_key,
+                                    *[np.asarray(x) for x in lightcurve[:3]])
+                for lightcurve in lightcurves]
+        results = [self.cache.get(key) for key in keys]
+
+        missing = [ii for ii, result in enumerate(results) if result is None]
+        if len(missing) > 0:
+            periods_best, significances, pdots = self.engine.run_batch(
+                [lightcurves[ii] for ii in missing])
+            periods_best = np.array(periods_best).flatten()
+            significances = np.array(significances).flatten()
+            pdots = np.array(pdots).flatten()
+            peaks = self.engine.batch_peaks(periods_best)
+
+            for jj, ii in enumerate(missing):
+                results[ii] = {"period": periods_best[jj],
+                               "significance": significances[jj],
+                               "pdot": pdots[jj],
+                               "peak_freqs": peaks["peak_freqs"][jj],
+                               "peak_stats": peaks["peak_stats"][jj],
+                               "summary": peaks["summary"][jj],
+                               "summary_freqs": peaks["summary_freqs"]}
+                self.cache.put(keys[ii], results[ii])
+
+        self.peaks = {key: np.array([result[key] for result in results])
+                      for key in ["peak_freqs", "peak_stats", "summary"]}
+        self.peaks["summary_freqs"] = results[0]["summary_freqs"]
+
+        return (np.array([result["period"] for result in results]),
+                np.array([result["significance"] for result in results]),
+                np.array([result["pdot"] for result in results]))
+
+    def batch_peaks(self, periods_best):
+        return self.peaks
+
+    def finalize(self):
+        self.engine.finalize()
+        self.cache.evict()
+
+
+# -- GPU engines --------------------------------------------------------------
+
+@register_engine
+class CEGPUEngine(PeriodSearchEngine):
+    algorithm = "CE"
+    device = "GPU"
+
+    def prepare(self, freqs):
+        from cuvarbase.ce import ConditionalEntropyAsyncProcess
+
+        self.freqs = freqs
+        self.proc = ConditionalEntropyAsyncProcess(use_double=True, use_fast=True, phase_bins=self.phase_bins, mag_bins=self.mag_bins, phase_overlap=1, mag_overlap=1, only_keep_best_freq=True)
+
+    def run_batch(self, lightcurves):
+        periods_best, significances = [], []
+        pdots = np.zeros((len(lightcurves),))
+
+        if self.doSaveMemory:
+            periods_best, significances = self.proc.batched_run_const_nfreq(lightcurves, batch_size=self.batch_size, freqs = self.freqs, only_keep_best_freq=True,show_progress=True,returnBestFreq=True)
+        else:
+            results = self.proc.batched_run_const_nfreq(lightcurves, batch_size=self.batch_size, freqs = self.freqs, only_keep_best_freq=True,show_progress=True,returnBestFreq=False)
+            entropies = np.array([out[1] for out in results])
+            idx, significances = calc_significances(entropies, maximize=False)
+            periods_best = np.array([1./out[0][ii] for out, ii in zip(results, idx)])
+
+        return periods_best, significances, pdots
+
+
+@register_engine
+class BLSGPUEngine(PeriodSearchEngine):
+    algorithm = "BLS"
+    device = "GPU"
+
+    def prepare(self, freqs):
+        from cuvarbase.bls import eebls_gpu_fast
+
+        self.freqs = freqs
+        self.eebls_gpu_fast = eebls_gpu_fast
+
+    def run_batch(self, lightcurves):
+        pdots = np.zeros((len(lightcurves),))
+
+        powers = []
+        for ii,data in enumerate(lightcurves):
+            if np.mod(ii,10) == 0:
+                print("%d/%d"%(ii,len(lightcurves)))
+            copy = np.ma.copy(data).T
+            powers.append(self.eebls_gpu_fast(copy[:,0],copy[:,1], copy[:,2],
+                                              freq_batch_size=self.batch_size,
+                                              freqs = self.freqs))
+
+        idx, significances = calc_significances(np.array(powers))
+        periods_best = 1.0/self.freqs[idx]
+
+        return periods_best, significances, pdots
+
+
+@register_engine
+class LSGPUEngine(PeriodSearchEngine):
+    algorithm = "LS"
+    device = "GPU"
+    regular_grid = True
+
+    def prepare(self, freqs):
+        from cuvarbase.lombscargle import LombScargleAsyncProcess
+        from ztfperiodic.mylombscargle import FAP_baluev_batch
+
+        self.freqs = freqs
+        self.FAP_baluev_batch = FAP_baluev_batch
+        nfft_sigma, self.spp = 10, 10
+        self.ls_proc = LombScargleAsyncProcess(use_double=True,
+                                               sigma=nfft_sigma)
+
+    def run_batch(self, lightcurves):
+        periods_best, significances = [], []
+        pdots = np.zeros((len(lightcurves),))
+
+        if self.doSaveMemory:
+            periods_best, significances = self.ls_proc.batched_run_const_nfreq(lightcurves, batch_size=self.batch_size, use_fft=True, samples_per_peak=self.spp, returnBestFreq=True, freqs = self.freqs, doRemoveTerrestrial=self.doRemoveTerrestrial, freqs_to_remove=self.freqs_to_remove)
+        else:
+            results = self.ls_proc.batched_run_const_nfreq(lightcurves,
+                                                           batch_size=self.batch_size,
+                                                           use_fft=True,
+                                                           samples_per_peak=self.spp,
+                                                           returnBestFreq=False,
+                                                           freqs = self.freqs)
 
-            ls_proc.finish()
-    
-        elif algorithm == "PDM":
-            from cuvarbase.pdm import PDMAsyncProcess
-    
-            kind, nbins = 'binned_linterp', 10
-    
-            pdm_proc = PDMAsyncProcess()
-            for lightcurve in lightcurves:
-                results = pdm_proc.run([lightcurve], kind=kind, nbins=nbins)
-                pdm_proc.finish()
-                powers = results[0]
-    
-                significance = np.abs(np.mean(powers)-np.max(powers))/np.std(powers)
-                freq = freqs[np.argmax(powers)]
-                period = 1.0/freq
-    
+            keep = self.grid.keep
+            freqs = results[0][0][keep]
+            powers = np.array([out[1][keep] for out in results])
+
+            accumulator = PeriodogramAccumulator(len(lightcurves))
+            accumulator.update(powers)
+            idx, significances = calc_fap_significance(lightcurves, freqs,
+                                                       accumulator,
+                                                       self.FAP_baluev_batch)
+            periods_best = 1./freqs[idx]
+
+        return periods_best, significances, pdots
+
+    def finalize(self):
+        self.ls_proc.finish()
+
+
+@register_engine
+class PDMGPUEngine(PeriodSearchEngine):
+    algorithm = "PDM"
+    device = "GPU"
+
+    def prepare(self, freqs):
+        from cuvarbase.pdm import PDMAsyncProcess
+        from cuvarbase.utils import weights
+
+        self.freqs = freqs
+        self.weights = weights
+        self.kind, self.nbins = 'binned_linterp', 10
+        self.pdm_proc = PDMAsyncProcess()
+
+    def run_batch(self, lightcurves):
+        pdots = np.zeros((len(lightcurves),))
+
+        powers = []
+        for t, y, dy in lightcurves:
+            lightcurve = (t, y, self.weights(np.ones(dy.shape)), self.freqs)
+            results = self.pdm_proc.run([lightcurve], kind=self.kind,
+                                        nbins=self.nbins)
+            self.pdm_proc.finish()
+            powers.append(results[0])
+
+        idx, significances = calc_significances(np.array(powers))
+        periods_best = 1.0/self.freqs[idx]
+
+        return periods_best, significances, pdots
+
+
+@register_engine
+class GCEGPUEngine(PeriodSearchEngine):
+    algorithm = "GCE"
+    device = "GPU"
+    supports_pdot = True
+
+    def prepare(self, freqs):
+        from gcex.gce import ConditionalEntropy
+
+        self.freqs = freqs
+        self.ce = ConditionalEntropy(phase_bins=self.phase_bins,
+                                     mag_bins=self.mag_bins)
+        self.pdots_to_test = get_pdots_to_test(self.doUsePDot)
+
+    def run_batch(self, lightcurves):
+        freqs = self.freqs
+        lightcurves_stack, maxn = stack_lightcurves(lightcurves,
+            doSingleTimeSegment=self.doSingleTimeSegment)
+        lightcurves_stack = lightcurves_stack.rows(3)
+
+        periods_best = np.zeros((len(lightcurves),1))
+        significances = np.zeros((len(lightcurves),1))
+        pdots = np.zeros((len(lightcurves),1))
+
+        pdots_split = np.array_split(self.pdots_to_test,len(self.pdots_to_test))
+        for ii, pdot in enumerate(pdots_split):
+            print("Running pdot %d / %d" % (ii+1, len(pdots_split)))
+            print_batch_info(len(lightcurves_stack), maxn, self.batch_size,
+                             len(freqs), self.phase_bins, self.mag_bins)
+
+            results = self.ce.batched_run_const_nfreq(lightcurves_stack, self.batch_size, freqs, pdot, show_progress=False)
+            periods = 1./freqs
+
+            entropies = np.array([entropies2 for entropies2 in results])
+            for kk in range(entropies.shape[1]):
+                idx, significance = calc_significances(entropies[:,kk,:],
+                                                       maximize=False)
+                better = significance > significances[:,0]
+                periods_best[better,0] = periods[idx[better]]
+                significances[better,0] = significance[better]
+                pdots[better,0] = pdot[kk]*1.0
+
+        return periods_best.flatten(), significances.flatten(), pdots.flatten()
+
+
+class PeriodFindGPUEngine(PeriodSearchEngine):
+    """Base class of the periodfind (ECE, EAOV, ELS) engines"""
+
+    device = "GPU"
+    supports_pdot = True
+    float32 = True
+
+    def prepare(self, freqs):
+        self.freqs = freqs
+        self.pdots_to_test = get_pdots_to_test(self.doUsePDot)
+
+    def run_batch(self, lightcurves):
+        lightcurves_stack, maxn = stack_lightcurves(lightcurves,
+            doSingleTimeSegment=self.doSingleTimeSegment)
+
+        time_stack = lightcurves_stack.split(
+            lightcurves_stack.t.astype(np.float32))
+        mag_stack = lightcurves_stack.split(
+            lightcurves_stack.normalized_mag().astype(np.float32))
+
+        print_batch_info(len(time_stack), maxn, self.batch_size,
+                         len(self.freqs), self.phase_bins, self.mag_bins)
+
+        periods = (1.0/self.freqs).astype(np.float32)
+        pdots_to_test = self.pdots_to_test.astype(np.float32)
+
+        periods_best = np.zeros((len(lightcurves),1))
+        significances = np.zeros((len(lightcurves),1))
+        pdots = np.zeros((len(lightcurves),1))
+
+        data_out = self.proc.calc(time_stack, mag_stack, periods, pdots_to_test)
+
+        for ii, stat in enumerate(data_out):
+            if np.isnan(stat.significance):
+                raise ValueError("Oops... significance  is nan... something went wrong")
+
+            periods_best[ii] = stat.params[0]
+            pdots[ii] = stat.params[1]
+            significances[ii] = stat.significance
+
+        return periods_best.flatten(), significances.flatten(), pdots.flatten()
+
+
+@register_engine
+class ECEGPUEngine(PeriodFindGPUEngine):
+    algorithm = "ECE"
+
+    def prepare(self, freqs):
+        from periodfind.ce import ConditionalEntropy
+
+        PeriodFindGPUEngine.prepare(self, freqs)
+        self.proc = ConditionalEntropy(self.phase_bins, self.mag_bins)
+
+
+@register_engine
+class EAOVGPUEngine(PeriodFindGPUEngine):
+    algorithm = "EAOV"
+
+    def prepare(self, freqs):
+        from periodfind.aov import AOV
+
+        PeriodFindGPUEngine.prepare(self, freqs)
+        self.proc = AOV(self.phase_bins)
+
+
+@register_engine
+class ELSGPUEngine(PeriodFindGPUEngine):
+    algorithm = "ELS"
+
+    def prepare(self, freqs):
+        from periodfind.ls import LombScargle
+
+        PeriodFindGPUEngine.prepare(self, freqs)
+        self.proc = LombScargle()
+
+
+@register_engine
+class GCELSAOVGPUEngine(PeriodSearchEngine):
+    algorithm = "GCE_LS_AOV"
+    device = "GPU"
+    regular_grid = True
+    nfreqs_to_keep = 50
+
+    def prepare(self, freqs):
+        from cuvarbase.lombscargle import LombScargleAsyncProcess
+        from gcex.gce import ConditionalEntropy
+
+        self.freqs = freqs
+        self.df = freqs[1]-freqs[0]
+        self.LombScargleAsyncProcess = LombScargleAsyncProcess
+        self.ce = ConditionalEntropy(phase_bins=self.phase_bins,
+                                     mag_bins=self.mag_bins)
+
+    def run_batch(self, lightcurves):
+        freqs = self.freqs
+        periods_best, significances = [], []
+        pdots = np.zeros((len(lightcurves),))
+
+        freqs_to_keep = {}
+        for jj in range(len(lightcurves)):
+            freqs_to_keep[jj] = np.empty((0,1))
+
+        pdot = np.array([0.0])
+        lightcurves_stack, maxn = stack_lightcurves(lightcurves,
+            doSingleTimeSegment=self.doSingleTimeSegment)
+        lightcurves_stack = lightcurves_stack.rows(3)
+
+        print_batch_info(len(lightcurves_stack), maxn, self.batch_size,
+                         len(self.grid.freqs), self.phase_bins, self.mag_bins)
+
+        # CE only runs on the kept frequencies, LS on the regular grid
+        freqs_tmp, keep = self.grid.freqs, self.grid.keep
+        results = self.ce.batched_run_const_nfreq(lightcurves_stack, self.batch_size, freqs_tmp, pdot, show_progress=False)
+
+        entropies = np.array([entropies2[0] for entropies2 in results])
+        idx = calc_top_frequencies(entropies, self.nfreqs_to_keep)
+        for jj in range(len(lightcurves)):
+            freqs_to_keep[jj] = np.append(freqs_to_keep[jj], freqs_tmp[idx[jj]])
+
+        nfft_sigma, spp = 10, 10
+
+        ls_proc = self.LombScargleAsyncProcess(use_double=True,
+                                               sigma=nfft_sigma)
+        results = ls_proc.batched_run_const_nfreq(lightcurves,
+                                                  batch_size=self.batch_size,
+                                                  use_fft=True,
+                                                  samples_per_peak=spp,
+                                                  returnBestFreq=False,
+                                                  freqs = freqs)
+
+        # the Baluev FAP of a lightcurve decreases with the power, so the
+        # lowest FAPs are the highest peaks
+        freqs_ls = results[0][0][keep]
+        powers = np.array([out[1][keep] for out in results])
+        idx = np.argsort(-powers, axis=1, kind='stable')[:,:self.nfreqs_to_keep]
+        for jj in range(len(lightcurves)):
+            freqs_to_keep[jj] = np.append(freqs_to_keep[jj], freqs_ls[idx[jj]])
+        ls_proc.finish()
+
+        if self.doParallel:
+            from joblib import Parallel, delayed
+            res = Parallel(n_jobs=self.Ncore)(delayed(calc_AOV)(data, freqs_to_keep[jj], self.df) for jj, data in enumerate(lightcurves))
+            periods_best = [x[0] for x in res]
+            significances = [x[1] for x in res]
+        else:
+            for jj, data in enumerate(lightcurves):
+                if np.mod(jj,10) == 0:
+                    print("%d/%d"%(jj,len(lightcurves)))
+
+                period, significance = calc_AOV(data, freqs_to_keep[jj], self.df)
                 periods_best.append(period)
                 significances.append(significance)
 
+        return periods_best, significances, pdots
 
-        elif algorithm == "GCE":
-            from gcex.gce import ConditionalEntropy
-            ce = ConditionalEntropy(phase_bins=phase_bins, mag_bins=mag_bins)
-
-            if doUsePDot:
-                num_pdots = 10
-                max_pdot = 1e-10
-                min_pdot = 1e-12
-                pdots_to_test = -np.logspace(np.log10(min_pdot), np.log10(max_pdot), num_pdots)
-                pdots_to_test = np.append(0,pdots_to_test)
-                #pdots_to_test = np.array([-2.365e-11])
-            else:
-                pdots_to_test = np.array([0.0])
-
-            if doSingleTimeSegment:
-                tt = np.empty((0,1))
-                for lightcurve in lightcurves:
-                    tt = np.unique(np.append(tt, lightcurve[0]))
-
-            maxn = -np.inf
-            lightcurves_stack = []
-            for lightcurve in lightcurves:
-                if doSingleTimeSegment:
-                    xy, x_ind, y_ind = np.intersect1d(tt, lightcurve[0], 
-                                                      return_indices=True)
-                    mag_array = 999*np.ones(tt.shape)
-                    magerr_array = 999*np.ones(tt.shape)
-                    mag_array[x_ind] = lightcurve[1][y_ind]
-                    magerr_array[x_ind] = lightcurve[2][y_ind]
-                    lightcurve = (tt, mag_array, magerr_array)
-                else:
-                    idx = np.argsort(lightcurve[0])
-                    tmin = np.min(lightcurve[0])
-                    lightcurve = (lightcurve[0][idx]-tmin,
-                                  lightcurve[1][idx],
-                                  lightcurve[2][idx])
-
-                lightcurve_stack = np.vstack((lightcurve[0],
-                                              lightcurve[1],
-                                              lightcurve[2])).T
-                lightcurves_stack.append(lightcurve_stack)
-
-                if len(idx) > maxn:
-                    maxn = len(idx)
-
-            periods_best = np.zeros((len(lightcurves),1))
-            significances = np.zeros((len(lightcurves),1))
-            pdots = np.zeros((len(lightcurves),1))
-
-            pdots_split = np.array_split(pdots_to_test,len(pdots_to_test))
-            for ii, pdot in enumerate(pdots_split):
-                print("Running pdot %d / %d" % (ii+1, len(pdots_split)))
-
-                print("Number of lightcurves: %d" % len(lightcurves_stack))
-                print("Max length of lightcurves: %d" % maxn)
-                print("Batch size: %d" % batch_size)
-                print("Number of frequency bins: %d" % len(freqs))
-                print("Number of phase bins: %d" % phase_bins)
-                print("Number of magnitude bins: %d" % mag_bins)
-
-                results = ce.batched_run_const_nfreq(lightcurves_stack, batch_size, freqs, pdot, show_progress=False)
-                periods = 1./freqs
-           
-                for jj, (lightcurve, entropies2) in enumerate(zip(lightcurves,results)):
-                    for kk, entropies in enumerate(entropies2):
-                        significance = np.abs(np.mean(entropies)-np.min(entropies))/np.std(entropies)
-
-                        period = periods[np.argmin(entropies)]
-                        if significance > significances[jj]:
-                            periods_best[jj] = period
-                            significances[jj] = significance
-                            pdots[jj] = pdot[kk]*1.0 
-            pdots, periods_best, significances = pdots.flatten(), periods_best.flatten(), significances.flatten()
-
-        elif (algorithm == "ECE") or (algorithm == "EAOV") or (algorithm == "ELS"):
-            if algorithm == "ECE":
-                from periodfind.ce import ConditionalEntropy
-                #ce = ConditionalEntropy(phase_bins=phase_bins, mag_bins=mag_bins)
-                ce = ConditionalEntropy(phase_bins, mag_bins)
-            elif algorithm == "EAOV":
-                from periodfind.aov import AOV
-                aov = AOV(phase_bins)
-            elif algorithm == "ELS":
-                from periodfind.ls import LombScargle
-                ls = LombScargle()
-
-            if doUsePDot:
-                num_pdots = 10
-                max_pdot = 1e-10
-                min_pdot = 1e-12
-                pdots_to_test = -np.logspace(np.log10(min_pdot), np.log10(max_pdot), num_pdots)
-                pdots_to_test = np.append(0,pdots_to_test)
-                #pdots_to_test = np.array([-2.365e-11])
-            else:
-                pdots_to_test = np.array([0.0])
-
-            if doSingleTimeSegment:
-                tt = np.empty((0,1))
-                for lightcurve in lightcurves:
-                    tt = np.unique(np.append(tt, lightcurve[0]))
-
-            maxn = -np.inf
-            time_stack, mag_stack = [], []
-            for lightcurve in lightcurves:
-                if doSingleTimeSegment:
-                    xy, x_ind, y_ind = np.intersect1d(tt, lightcurve[0],
-                                                      return_indices=True)
-                    mag_array = 999*np.ones(tt.shape)
-                    magerr_array = 999*np.ones(tt.shape)
-                    mag_array[x_ind] = lightcurve[1][y_ind]
-                    magerr_array[x_ind] = lightcurve[2][y_ind]
-                    lightcurve = (tt, mag_array, magerr_array)
-                else:
-                    idx = np.argsort(lightcurve[0])
-                    tmin = np.min(lightcurve[0])
-                    lightcurve = (lightcurve[0][idx]-tmin,
-                                  lightcurve[1][idx],
-                                  lightcurve[2][idx])
-
-                lightcurve_stack = np.vstack((lightcurve[0],
-                                              lightcurve[1],
-                                              lightcurve[2])).T
-                time_stack.append(lightcurve[0].astype(np.float32))
-                lc = lightcurve[1]
-                lc = (lc - np.min(lc))/(np.max(lc)-np.min(lc))
-                mag_stack.append(lc.astype(np.float32))
-
-                if len(idx) > maxn:
-                    maxn = len(idx)
-
-            print("Number of lightcurves: %d" % len(time_stack))
-            print("Max length of lightcurves: %d" % maxn)
-            print("Batch size: %d" % batch_size)
-            print("Number of frequency bins: %d" % len(freqs))
-            print("Number of phase bins: %d" % phase_bins)
-            print("Number of magnitude bins: %d" % mag_bins)
-
-            periods = (1.0/freqs).astype(np.float32)
-            pdots_to_test = pdots_to_test.astype(np.float32)
-
-            periods_best = np.zeros((len(lightcurves),1))
-            significances = np.zeros((len(lightcurves),1))
-            pdots = np.zeros((len(lightcurves),1))
-
-            if algorithm == "ECE":
-                data_out = ce.calc(time_stack, mag_stack, periods, pdots_to_test)
-            elif algorithm == "EAOV":
-                data_out = aov.calc(time_stack, mag_stack, periods, pdots_to_test)
-            elif algorithm == "ELS":
-                data_out = ls.calc(time_stack, mag_stack, periods, pdots_to_test)
-
-            for ii, stat in enumerate(data_out):
-                if np.isnan(stat.significance):
-                    raise ValueError("Oops... significance  is nan... something went wrong")
-
-                periods_best[ii] = stat.params[0]
-                pdots[ii] = stat.params[1]
-                significances[ii] = stat.significance
-            pdots, periods_best, significances = pdots.flatten(), periods_best.flatten(), significances.flatten()
-
-        elif algorithm == "GCE_LS_AOV":
-            nfreqs_to_keep = 100
-            nfreqs_to_keep = 50
-            df = freqs[1]-freqs[0]
-
-            from cuvarbase.lombscargle import LombScargleAsyncProcess, fap_baluev
-            from gcex.gce import ConditionalEntropy
-            from ztfperiodic.pyaov.pyaov import aovw, amhw
-
-            ce = ConditionalEntropy(phase_bins=phase_bins, mag_bins=mag_bins)
-
-            freqs_to_keep = {}
-            for jj in range(len(lightcurves)):
-                freqs_to_keep[jj] = np.empty((0,1))
-
-            pdot = np.array([0.0])
-            if doSingleTimeSegment:
-                tt = np.empty((0,1))
-                for lightcurve in lightcurves:
-                    tt = np.unique(np.append(tt, lightcurve[0]))
-
-            maxn = -np.inf
-            lightcurves_stack = []
-            for lightcurve in lightcurves:
-                if doSingleTimeSegment:
-                    xy, x_ind, y_ind = np.intersect1d(tt, lightcurve[0],
-                                                      return_indices=True)
-                    mag_array = 999*np.ones(tt.shape)
-                    magerr_array = 999*np.ones(tt.shape)
-                    mag_array[x_ind] = lightcurve[1][y_ind]
-                    magerr_array[x_ind] = lightcurve[2][y_ind]
-                    lightcurve = (tt, mag_array, magerr_array)
-                else:
-                    tmin = np.min(lightcurve[0])
-                    idx = np.argsort(lightcurve[0])
-                    lightcurve = (lightcurve[0][idx]-tmin,
-                                  lightcurve[1][idx],
-                                  lightcurve[2][idx])
 
-                lightcurve_stack = np.vstack((lightcurve[0],
-                                              lightcurve[1],
-                                              lightcurve[2])).T
-                lightcurves_stack.append(lightcurve_stack)
+@register_engine
+class GCELSAOVx3GPUEngine(GCELSAOVGPUEngine):
+    algorithm = "GCE_LS_AOV_x3"
+    niter = 3
 
-                if len(idx) > maxn:
-                    maxn = len(idx)
+    def run_batch(self, lightcurves):
+        from ztfperiodic.pyaov.pyaov import amhw
 
-            print("Number of lightcurves: %d" % len(lightcurves_stack))
-            print("Max length of lightcurves: %d" % maxn)
-            print("Batch size: %d" % batch_size)
-            print("Number of frequency bins: %d" % len(freqs))
-            print("Number of phase bins: %d" % phase_bins)
-            print("Number of magnitude bins: %d" % mag_bins)
+        freqs = self.freqs
+        df = self.df
+        periods_best, significances = [], []
+        pdots = np.zeros((len(lightcurves),))
 
-            results = ce.batched_run_const_nfreq(lightcurves_stack, batch_size, freqs, pdot, show_progress=False)
+        freqs_to_keep = {}
+        for jj in range(len(lightcurves)):
+            freqs_to_keep[jj] = np.empty((0,1))
+
+        pdot = np.array([0.0])
+        lightcurves_stack, maxn = stack_lightcurves(lightcurves,
+            doSingleTimeSegment=self.doSingleTimeSegment)
+        lightcurves_stack = lightcurves_stack.rows(3)
+
+        print_batch_info(len(lightcurves_stack), maxn, self.batch_size,
+                         len(self.grid.freqs), self.phase_bins, self.mag_bins)
+
+        # CE only runs on the kept frequencies, LS on the regular grid
+        freqs_tmp, keep = self.grid.freqs, self.grid.keep
+        entropies_all = {}
+        for nn in range(self.niter):
+            results = self.ce.batched_run_const_nfreq(lightcurves_stack, self.batch_size, freqs_tmp, pdot, show_progress=False)
 
             for jj, (lightcurve, entropies2) in enumerate(zip(lightcurves,results)):
+                if nn == 0:
+                    entropies_all[jj] = np.empty((0,len(freqs_tmp)))
+
                 for kk, entropies in enumerate(entropies2):
-                    freqs_tmp = np.copy(freqs)
-                    if doRemoveTerrestrial and (freqs_to_remove is not None):
-                        for pair in freqs_to_remove:
-                            idx = np.where((freqs_tmp < pair[0]) | (freqs_tmp > pair[1]))[0]
-                            freqs_tmp = freqs_tmp[idx]
-                            entropies = entropies[idx]
-                    significance = np.abs(np.mean(entropies)-entropies)/np.std(entropies)
-                    idx = np.argsort(significance)[::-1]
-
-                    freqs_to_keep[jj] = np.append(freqs_to_keep[jj],
-                                                  freqs_tmp[idx[:nfreqs_to_keep]])
-
-            nfft_sigma, spp = 10, 10
-
-            ls_proc = LombScargleAsyncProcess(use_double=True,
-                                                  sigma=nfft_sigma)
+                    entropies_all[jj] = np.append(entropies_all[jj],
+                                                  np.atleast_2d(entropies),
+                                                  axis=0)
+
+        entropies = np.array([np.median(entropies_all[jj], axis=0)
+                              for jj in range(len(lightcurves))])
+        idx = calc_top_frequencies(entropies, self.nfreqs_to_keep)
+        for jj in range(len(lightcurves)):
+            freqs_to_keep[jj] = np.append(freqs_to_keep[jj], freqs_tmp[idx[jj]])
+
+        nfft_sigma, spp = 10, 10
+
+        freqs_all = {}
+        powers_all = {}
+        for nn in range(self.niter):
+            ls_proc = self.LombScargleAsyncProcess(use_double=True,
+                                                   sigma=nfft_sigma)
             results = ls_proc.batched_run_const_nfreq(lightcurves,
-                                                      batch_size=batch_size,
+                                                      batch_size=self.batch_size,
                                                       use_fft=True,
                                                       samples_per_peak=spp,
                                                       returnBestFreq=False,
                                                       freqs = freqs)
 
             for jj, (data, out) in enumerate(zip(lightcurves,results)):
-                freqs, powers = out
-                if doRemoveTerrestrial and (freqs_to_remove is not None):
-                    for pair in freqs_to_remove:
-                        idx = np.where((freqs < pair[0]) | (freqs > pair[1]))[0]
-                        freqs = freqs[idx]
-                        powers = powers[idx]
-
-                copy = np.ma.copy(data).T
-                fap = fap_baluev(copy[:,0], copy[:,2], powers, np.max(freqs))
-                idx = np.argsort(fap)
-                freqs_to_keep[jj] = np.append(freqs_to_keep[jj],
-                                              freqs[idx[:nfreqs_to_keep]])
+                freqs_ls, powers = out
+                if nn == 0:
+                    freqs_all[jj] = freqs_ls
+                    powers_all[jj] = np.empty((0,len(freqs_ls)))
+                powers_all[jj] = np.append(powers_all[jj],
+                                           np.atleast_2d(powers),
+                                           axis=0)
             ls_proc.finish()
 
-            if doParallel:
-                from joblib import Parallel, delayed
-                res = Parallel(n_jobs=Ncore)(delayed(calc_AOV)(data, freqs_to_keep[jj], df) for jj, data in enumerate(lightcurves))
-                periods_best = [x[0] for x in res]
-                significances = [x[1] for x in res]
-            else:
-                for jj, data in enumerate(lightcurves):
-                    if np.mod(jj,10) == 0:
-                        print("%d/%d"%(jj,len(lightcurves)))
-
-                    period, significance = calc_AOV(data, freqs_to_keep[jj], df)
-                    periods_best.append(period)
-                    significances.append(significance)
-
-        elif algorithm == "GCE_LS_AOV_x3":
-            nfreqs_to_keep = 100
-            nfreqs_to_keep = 50
-            df = freqs[1]-freqs[0]
-
-            niter = 3
-
-            from cuvarbase.lombscargle import LombScargleAsyncProcess, fap_baluev
-            from gcex.gce import ConditionalEntropy
-            from ztfperiodic.pyaov.pyaov import aovw, amhw
-
-            ce = ConditionalEntropy(phase_bins=phase_bins, mag_bins=mag_bins)
-
-            freqs_to_keep = {}
-            for jj in range(len(lightcurves)):
-                freqs_to_keep[jj] = np.empty((0,1))
-
-            pdot = np.array([0.0])
-            if doSingleTimeSegment:
-                tt = np.empty((0,1))
-                for lightcurve in lightcurves:
-                    tt = np.unique(np.append(tt, lightcurve[0]))
-
-            maxn = -np.inf
-            lightcurves_stack = []
-            for lightcurve in lightcurves:
-                if doSingleTimeSegment:
-                    xy, x_ind, y_ind = np.intersect1d(tt, lightcurve[0],
-                                                      return_indices=True)
-                    mag_array = 999*np.ones(tt.shape)
-                    magerr_array = 999*np.ones(tt.shape)
-                    mag_array[x_ind] = lightcurve[1][y_ind]
-                    magerr_array[x_ind] = lightcurve[2][y_ind]
-                    lightcurve = (tt, mag_array, magerr_array)
-                else:
-                    tmin = np.min(lightcurve[0])
-                    idx = np.argsort(lightcurve[0])
-                    lightcurve = (lightcurve[0][idx]-tmin,
-                                  lightcurve[1][idx],
-                                  lightcurve[2][idx])
-
-                lightcurve_stack = np.vstack((lightcurve[0],
-                                              lightcurve[1],
-                                              lightcurve[2])).T
-                lightcurves_stack.append(lightcurve_stack)
-
-                if len(idx) > maxn:
-                    maxn = len(idx)
-
-            print("Number of lightcurves: %d" % len(lightcurves_stack))
-            print("Max length of lightcurves: %d" % maxn)
-            print("Batch size: %d" % batch_size)
-            print("Number of frequency bins: %d" % len(freqs))
-            print("Number of phase bins: %d" % phase_bins)
-            print("Number of magnitude bins: %d" % mag_bins)
-
-            entropies_all = {}    
-            for nn in range(niter):
-                results = ce.batched_run_const_nfreq(lightcurves_stack, batch_size, freqs, pdot, show_progress=False)
-
-                for jj, (lightcurve, entropies2) in enumerate(zip(lightcurves,results)):
-                    if nn == 0:
-                        entropies_all[jj] = np.empty((0,len(freqs))) 
-
-                    for kk, entropies in enumerate(entropies2):
-                        entropies_all[jj] = np.append(entropies_all[jj],
-                                                      np.atleast_2d(entropies),
-                                                      axis=0)
-            
-            for jj in entropies_all.keys():
-                entropies = np.median(entropies_all[jj], axis=0)
-                freqs_tmp = np.copy(freqs)
-                if doRemoveTerrestrial and (freqs_to_remove is not None):
-                    for pair in freqs_to_remove:
-                        idx = np.where((freqs_tmp < pair[0]) | (freqs_tmp > pair[1]))[0]
-                        freqs_tmp = freqs_tmp[idx]
-                        entropies = entropies[idx]
-                significance = np.abs(np.mean(entropies)-entropies)/np.std(entropies)
-                idx = np.argsort(significance)[::-1]
-
-                freqs_to_keep[jj] = np.append(freqs_to_keep[jj],
-                                              freqs_tmp[idx[:nfreqs_to_keep]])
-
-            nfft_sigma, spp = 10, 10
-
-            freqs_all = {}
-            powers_all = {}
-            for nn in range(niter):
-                ls_proc = LombScargleAsyncProcess(use_double=True,
-                                                  sigma=nfft_sigma)
-                results = ls_proc.batched_run_const_nfreq(lightcurves,
-                                                          batch_size=batch_size,
-                                                          use_fft=True,
-                                                          samples_per_peak=spp,
-                                                          returnBestFreq=False,
-                                                          freqs = freqs)
-
-                for jj, (data, out) in enumerate(zip(lightcurves,results)):
-                    freqs, powers = out
-                    if nn == 0:
-                        freqs_all[jj] = freqs
-                        powers_all[jj] = np.empty((0,len(freqs)))
-                    powers_all[jj] = np.append(powers_all[jj],
-                                               np.atleast_2d(powers),
-                                               axis=0)
-                ls_proc.finish()
-
-            for jj in powers_all.keys(): 
-                data = lightcurves[jj]
-                freqs = freqs_all[jj]
-                powers = np.median(powers_all[jj], axis=0)
-                if doRemoveTerrestrial and (freqs_to_remove is not None):
-                    for pair in freqs_to_remove:
-                        idx = np.where((freqs < pair[0]) | (freqs > pair[1]))[0]
-                        freqs = freqs[idx]
-                        powers = powers[idx]
-
-                copy = np.ma.copy(data).T
-                fap = fap_baluev(copy[:,0], copy[:,2], powers, np.max(freqs))
-                idx = np.argsort(fap)
-                freqs_to_keep[jj] = np.append(freqs_to_keep[jj],
-                                              freqs[idx[:nfreqs_to_keep]])
+        freqs_ls = freqs_all[0][keep]
+        powers = np.array([np.median(powers_all[jj], axis=0)[keep]
+                           for jj in range(len(lightcurves))])
+        idx = np.argsort(-powers, axis=1, kind='stable')[:,:self.nfreqs_to_keep]
+        for jj in range(len(lightcurves)):
+            freqs_to_keep[jj] = np.append(freqs_to_keep[jj], freqs_ls[idx[jj]])
+
+        for jj, data in enumerate(lightcurves):
+            if np.mod(jj,10) == 0:
+                print("%d/%d"%(jj,len(lightcurves)))
+
+            copy = np.ma.copy(data).T
+            copy[:,1] = normalize_mag(copy[:,1])
 
-            for jj, data in enumerate(lightcurves):
-                if np.mod(jj,10) == 0:
-                    print("%d/%d"%(jj,len(lightcurves)))
+            freqs_aov, aovs = np.empty((0,1)), np.empty((0,1))
+            for ii, fr0 in enumerate(freqs_to_keep[jj]):
+                err = copy[:,2]
+                aov, frtmp, _ = amhw(copy[:,0], copy[:,1], err,
+                                     fr0=fr0-50*df,
+                                     fstop=fr0+50*df,
+                                     fstep=df/2.0,
+                                     nh2=4)
+                idx = np.where(frtmp > 0)[0]
+
+                aovs = np.append(aovs,aov[idx])
+                freqs_aov = np.append(freqs_aov,frtmp[idx])
+
+            periods = 1./freqs_aov
+            significance = np.max(aovs)
+            period = periods[np.argmax(aovs)]
 
-                copy = np.ma.copy(data).T
-                copy[:,1] = (copy[:,1]  - np.min(copy[:,1])) \
-                   / (np.max(copy[:,1]) - np.min(copy[:,1]))
+            periods_best.append(period)
+            significances.append(significance)
 
-                freqs, aovs = np.empty((0,1)), np.empty((0,1))
-                for ii, fr0 in enumerate(freqs_to_keep[jj]):
-                    err = copy[:,2]
-                    aov, frtmp, _ = amhw(copy[:,0], copy[:,1], err,
-                                         fr0=fr0-50*df,
-                                         fstop=fr0+50*df,
-                                         fstep=df/2.0,
-                                         nh2=4)
-                    idx = np.where(frtmp > 0)[0]
+        return periods_best, significances, pdots
 
-                    aovs = np.append(aovs,aov[idx])
-                    freqs = np.append(freqs,frtmp[idx])
 
-                significance = np.abs(np.mean(aovs)-np.max(aovs))/np.std(aovs)
-                periods = 1./freqs
-                significance = np.max(aovs)
-                period = periods[np.argmax(aovs)]
+@register_engine
+class GCELSGPUEngine(PeriodSearchEngine):
+    algorithm = "GCE_LS"
+    device = "GPU"
+    regular_grid = True
 
-                periods_best.append(period)
-                significances.append(significance)
+    def prepare(self, freqs):
+        from cuvarbase.lombscargle import LombScargleAsyncProcess
+        from gcex.gce import ConditionalEntropy
 
-        elif algorithm == "GCE_LS":
-            from cuvarbase.lombscargle import LombScargleAsyncProcess, fap_baluev
-            from gcex.gce import ConditionalEntropy
-            from ztfperiodic.pyaov.pyaov import aovw, amhw
-
-            ce = ConditionalEntropy(phase_bins=phase_bins, mag_bins=mag_bins)
-
-            pdot = np.array([0.0])
-            if doSingleTimeSegment:
-                tt = np.empty((0,1))
-                for lightcurve in lightcurves:
-                    tt = np.unique(np.append(tt, lightcurve[0]))
-
-            maxn = -np.inf
-            lightcurves_stack = []
-            for lightcurve in lightcurves:
-                if doSingleTimeSegment:
-                    xy, x_ind, y_ind = np.intersect1d(tt, lightcurve[0],
-                                                      return_indices=True)
-                    mag_array = 999*np.ones(tt.shape)
-                    magerr_array = 999*np.ones(tt.shape)
-                    mag_array[x_ind] = lightcurve[1][y_ind]
-                    magerr_array[x_ind] = lightcurve[2][y_ind]
-                    lightcurve = (tt, mag_array, magerr_array)
-                else:
-                    tmin = np.min(lightcurve[0])
-                    idx = np.argsort(lightcurve[0])
-                    lightcurve = (lightcurve[0][idx]-tmin,
-                                  lightcurve[1][idx],
-                                  lightcurve[2][idx])
-
-                lightcurve_stack = np.vstack((lightcurve[0],
-                                              lightcurve[1])).T
-                lightcurves_stack.append(lightcurve_stack)
-
-                if len(idx) > maxn:
-                    maxn = len(idx)
-
-            print("Number of lightcurves: %d" % len(lightcurves_stack))
-            print("Max length of lightcurves: %d" % maxn)
-            print("Batch size: %d" % batch_size)
-            print("Number of frequency bins: %d" % len(freqs))
-            print("Number of phase bins: %d" % phase_bins)
-            print("Number of magnitude bins: %d" % mag_bins)
-
-            results2 = ce.batched_run_const_nfreq(lightcurves_stack, batch_size, freqs, pdot, show_progress=False)
-
-            nfft_sigma, spp = 10, 10
-
-            ls_proc = LombScargleAsyncProcess(use_double=True,
-                                                  sigma=nfft_sigma)
-            results1 = ls_proc.batched_run_const_nfreq(lightcurves,
-                                                       batch_size=batch_size,
-                                                       use_fft=True,
-                                                       samples_per_peak=spp,
-                                                       returnBestFreq=False,
-                                                       freqs = freqs)
-
-            for jj, (data, out, entropies2) in enumerate(zip(lightcurves, results1, results2)):
-                entropies = entropies2[0]
-                freqs1, powers = out
-                if doRemoveTerrestrial and (freqs_to_remove is not None):
-                    for pair in freqs_to_remove:
-                        idx = np.where((freqs1 < pair[0]) | (freqs1 > pair[1]))[0]
-                        freqs1 = freqs1[idx]
-                        powers = powers[idx]
-                        entropies = entropies[idx]
-
-                #copy = np.ma.copy(data).T
-                #fap = fap_baluev(copy[:,0], copy[:,2], powers, np.max(freqs))
-                #significance1 = 1./fap
-                significance1 = np.abs(powers-np.mean(powers))/np.std(powers)
-                significance2 = np.abs(np.mean(entropies)-entropies)/np.std(entropies)
-                significance = significance1*significance2
-                #significance = significance2
-                idx = np.argmax(significance)
-
-                period = 1./freqs[idx]
-                significance = significance[idx]
+        self.freqs = freqs
+        self.LombScargleAsyncProcess = LombScargleAsyncProcess
+        self.ce = ConditionalEntropy(phase_bins=self.phase_bins,
+                                     mag_bins=self.mag_bins)
 
-                periods_best.append(period)
-                significances.append(significance)
-            ls_proc.finish()
+    def run_batch(self, lightcurves):
+        freqs = self.freqs
+        pdots = np.zeros((len(lightcurves),))
 
-        elif algorithm == "FFT":
-            from cuvarbase.lombscargle import fap_baluev
-            from reikna import cluda
-            from reikna.fft.fft import FFT
+        pdot = np.array([0.0])
+        lightcurves_stack, maxn = stack_lightcurves(lightcurves,
+            doSingleTimeSegment=self.doSingleTimeSegment)
+        lightcurves_stack = lightcurves_stack.rows(2)
 
-            T = 30.0/86400.0
-            fs = 1.0/T
+        print_batch_info(len(lightcurves_stack), maxn, self.batch_size,
+                         len(self.grid.freqs), self.phase_bins, self.mag_bins)
 
-            api = cluda.get_api('cuda')
-            dev = api.get_platforms()[0].get_devices()[0]
-            thr = api.Thread(dev)
+        # CE only runs on the kept frequencies, LS on the regular grid
+        keep = self.grid.keep
+        results2 = self.ce.batched_run_const_nfreq(lightcurves_stack, self.batch_size, self.grid.freqs, pdot, show_progress=False)
 
-            x = np.arange(0.0, 12.0/24.0, T).astype(np.complex128)
-            fft  = FFT(x, axes=(0,))
-            fftc = fft.compile(thr, fast_math=True)
+        nfft_sigma, spp = 10, 10
 
-            lightcurves_stack = []
+        ls_proc = self.LombScargleAsyncProcess(use_double=True,
+                                               sigma=nfft_sigma)
+        results1 = ls_proc.batched_run_const_nfreq(lightcurves,
+                                                   batch_size=self.batch_size,
+                                                   use_fft=True,
+                                                   samples_per_peak=spp,
+                                                   returnBestFreq=False,
+                                                   freqs = freqs)
 
-            period_min, period_max = 60.0/86400.0, 12.0*3600.0/86400.0
-            freq_min, freq_max = 1/period_max, 1/period_min
+        freqs1 = results1[0][0][keep]
+        powers = np.array([out[1][keep] for out in results1])
+        entropies = np.array([entropies2[0] for entropies2 in results2])
+        ls_proc.finish()
 
-            for ii, lightcurve in enumerate(lightcurves):
-                bins_tmp = np.arange(np.min(lightcurve[0]), np.max(lightcurve[1]), 1/24.0)
-                bins = np.vstack((bins_tmp[:-12],bins_tmp[12:]))
-                n, bins_tmp = ztfperiodic.utils.overlapping_histogram(lightcurve[0], bins)
-                idx = np.argmax(n)
-                bins_max = bins[:,idx]
+        significance1 = np.abs(powers-np.mean(powers, axis=1)[:,np.newaxis])/np.std(powers, axis=1)[:,np.newaxis]
+        significance2 = np.abs(np.mean(entropies, axis=1)[:,np.newaxis]-entropies)/np.std(entropies, axis=1)[:,np.newaxis]
+        significance = significance1*significance2
+        idx = np.argmax(significance, axis=1)
 
-                x = np.arange(bins_max[0], bins_max[0] + 12.0/24.0, T)
-                y = np.interp(x, lightcurve[0], lightcurve[1]).astype(np.complex128)
-                yerr = np.interp(x, lightcurve[0], lightcurve[2])
-                if len(y) == 0:
-                    periods_best.append(-1)
-                    significances.append(-1)
-                    continue                    
-                y = y - np.median(y)
-                y = y * np.hanning(len(y))
+        periods_best = 1./freqs1[idx]
+        significances = significance[np.arange(len(lightcurves)), idx]
 
-                dev   = thr.to_device(y)
-                fftc(dev, dev)
+        return periods_best, significances, pdots
 
-                Y = dev.get()
-                powers = np.abs(Y)
-                N = len(y)
-                freqs = np.linspace(0.0, 1.0/(2.0*T), N/2)
 
-                powers = powers[:int(N/2)]
-                idx = np.where((freqs >= freq_min) & (freqs <= freq_max))[0]
+class FFTEngine(PeriodSearchEngine):
+    """
+    Base class for the FFT engines: each lightcurve is interpolated onto a
+    regular grid of cadence T over its densest window of the given
+    duration, and peaks are searched between period_min and period_max.
+    """
 
-                freqs, powers = freqs[idx], powers[idx]
-                powers = powers * freqs**2
+    algorithm = "FFT"
+    T = 30.0/86400.0
+    duration = 12.0/24.0
+    period_min, period_max = 60.0/86400.0, 12.0*3600.0/86400.0
 
-                significance = np.abs(np.median(powers)-np.max(powers))/np.std(powers)   
-                freq = freqs[np.argmax(powers)]
-                period = 1.0/freq
+    def resample(self, lightcurves):
+        return resample_lightcurves(lightcurves, self.T, self.duration)
 
-                periods_best.append(period)
-                significances.append(significance)
+    def get_peaks(self, Y):
+        """Returns the periods and significances from the rfft *Y* of the
+        resampled lightcurves, shape [n_lightcurves, N//2+1]."""
 
-    elif doCPU:
-    
-        periods = 1/freqs
-        period_jobs=1
-    
-        if algorithm == "LS":
-            from astropy.stats import LombScargle
-            for ii,data in enumerate(lightcurves):
-                if np.mod(ii,1) == 0:
-                    print("%d/%d"%(ii,len(lightcurves)))
-                copy = np.ma.copy(data).T
-                nrows, ncols = copy.shape
-    
-                if nrows == 1:
-                    periods_best.append(-1)
-                    significances.append(-1)
-                    continue
-    
-                ls = LombScargle(copy[:,0], copy[:,1], copy[:,2])
-                power = ls.power(freqs)
-                fap = ls.false_alarm_probability(power,maximum_frequency=np.max(freqs))
-    
-                idx = np.argmin(fap)
-                significance = 1./fap[idx]
-                period = 1./freqs[idx]
-                periods_best.append(period)
-                significances.append(significance)
-    
-        elif algorithm == "CE":
-            from ztfperiodic.period import CE
-            for ii,data in enumerate(lightcurves):
-                if np.mod(ii,1) == 0:
-                    print("%d/%d"%(ii,len(lightcurves)))
-    
-                copy = np.ma.copy(data).T
-                copy[:,1] = (copy[:,1]  - np.min(copy[:,1])) \
-                   / (np.max(copy[:,1]) - np.min(copy[:,1]))
-                entropies = []
-                for period in periods:
-                    entropy = CE(period, data=copy, xbins=phase_bins, ybins=mag_bins)
-                    entropies.append(entropy)
-                significance = np.abs(np.mean(entropies)-np.min(entropies))/np.std(entropies)
-                period = periods[np.argmin(entropies)]
-    
-                periods_best.append(period)
-                significances.append(significance)
-    
-        elif algorithm == "AOV":
-            from ztfperiodic.pyaov.pyaov import aovw, amhw
-            for ii,data in enumerate(lightcurves):
-                if np.mod(ii,10) == 0:
-                    print("%d/%d"%(ii,len(lightcurves)))
-    
-                copy = np.ma.copy(data).T
-                copy[:,1] = (copy[:,1]  - np.min(copy[:,1])) \
-                   / (np.max(copy[:,1]) - np.min(copy[:,1]))
-    
-                aov, fr, _ = amhw(copy[:,0], copy[:,1], copy[:,2],
-                                  fstop=np.max(1.0/periods),
-                                  fstep=1/periods[0])
-    
-                significance = np.abs(np.mean(aov)-np.max(aov))/np.std(aov)
-                period = periods[np.argmax(aov)]
-    
-                periods_best.append(period)
-                significances.append(significance)
-   
-        elif algorithm == "AOV_cython":
-            from AOV_cython import aov as pyaov
-            for ii,data in enumerate(lightcurves):
+        N = self.x.shape[0]
+        freqs = np.fft.rfftfreq(N, self.T)
+        idx = np.where((freqs >= 1/self.period_max) &
+                       (freqs <= 1/self.period_min))[0]
+
+        freqs = freqs[idx]
+        powers = np.abs(Y[:, idx]) * freqs**2
+
+        significances = np.abs(np.median(powers, axis=1) -
+                               np.max(powers, axis=1))/np.std(powers, axis=1)
+        periods_best = 1.0/freqs[np.argmax(powers, axis=1)]
+
+        return periods_best, significances
+
+
+@register_engine
+class FFTGPUEngine(FFTEngine):
+    device = "GPU"
+
+    def prepare(self, freqs):
+        from reikna import cluda
+        from reikna.fft.fft import FFT
+
+        self.freqs = freqs
+        self.x = np.arange(0.0, self.duration, self.T)
+
+        api = cluda.get_api('cuda')
+        dev = api.get_platforms()[0].get_devices()[0]
+        self.thr = api.Thread(dev)
+
+        fft  = FFT(self.x.astype(np.complex128), axes=(0,))
+        self.fftc = fft.compile(self.thr, fast_math=True)
+
+    def run_batch(self, lightcurves):
+        y, valid = self.resample(lightcurves)
+        N = self.x.shape[0]
+
+        Y = np.zeros((len(lightcurves), N//2+1), dtype=np.complex128)
+        for ii in np.where(valid)[0]:
+            dev   = self.thr.to_device(y[ii].astype(np.complex128))
+            self.fftc(dev, dev)
+            Y[ii] = dev.get()[:N//2+1]
+
+        periods_best, significances = self.get_peaks(Y)
+        periods_best[~valid], significances[~valid] = -1, -1
+        pdots = np.zeros((len(lightcurves),))
+
+        return periods_best, significances, pdots
+
+
+@register_engine
+class FFTCPUEngine(FFTEngine):
+    """
+    The FFT search on the CPU: all lightcurves of a batch are resampled in
+    one vectorized step and transformed with a batched numpy.fft.rfft.
+    """
+
+    device = "CPU"
+
+    def prepare(self, freqs):
+        self.freqs = freqs
+        self.x = np.arange(0.0, self.duration, self.T)
+
+    def run_batch(self, lightcurves):
+        y, valid = self.resample(lightcurves)
+        Y = np.fft.rfft(y, axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            periods_best, significances = self.get_peaks(Y)
+        periods_best[~valid], significances[~valid] = -1, -1
+        pdots = np.zeros((len(lightcurves),))
+
+        return periods_best, significances, pdots
+
+
+# -- CPU engines --------------------------------------------------------------
+
+@register_engine
+class LSCPUEngine(PeriodogramEngine):
+    """
+    Fast (extirpolation and FFT) Lomb-Scargle, evaluated separately on each
+    regular run of the grid, so that excluded bands are never computed.
+
+    The fast periodogram is only accurate to ~1e-3 in power, which the
+    steep Baluev FAP turns into orders of magnitude in significance, so the
+    *nrefine* highest local peaks are re-evaluated with the exact
+    Lomb-Scargle (at their index and +- *halfwidth* neighbours) before the
+    best peak and its FAP are taken: the results then do not depend on the
+    extirpolation (nor on freq_block_size).
+
+    Runs shorter than *min_fast_size* frequencies (e.g. the refinement
+    windows of a CoarseToFineEngine) are evaluated with the exact
+    Lomb-Scargle instead, all at once, which is cheaper than one
+    extirpolation per run.
+    """
+
+    algorithm = "LS"
+    nrefine = 5
+    halfwidth = 2
+    min_fast_size = 256
+
+    def prepare(self, freqs):
+        from ztfperiodic.mylombscargle import lombscargle_fast_batch
+        from ztfperiodic.mylombscargle import lombscargle_batch_at
+        from ztfperiodic.mylombscargle import FAP_baluev_batch
+
+        self.freqs = freqs
+        self.df, self.segments = get_regular_segments(freqs)
+        self.lombscargle_fast_batch = lombscargle_fast_batch
+        self.lombscargle_batch_at = lombscargle_batch_at
+        self.FAP_baluev_batch = FAP_baluev_batch
+
+    def config_key(self):
+        return str((PeriodogramEngine.config_key(self), self.nrefine,
+                    self.halfwidth))
+
+    def make_accumulator(self, nlightcurves):
+        """Returns the accumulator of a batch, keeping the nrefine (or
+        npeaks) highest local peaks as candidates"""
+        return PeriodogramAccumulator(nlightcurves, maximize=True,
+                                      npeaks=max(self.npeaks, self.nrefine),
+                                      local_peaks=True,
+                                      nsummary=self.summary_bins,
+                                      nfreqs=len(self.freqs))
+
+    def iter_segments(self, lightcurves):
+        """Yields the periodograms (rows, start, powers) of each regular
+        segment of the grid, starting at index *start*, in order, for
+        chunks *rows* of batch_size lightcurves"""
+        # a sinusoid plus offset needs at least 3 points
+        idx = np.array([ii for ii, data in enumerate(lightcurves)
+                        if len(data[0]) > 3], dtype=int)
+        short = [np.arange(start, stop) for start, stop in self.segments
+                 if stop-start < self.min_fast_size]
+        short = np.concatenate(short) if len(short) > 0 else np.zeros(0, dtype=int)
+        for jj in range(0, len(idx), self.batch_size):
+            print("%d/%d"%(jj,len(idx)))
+            batch = idx[jj:jj+self.batch_size]
+            data = [lightcurves[ii] for ii in batch]
+            if len(short) > 0:
+                exact = self.lombscargle_batch_at(data, np.tile(self.freqs[short], (len(batch), 1)))
+                nexact = 0
+            for start, stop in self.segments:
+                if stop-start < self.min_fast_size:
+                    yield batch, start, exact[:, nexact:nexact+stop-start]
+                    nexact += stop-start
+                else:
+                    yield batch, start, self.lombscargle_fast_batch(data, self.freqs[start],
+                                                                    self.df, stop-start)
+
+    def periodogram(self, lightcurves):
+        powers = np.full((len(lightcurves), len(self.freqs)), np.nan)
+        for rows, start, segment in self.iter_segments(lightcurves):
+            powers[rows, start:start+segment.shape[1]] = segment
+
+        return powers
+
+    def accumulate(self, lightcurves, accumulator):
+        """Streams the periodograms into *accumulator* in blocks of
+        freq_block_size frequencies; the extirpolation always spans whole
+        regular segments, so that the powers do not depend on the blocks"""
+        self.fmax = np.max(self.freqs)
+        block_size = self.freq_block_size or len(self.freqs)
+        for rows, start, segment in self.iter_segments(lightcurves):
+            for jj in range(0, segment.shape[1], block_size):
+                accumulator.update(segment[:, jj:jj+block_size],
+                                   offset=start+jj, rows=rows)
+        accumulator.finalize()
+
+        return accumulator
+
+    def significance(self, lightcurves, accumulator):
+        refine_peaks(lightcurves, self.freqs, accumulator,
+                     self.lombscargle_batch_at, halfwidth=self.halfwidth,
+                     npeaks=self.npeaks)
+        return calc_fap_significance(lightcurves, self.freqs, accumulator,
+                                     self.FAP_baluev_batch)
+
+
+def refine_peaks(lightcurves, freqs, accumulator, periodogram_at,
+                 halfwidth=2, npeaks=1):
+    """
+    Re-evaluates the candidate peaks of *accumulator* with the exact
+    periodogram *periodogram_at(lightcurves, freqs)* (at each candidate
+    index and its +- halfwidth neighbours of *freqs*), moves each peak to
+    its best neighbour and sorts the peaks by their exact values, keeping
+    *npeaks* of them. Rows without finite values are left alone.
+    """
+    rows = np.where(accumulator.count > 0)[0]
+    candidates = accumulator.peak_index[rows]
+    valid = np.isfinite(accumulator.peak_value[rows])
+
+    if len(rows) > 0:
+        shifts = np.arange(-halfwidth, halfwidth+1)
+        idx = np.clip(candidates[:,:,np.newaxis] + shifts, 0, len(freqs)-1)
+        nlc, ncand, nshift = idx.shape
+        values = periodogram_at([lightcurves[ii] for ii in rows],
+                                freqs[idx.reshape(nlc, -1)])
+        values = values.reshape(nlc, ncand, nshift)
+        key = accumulator.key(values)
+        best = np.argmax(key, axis=2)[:,:,np.newaxis]
+        idx = np.take_along_axis(idx, best, axis=2)[:,:,0]
+        values = np.take_along_axis(values, best, axis=2)[:,:,0]
+        values[~valid] = np.nan
+
+        # two candidates can settle on the same index: keep the first
+        order = np.lexsort((idx, -accumulator.key(values)), axis=1)
+        idx = np.take_along_axis(idx, order, axis=1)
+        values = np.take_along_axis(values, order, axis=1)
+        duplicate = np.zeros(idx.shape, dtype=bool)
+        duplicate[:,1:] = (idx[:,1:] == idx[:,:-1]) & np.isfinite(values[:,1:])
+        values[duplicate] = np.nan
+        order = np.argsort(-accumulator.key(values), axis=1, kind='stable')
+        candidates = np.take_along_axis(idx, order, axis=1)
+        accumulator.peak_index[rows] = candidates
+        accumulator.peak_value[rows] = np.take_along_axis(values, order,
+                                                          axis=1)
+
+    accumulator.peak_index = accumulator.peak_index[:,:npeaks]
+    accumulator.peak_value = accumulator.peak_value[:,:npeaks]
+    accumulator.npeaks = npeaks
+
+
+def calc_fap_significance(lightcurves, freqs, accumulator, FAP_baluev_batch):
+    """
+    Returns the index of the highest Lomb-Scargle peak of each periodogram
+    and its significance, 1 / FAP; the Baluev FAP is only evaluated at the
+    peak.
+    """
+    idx = accumulator.peak_index[:,0]
+    significances = -np.ones(len(lightcurves))
+    rows = np.where(accumulator.count > 0)[0]
+    if len(rows) == 0:
+        return idx, significances
+
+    fap = FAP_baluev_batch(accumulator.peak_value[rows,0], np.max(freqs),
+                           [lightcurves[ii] for ii in rows])
+    with np.errstate(divide='ignore'):
+        significances[rows] = 1./fap
+    return idx, significances
+
+
+class SharedEpochEngine(PeriodogramEngine):
+    """
+    Base class of the engines working on blocks of sources stacked on
+    their common epochs with stack_shared_epochs.
+    """
+
+    shared_epochs = True
+    nsources = 1000
+    min_epochs = 3
+    # blocks sharing fewer sources per epoch than this are searched one
+    # lightcurve at a time, on its own epochs: merging the exposures of
+    # unrelated sources shifts their samples and buys little speed
+    min_sources_per_epoch = 2.0
+
+    def periodogram(self, lightcurves):
+        # epochs closer than this shift the phase by < 0.01 cycles at the
+        # highest frequency of the whole grid
+        tol = 0.01/self.fmax
+
+        stats = np.full((len(lightcurves), len(self.freqs)), np.nan)
+        idx = np.array([ii for ii, data in enumerate(lightcurves)
+                        if len(data[0]) > self.min_epochs], dtype=int)
+        for jj in range(0, len(idx), self.nsources):
+            batch = idx[jj:jj+self.nsources]
+            tt, mag_array, weight_array = stack_shared_epochs([lightcurves[ii] for ii in batch], tol=tol)
+
+            sources_per_epoch = np.sum(weight_array > 0)/len(tt)
+
+            print("%d/%d"%(jj,len(idx)))
+            print("Number of shared epochs: %d" % len(tt))
+            print("Mean sources per epoch: %.1f" % sources_per_epoch)
+
+            if sources_per_epoch >= self.min_sources_per_epoch:
+                stats[batch] = self.shared_periodogram(tt, mag_array,
+                                                       weight_array)
+                continue
+
+            print("Too few shared epochs, searching the sources one by one")
+            for ii in batch:
+                tt, mag_array, weight_array = \
+                    stack_shared_epochs([lightcurves[ii]])
+                stats[ii] = self.shared_periodogram(tt, mag_array,
+                                                    weight_array)[0]
+        return stats
+
+    def shared_periodogram(self, tt, mag_array, weight_array):
+        raise NotImplementedError
+
+
+@register_engine
+class LSGEMMCPUEngine(SharedEpochEngine):
+    algorithm = "LS_GEMM"
+
+    def prepare(self, freqs):
+        from ztfperiodic.mylombscargle import lombscargle_shared_epochs
+        from ztfperiodic.mylombscargle import FAP_baluev_batch
+
+        self.freqs = freqs
+        self.lombscargle_shared_epochs = lombscargle_shared_epochs
+        self.FAP_baluev_batch = FAP_baluev_batch
+
+    def shared_periodogram(self, tt, mag_array, weight_array):
+        return self.lombscargle_shared_epochs(tt, mag_array, weight_array,
+                                              self.freqs,
+                                              chunk_size=self.freq_chunk_size)
+
+    def significance(self, lightcurves, accumulator):
+        return calc_fap_significance(lightcurves, self.freqs, accumulator,
+                                     self.FAP_baluev_batch)
+
+
+class BinnedSharedEpochEngine(SharedEpochEngine):
+    statistic = None
+    min_epochs = 10
+
+    def shared_periodogram(self, tt, mag_array, weight_array):
+        stats = calc_binned_statistics(tt, mag_array, weight_array,
+                                       self.freqs,
+                                       statistics=[self.statistic],
+                                       phase_bins=self.phase_bins,
+                                       mag_bins=self.mag_bins,
+                                       chunk_size=self.freq_chunk_size)
+        stats = stats[self.statistic]
+        for stat in stats:
+            stat[~np.isfinite(stat)] = np.nanmedian(stat)
+        return stats
+
+
+@register_engine
+class CESharedCPUEngine(BinnedSharedEpochEngine):
+    algorithm = "CE_SHARED"
+    statistic = "CE"
+    maximize = False
+
+
+@register_engine
+class AOVSharedCPUEngine(BinnedSharedEpochEngine):
+    algorithm = "AOV_SHARED"
+    statistic = "AOV"
+
+
+@register_engine
+class CECPUEngine(PeriodogramEngine):
+    algorithm = "CE"
+    maximize = False
+
+    def prepare(self, freqs):
+        from ztfperiodic.period import CE
+
+        self.freqs = freqs
+        self.CE = CE
+
+    def periodogram(self, lightcurves):
+        periods = 1/self.freqs
+        entropies = np.zeros((len(lightcurves), len(periods)))
+        for ii,data in enumerate(lightcurves):
+            print("%d/%d"%(ii,len(lightcurves)))
+
+            copy = np.ma.copy(data).T
+            copy[:,1] = normalize_mag(copy[:,1])
+            for jj, period in enumerate(periods):
+                entropies[ii, jj] = self.CE(period, data=copy,
+                                            xbins=self.phase_bins,
+                                            ybins=self.mag_bins)
+        return entropies
+
+
+@register_engine
+class CEVECCPUEngine(PeriodogramEngine):
+    algorithm = "CE_VEC"
+    maximize = False
+
+    def prepare(self, freqs):
+        from ztfperiodic.period import CE_vectorized
+
+        self.freqs = freqs
+        self.CE_vectorized = CE_vectorized
+
+    def periodogram(self, lightcurves):
+        periods = 1/self.freqs
+        entropies = np.zeros((len(lightcurves), len(periods)))
+        for ii,data in enumerate(lightcurves):
+            if np.mod(ii,10) == 0:
+                print("%d/%d"%(ii,len(lightcurves)))
+
+            copy = np.ma.copy(data).T
+            copy[:,1] = normalize_mag(copy[:,1])
+            entropies[ii] = self.CE_vectorized(periods, data=copy,
+                                               xbins=self.phase_bins,
+                                               ybins=self.mag_bins,
+                                               chunk_size=self.freq_chunk_size)
+        return entropies
+
+
+class PdotEngine(PeriodSearchEngine):
+    """
+    Base class of the CPU engines searching over a (frequency, pdot) grid.
+
+    The whole frequency grid is folded with the pdots of
+    get_pdots_to_test; the best (frequency, pdot) cell is then refined on
+    a finer pdot grid spanning its two neighbouring pdots, over
+    +- nfreqs_fine frequency bins. The significance is |mean - extremum| /
+    std over the coarse (frequency, pdot) grid.
+    """
+
+    device = "CPU"
+    supports_pdot = True
+    statistic = None
+    maximize = True
+    npdots_fine = 21
+    nfreqs_fine = 10
+
+    def prepare(self, freqs):
+        from ztfperiodic.period import pdot_periodogram
+
+        self.freqs = freqs
+        self.pdots_to_test = np.sort(get_pdots_to_test(self.doUsePDot))
+        self.pdot_periodogram = pdot_periodogram
+
+    def periodogram(self, t, y, freqs, pdots):
+        stats = self.pdot_periodogram(t, y, freqs, pdots,
+                                      statistic=self.statistic,
+                                      xbins=self.phase_bins,
+                                      ybins=self.mag_bins,
+                                      chunk_size=self.freq_chunk_size)
+        stats[~np.isfinite(stats)] = np.nanmedian(stats)
+        if not self.maximize:
+            stats = -stats
+        return stats
+
+    def run_batch(self, lightcurves):
+        freqs, pdots_to_test = self.freqs, self.pdots_to_test
+
+        periods_best = -np.ones(len(lightcurves))
+        significances = -np.ones(len(lightcurves))
+        pdots = np.zeros((len(lightcurves),))
+
+        for ii, data in enumerate(lightcurves):
+            if np.mod(ii,10) == 0:
+                print("%d/%d"%(ii,len(lightcurves)))
+            if len(data[0]) <= self.phase_bins:
+                continue
+
+            t = np.asarray(data[0], dtype=float)
+            y = normalize_mag(np.asarray(data[1], dtype=float))
+
+            stats = self.periodogram(t, y, freqs, pdots_to_test)
+            if not np.any(np.isfinite(stats)):
+                continue
+            kk, jj = np.unravel_index(np.argmax(stats), stats.shape)
+            best = stats[kk, jj]
+            freq, pdot = freqs[jj], pdots_to_test[kk]
+
+            if len(pdots_to_test) > 1:
+                pdots_fine = np.linspace(pdots_to_test[max(kk-1, 0)],
+                                         pdots_to_test[min(kk+1, len(pdots_to_test)-1)],
+                                         self.npdots_fine)
+                freqs_fine = freqs[max(jj-self.nfreqs_fine, 0):jj+self.nfreqs_fine+1]
+                stats_fine = self.periodogram(t, y, freqs_fine, pdots_fine)
+                kk, jj = np.unravel_index(np.argmax(stats_fine),
+                                          stats_fine.shape)
+                if stats_fine[kk, jj] > best:
+                    best = stats_fine[kk, jj]
+                    freq, pdot = freqs_fine[jj], pdots_fine[kk]
+
+            periods_best[ii] = 1.0/freq
+            significances[ii] = np.abs(np.mean(stats)-best)/np.std(stats)
+            pdots[ii] = pdot
+
+        return periods_best, significances, pdots
+
+
+@register_engine
+class CEPdotCPUEngine(PdotEngine):
+    algorithm = "CE_PDOT"
+    statistic = "CE"
+    maximize = False
+
+
+@register_engine
+class AOVPdotCPUEngine(PdotEngine):
+    algorithm = "AOV_PDOT"
+    statistic = "AOV"
+
+
+class FusedEngine(PeriodSearchEngine):
+    """
+    CPU engine computing the phase-binned CE and AOV and the Lomb-Scargle
+    periodograms (the statistics of the ECE, EAOV and ELS GPU engines) in
+    a single pass over the frequency grid with period.fused_periodogram.
+
+    By default only the statistic of the registered algorithm is computed;
+    with algorithms=["ECE", "EAOV", "ELS"] (any subset), run_batch_multi
+    returns the results of all of them for the cost of one search. The
+    significance of every statistic is |mean - extremum| / std.
+    """
+
+    device = "CPU"
+    chunked = True
+    # algorithm: (statistic, maximize)
+    statistics = {"ECE": ("CE", False),
+                  "EAOV": ("AOV", True),
+                  "ELS": ("LS", True)}
+
+    def __init__(self, algorithms=None, **kwargs):
+        PeriodSearchEngine.__init__(self, **kwargs)
+        if algorithms is None:
+            algorithms = [self.algorithm]
+        for algorithm in algorithms:
+            if not algorithm in self.statistics:
+                raise ValueError("%s not available in the fused engine" % algorithm)
+        self.algorithms = algorithms
+
+    def prepare(self, freqs):
+        from ztfperiodic.period import fused_periodogram
+
+        self.freqs = freqs
+        self.fused_periodogram = fused_periodogram
+
+    def run_batch_multi(self, lightcurves):
+        """Returns {algorithm: (periods, significances, pdots)}"""
+        freqs = self.freqs
+        statistics = [self.statistics[algorithm][0]
+                      for algorithm in self.algorithms]
+        accumulators = {}
+        for algorithm in self.algorithms:
+            accumulators[algorithm] = PeriodogramAccumulator(len(lightcurves),
+                maximize=self.statistics[algorithm][1])
+
+        block_size = self.freq_block_size or len(freqs)
+        for ii, data in enumerate(lightcurves):
+            if np.mod(ii,10) == 0:
+                print("%d/%d"%(ii,len(lightcurves)))
+            if len(data[0]) <= self.phase_bins:
+                continue
+
+            t = np.asarray(data[0], dtype=float)
+            y = normalize_mag(np.asarray(data[1], dtype=float))
+            dy = np.asarray(data[2], dtype=float)
+            for start in range(0, len(freqs), block_size):
+                stats = self.fused_periodogram(t, y, dy,
+                                               freqs[start:start+block_size],
+                                               statistics=statistics,
+                                               xbins=self.phase_bins,
+                                               ybins=self.mag_bins,
+                                               chunk_size=self.freq_chunk_size)
+                for algorithm in self.algorithms:
+                    # non-finite values are left out by the accumulator,
+                    # so that they do not depend on the block size
+                    stat = stats[self.statistics[algorithm][0]]
+                    stat = np.where(np.isfinite(stat), stat, np.nan)
+                    accumulators[algorithm].update(stat, offset=start,
+                                                   rows=[ii])
+
+        results = {}
+        for algorithm in self.algorithms:
+            accumulator = accumulators[algorithm]
+            significances = accumulator.significance()
+            periods_best = 1.0/freqs[accumulator.peak_index[:,0]]
+            periods_best[significances < 0] = -1
+            results[algorithm] = (periods_best, significances,
+                                  np.zeros((len(lightcurves),)))
+        return results
+
+    def run_batch(self, lightcurves):
+        return self.run_batch_multi(lightcurves)[self.algorithms[0]]
+
+
+@register_engine
+class ECECPUEngine(FusedEngine):
+    algorithm = "ECE"
+
+
+@register_engine
+class EAOVCPUEngine(FusedEngine):
+    algorithm = "EAOV"
+
+
+@register_engine
+class ELSCPUEngine(FusedEngine):
+    algorithm = "ELS"
+
+
+def find_periods_fused(algorithms, lightcurves, freqs, **kwargs):
+    """
+    Returns {algorithm: (periods, significances, pdots)} for the fused
+    CPU algorithms (ECE, EAOV, ELS) in *algorithms*, computed in a single
+    pass; the keyword arguments are passed to the engine.
+    """
+    engine = FusedEngine(algorithms=algorithms, **kwargs)
+
+    print('Period finding lightcurves...')
+    engine.set_grid(engine.make_grid(freqs))
+    results = engine.run_batch_multi(lightcurves)
+    engine.finalize()
+
+    return results
+
+
+class FoldedPeriodogramEngine(PeriodogramEngine):
+    """
+    Base class for CPU engines whose periodogram is computed one lightcurve
+    at a time by a function of (t, y, dy, freqs); with doParallel the
+    lightcurves are distributed over Ncore processes.
+    """
+
+    def calc_periodogram(self, t, y, dy, freqs):
+        raise NotImplementedError
+
+    def periodogram(self, lightcurves):
+        calc_periodogram = partial(self.calc_periodogram, freqs=self.freqs)
+
+        if self.doParallel:
+            from joblib import Parallel, delayed
+            powers = Parallel(n_jobs=self.Ncore)(delayed(calc_periodogram)(data[0], data[1], data[2]) for data in lightcurves)
+        else:
+            powers = []
+            for ii, data in enumerate(lightcurves):
                 if np.mod(ii,10) == 0:
                     print("%d/%d"%(ii,len(lightcurves)))
+                powers.append(calc_periodogram(data[0], data[1], data[2]))
 
-                copy = np.ma.copy(data).T
-                copy[:,1] = (copy[:,1]  - np.min(copy[:,1])) \
-                   / (np.max(copy[:,1]) - np.min(copy[:,1]))
+        return np.array(powers).reshape((len(lightcurves), len(self.freqs)))
 
-                aov = pyaov(freqs, copy[:,0], copy[:,1],
-                            np.mean(copy[:,1]),
-                            len(copy[:,0]), 10, len(freqs))
 
-                significance = np.abs(np.mean(aov)-np.max(aov))/np.std(aov)
-                freq = freqs[np.argmax(aov)]
-                period = 1.0/freq
+@register_engine
+class BLSCPUEngine(FoldedPeriodogramEngine):
+    """
+    Box least squares on the CPU with period.BLS_periodogram.
+    """
+
+    algorithm = "BLS"
+    nbins = 100
+    qmin, qmax = 0.01, 0.2
+
+    def prepare(self, freqs):
+        self.freqs = freqs
+
+    def calc_periodogram(self, t, y, dy, freqs):
+        from ztfperiodic.period import BLS_periodogram
+
+        return BLS_periodogram(t, y, dy, freqs, nbins=self.nbins,
+                               qmin=self.qmin, qmax=self.qmax,
+                               chunk_size=self.freq_chunk_size)
+
+
+@register_engine
+class PDMCPUEngine(FoldedPeriodogramEngine):
+    """
+    Phase dispersion minimization on the CPU with period.PDM_periodogram,
+    using the same binned_linterp statistic, number of bins and (uniform)
+    weights as the GPU engine.
+    """
+
+    algorithm = "PDM"
+    nbins = 10
+
+    def prepare(self, freqs):
+        self.freqs = freqs
+
+    def calc_periodogram(self, t, y, dy, freqs):
+        from ztfperiodic.period import PDM_periodogram
+
+        return PDM_periodogram(t, y, freqs, nbins=self.nbins,
+                               chunk_size=self.freq_chunk_size)
+
+
+@register_engine
+class AOVCPUEngine(PeriodSearchEngine):
+    algorithm = "AOV"
+    device = "CPU"
+
+    def prepare(self, freqs):
+        from ztfperiodic.pyaov.pyaov import amhw
+
+        self.freqs = freqs
+        self.amhw = amhw
+
+    def run_batch(self, lightcurves):
+        periods = 1/self.freqs
+        periods_best, significances = [], []
+        pdots = np.zeros((len(lightcurves),))
+
+        for ii,data in enumerate(lightcurves):
+            if np.mod(ii,10) == 0:
+                print("%d/%d"%(ii,len(lightcurves)))
+
+            copy = np.ma.copy(data).T
+            copy[:,1] = normalize_mag(copy[:,1])
+
+            aov, fr, _ = self.amhw(copy[:,0], copy[:,1], copy[:,2],
+                                   fstop=np.max(1.0/periods),
+                                   fstep=1/periods[0])
+
+            significance = np.abs(np.mean(aov)-np.max(aov))/np.std(aov)
+            period = periods[np.argmax(aov)]
+
+            periods_best.append(period)
+            significances.append(significance)
+
+        return periods_best, significances, pdots
+
+
+@register_engine
+class AOVCythonCPUEngine(PeriodogramEngine):
+    algorithm = "AOV_cython"
+
+    def prepare(self, freqs):
+        from ztfperiodic.AOV_cython import aov_batch
+
+        self.freqs = freqs
+        self.aov_batch = aov_batch
+
+    def periodogram(self, lightcurves):
+        from ztfperiodic.batch import LightcurveBatch
+
+        batch = LightcurveBatch.from_lightcurves(lightcurves)
+
+        print("Number of lightcurves: %d" % len(batch))
+        print("Number of frequency bins: %d" % len(self.freqs))
+        print("Number of threads: %d" % self.Ncore)
+
+        aovs = self.aov_batch(self.freqs, batch.t, batch.normalized_mag(),
+                              batch.offsets, r=10, nthreads=self.Ncore)
+        # zero variance within the bins at some frequencies counts as no
+        # signal there, but rows with no finite value at all (too few
+        # epochs, constant magnitudes) stay NaN so that they are reported
+        # as not analyzed (period and significance -1)
+        finite = np.isfinite(aovs)
+        aovs[~finite & np.any(finite, axis=1)[:,np.newaxis]] = 0.0
+
+        return aovs
 
-                periods_best.append(period)
-                significances.append(significance)
- 
-    return np.array(periods_best), np.array(significances), np.array(pdots)
 
 def calc_AOV(data, freqs_to_keep, df):
+    from ztfperiodic.pyaov.pyaov import amhw
+
     copy = np.ma.copy(data).T
     copy[:,1] = (copy[:,1]  - np.min(copy[:,1])) \
        / (np.max(copy[:,1]) - np.min(copy[:,1]))
@@ -802,3 +2194,173 @@ def calc_AOV(data, freqs_to_keep, df):
     period = periods[np.argmax(aovs)]
 
     return [period, significance]
+
+
+def get_shared_epochs(lightcurves, tol=0.0):
+    """
+    Returns the epochs common to a set of lightcurves, and the index of
+    every sample of every lightcurve in that set. Samples within *tol* of
+    the first sample of an epoch are assigned to that epoch (the mean of
+    their times), so that the heliocentric corrections of sources in one
+    exposure do not split it; an epoch never spans more than *tol*, even
+    when the lightcurves do not share exposures.
+    """
+    lengths = np.array([len(lightcurve[0]) for lightcurve in lightcurves])
+    t = np.concatenate([lightcurve[0] for lightcurve in lightcurves])
+
+    order = np.argsort(t, kind='stable')
+    tsort = t[order]
+    # the first sample of each epoch is the first sample more than tol
+    # after the first sample of the previous epoch
+    starts = [0]
+    while len(tsort) > 0:
+        start = np.searchsorted(tsort, tsort[starts[-1]] + tol, side='right')
+        if start >= len(tsort):
+            break
+        starts.append(start)
+    epoch = np.zeros(len(tsort), dtype=int)
+    epoch[starts[1:]] = 1
+    epoch = np.cumsum(epoch)
+
+    tt = np.bincount(epoch, weights=tsort)/np.bincount(epoch)
+    idx = np.empty(len(t), dtype=int)
+    idx[order] = epoch
+
+    return tt, np.split(idx, np.cumsum(lengths)[:-1])
+
+
+def stack_shared_epochs(lightcurves, tol=0.0):
+    """
+    Returns the common epochs of *lightcurves* together with their
+    (sources x epochs) magnitude and weight matrices; missing epochs have
+    zero weight, and repeated samples in one epoch are averaged.
+    """
+    tt, idxs = get_shared_epochs(lightcurves, tol=tol)
+
+    mag_array = np.zeros((len(lightcurves), len(tt)))
+    weight_array = np.zeros((len(lightcurves), len(tt)))
+    for ii, (lightcurve, idx) in enumerate(zip(lightcurves, idxs)):
+        mag = np.asarray(lightcurve[1], dtype=float)
+        w = 1.0/np.asarray(lightcurve[2], dtype=float)**2
+        np.add.at(weight_array[ii], idx, w)
+        mag_array[ii, idx] = mag
+
+        counts = np.bincount(idx, minlength=len(tt))
+        if np.any(counts > 1):
+            repeated = counts[idx] > 1
+            mag_array[ii, idx[repeated]] = 0.0
+            np.add.at(mag_array[ii], idx[repeated],
+                      w[repeated]*mag[repeated])
+            mag_array[ii, idx[repeated]] /= weight_array[ii, idx[repeated]]
+
+    return tt, mag_array, weight_array
+
+
+def calc_binned_statistics(tt, mag_array, weight_array, freqs,
+                           statistics=["CE"], phase_bins=20, mag_bins=10,
+                           aov_bins=10, chunk_size=1000,
+                           max_elements=20000000):
+    """
+    Returns phase-binned periodograms of sources observed at common epochs.
+
+    The (frequency, epoch) -> phase bin map depends only on the epochs, so
+    it is computed once per chunk of frequencies, stored as a sparse one-hot
+    matrix, and applied to every source with sparse matrix products. Missing
+    epochs (zero weight) are masked out. Magnitudes are min-max normalized
+    per source, as in the per-lightcurve CE and AOV engines.
+
+    Parameters
+    ----------
+    tt : 1D-array, shape = [n_epochs]
+    mag_array, weight_array : 2D-array, shape = [n_sources, n_epochs]
+        as returned by stack_shared_epochs
+    freqs : 1D-array
+    statistics : list
+        any of "CE" (conditional entropy, phase_bins x mag_bins) and "AOV"
+        (analysis of variance, aov_bins phase bins)
+    chunk_size : int
+        maximum number of frequencies per chunk; reduced so that the dense
+        bin counts of a chunk stay below max_elements values
+
+    Returns
+    -------
+    results : dict
+        statistic name -> 2D-array, shape = [n_sources, n_freqs]
+    """
+    import scipy.sparse
+
+    nsources, nepochs = mag_array.shape
+    mask = weight_array > 0
+    N = np.sum(mask, axis=1).astype(float)
+    t = tt
+
+    mag = np.where(mask, mag_array, np.nan)
+    magmin = np.nanmin(mag, axis=1)[:, np.newaxis]
+    magmax = np.nanmax(mag, axis=1)[:, np.newaxis]
+    mag = (mag - magmin)/(magmax - magmin)
+    mag[~mask] = 0.0
+
+    results = {}
+    for statistic in statistics:
+        results[statistic] = np.full((nsources, len(freqs)), np.nan)
+
+    if "CE" in statistics:
+        # one-hot (epoch, source x mag bin), following the fast_histogram
+        # convention of period.CE: the upper edge of the range is dropped
+        valid = mask & (mag >= 0) & (mag < 1)
+        ybin = (mag * mag_bins).astype(int)
+        source, epoch = np.nonzero(valid)
+        onehot_mag = scipy.sparse.csr_matrix(
+            (np.ones(len(epoch)), (epoch, source*mag_bins + ybin[valid])),
+            shape=(nepochs, nsources*mag_bins))
+        nchunk_ce = max(1, int(max_elements // (phase_bins*nsources)))
+
+    if "AOV" in statistics:
+        sums = np.hstack((mask.T, (mag*mask).T, (mag**2*mask).T))
+        avg = np.sum(mag*mask, axis=1)/N
+
+    nbins = {"CE": phase_bins, "AOV": aov_bins}
+    nchunk = chunk_size
+    if "CE" in statistics:
+        nchunk = min(nchunk, nchunk_ce)
+
+    for start in range(0, len(freqs), nchunk):
+        f = freqs[start:start+nchunk]
+        nf = len(f)
+        period = 1.0/f
+        phase = np.mod(t, period[:, np.newaxis]) / period[:, np.newaxis]
+
+        for statistic in statistics:
+            xbins = nbins[statistic]
+            xbin = np.minimum((phase * xbins).astype(int), xbins-1)
+            rows = (np.arange(nf)[:, np.newaxis]*xbins + xbin).ravel()
+            cols = np.tile(np.arange(nepochs), nf)
+            onehot_phase = scipy.sparse.csr_matrix(
+                (np.ones(len(rows)), (rows, cols)),
+                shape=(nf*xbins, nepochs))
+
+            if statistic == "CE":
+                # only the occupied bins contribute to the entropy
+                bins = (onehot_phase @ onehot_mag).tocoo()
+                source = bins.col // mag_bins
+                column_sums = onehot_phase @ valid.T.astype(float)
+                column_sums = column_sums[bins.row, source]
+
+                A = bins.data * np.log(column_sums / bins.data)
+                index = (bins.row // xbins)*nsources + source
+                stat = np.bincount(index, weights=A, minlength=nf*nsources)
+                stat = stat.reshape((nf, nsources)) / N
+
+            elif statistic == "AOV":
+                binned = onehot_phase @ sums
+                binned = binned.reshape((nf, xbins, 3, nsources))
+                n, sum1, sum2 = binned[:,:,0], binned[:,:,1], binned[:,:,2]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    mean = np.where(n > 0, sum1/n, 0.0)
+                    s1 = np.sum(n*(mean-avg)**2, axis=1)
+                    s2 = np.sum(sum2 - n*mean**2, axis=1)
+                    stat = s1/s2*(N-xbins)/(xbins-1)
+
+            results[statistic][:, start:start+nf] = stat.T
+
+    return results
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests of the Stetson J of the incremental statistics of
+ztfperiodic.lcstats"""
+
+import warnings
+
+import numpy as np
+
+from ztfperiodic.lcstats import OnlineStats, calc_basic_stats
+
+STETSONJ = 18
+
+
+def make_lightcurve(n=600, trend=0.2, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.sort(rng.uniform(58000, 59000, n))
+    err = rng.uniform(0.02, 0.08, n)
+    mag = (15 + trend*(t-58000)/1000 + 0.1*np.sin(2*np.pi*t/7.3) +
+           rng.normal(0, 1, n)*err)
+    return t, mag, err
+
+
+def appended(t, mag, err, first, step):
+    state = OnlineStats.from_lightcurve(t[:first], mag[:first], err[:first])
+    for start in range(first, len(t), step):
+        state.update(t[start:start+step], mag[start:start+step],
+                     err[start:start+step])
+    return state
+
+
+def exact_stetsonj(t, mag, err):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return calc_basic_stats(t, mag, err)[STETSONJ]
+
+
+def test_stetsonj_exact():
+    # the pairs are kept while there are at most compression of them
+    t, mag, err = make_lightcurve(n=150)
+    state = appended(t, mag, err, 10, 7)
+    np.testing.assert_allclose(state.calc_basic_stats()[STETSONJ],
+                               exact_stetsonj(t, mag, err), rtol=1e-10)
+
+
+def test_stetsonj_trend():
+    # the weighted mean drifts while epochs are appended
+    for seed, trend in enumerate([0.05, 0.2, 0.5]):
+        t, mag, err = make_lightcurve(trend=trend, seed=seed)
+        state = appended(t, mag, err, 200, 20)
+
+        wmean = np.average(mag, weights=err**-2)
+        d = np.sqrt(len(t)/(len(t)-1.))*(mag-wmean)/err
+        scale = np.sum(np.sqrt(np.abs(d[:-1]*d[1:])))
+        assert abs(state.calc_basic_stats()[STETSONJ] -
+                   exact_stetsonj(t, mag, err)) < 6e-3*scale
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Tests of the CPU period search engines of ztfperiodic.periodsearch"""
+
+import numpy as np
+
+from ztfperiodic.periodsearch import make_engine, iter_find_periods
+from ztfperiodic.periodsearch import PeriodogramAccumulator, find_peaks
+
+
+def make_lightcurves(nlightcurves=20, seed=0):
+    rng = np.random.RandomState(seed)
+    lightcurves = []
+    for ii in range(nlightcurves):
+        n = rng.randint(20, 200)
+        t = np.sort(rng.uniform(58000, 59000, n))
+        period = rng.uniform(0.1, 5)
+        mag = (15 + rng.uniform(0, 0.1)*np.sin(2*np.pi*t/period) +
+               rng.normal(0, 0.05, n))
+        lightcurves.append((t, mag, np.full(n, 0.05)))
+    # too short to be analyzed
+    lightcurves.append((np.arange(3.), np.ones(3), np.ones(3)))
+    return lightcurves
+
+
+def run_ls(lightcurves, freqs, **kwargs):
+    engine = make_engine("LS", doCPU=True, **kwargs)
+    return list(iter_find_periods(engine, enumerate(lightcurves), freqs,
+                                  batch_size=len(lightcurves),
+                                  return_peaks=True))[0]
+
+
+def test_ls_freq_blocks():
+    lightcurves = make_lightcurves()
+    freqs = 1/30. + 1e-3*np.arange(10000)
+    # an excluded band splits the grid into two regular segments
+    freqs = freqs[(freqs < 0.9) | (freqs > 1.1)]
+
+    _, periods, significances, _, peaks = run_ls(lightcurves, freqs)
+    for freq_block_size in [1000, 3333]:
+        _, periods_blocked, significances_blocked, _, peaks_blocked = \
+            run_ls(lightcurves, freqs, freq_block_size=freq_block_size)
+        np.testing.assert_array_equal(periods_blocked, periods)
+        np.testing.assert_array_equal(significances_blocked, significances)
+        np.testing.assert_array_equal(peaks_blocked["summary"],
+                                      peaks["summary"])
+
+    assert periods[-1] == -1 and significances[-1] == -1
+
+
+def test_plateau_peaks():
+    # plateaus count once, at their first index, across block boundaries
+    stat = np.array([1, 3, 3, 3, 1, 2, 5, 5, 0, 4, 4.])
+    for block_size in [len(stat), 2, 3]:
+        accumulator = PeriodogramAccumulator(1, npeaks=4, local_peaks=True)
+        for start in range(0, len(stat), block_size):
+            accumulator.update(stat[np.newaxis, start:start+block_size],
+                               offset=start)
+        accumulator.finalize()
+        np.testing.assert_array_equal(accumulator.peak_index[0, :3],
+                                      [6, 9, 1])
+        assert np.isnan(accumulator.peak_value[0, 3])
+
+    np.testing.assert_array_equal(find_peaks(stat, 4), [6, 9, 1])
+    np.testing.assert_array_equal(find_peaks(-stat, 4, maximize=False),
+                                  [6, 9, 1])
+
+
+def test_nan_moments():
+    # non-finite values are left out of the mean and variance, whatever
+    # the block size
+    rng = np.random.RandomState(1)
+    stats = rng.uniform(0, 1, (3, 100))
+    stats[0, [5, 50, 51]] = np.nan
+    stats[1, 40:] = np.nan
+    stats[2] = np.nan
+    for block_size in [100, 7, 40]:
+        accumulator = PeriodogramAccumulator(3)
+        for start in range(0, stats.shape[1], block_size):
+            accumulator.update(stats[:, start:start+block_size],
+                               offset=start)
+        np.testing.assert_allclose(accumulator.mean[:2],
+                                   np.nanmean(stats[:2], axis=1))
+        np.testing.assert_allclose(accumulator.std()[:2],
+                                   np.nanstd(stats[:2], axis=1))
+        np.testing.assert_array_equal(accumulator.peak_index[:2, 0],
+                                      np.nanargmax(stats[:2], axis=1))
+        assert accumulator.significance()[2] == -1
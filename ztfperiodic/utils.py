@@ -1733,10 +1733,12 @@ def find_matchfile(matchfileDir, objid = 10593142036566):
 
 
 def get_matchfile(f, min_epochs = 1, doRemoveHC=False, doHCOnly=False,
-                  Ncatalog = 1, Ncatindex = 0):
+                  Ncatalog = 1, Ncatindex = 0, doZeroPoint=True):
     """
     Read matchfile (hdf file) light curves given the filename
     e.g.: f = '/path/to/fr000551-000600/ztf_000593_zr_c04_q3_match.pytable'
+    With doZeroPoint=False the times are left as HJD, so that sources
+    observed in the same exposures keep identical epochs.
     """
     bands = {'g': 1, 'r': 2, 'i': 3, 'z': 4, 'J': 5}
     fsplit = f.split("/")[-1].replace(".pytable","").split("_")
@@ -1818,7 +1820,8 @@ def get_matchfile(f, min_epochs = 1, doRemoveHC=False, doHCOnly=False,
             magmat[:, ii] = yinterp - np.nanmedian(yinterp)
 
         hjds.append(hjd)
-        hjd = hjd - np.min(hjd)
+        if doZeroPoint:
+            hjd = hjd - np.min(hjd)
 
         coordinate=(RA,Dec)
         coordinates.append(coordinate)